@@ -0,0 +1 @@
+"""Screen and audio recorder: a headless engine driven by a Tk window or the command line"""
@@ -0,0 +1,674 @@
+"""Audio capture, its ring buffers and the sinks it is written to"""
+import time
+import errno
+import stat
+import threading
+import types
+import os
+
+from .lazy import LazyModule
+
+np = LazyModule('numpy', 'np', globals())
+sf = LazyModule('soundfile', 'sf', globals())
+
+
+class AudioRingBuffer:
+    """Fixed-size single-producer/single-consumer ring of audio frames
+
+    write() runs in the real-time PortAudio callback: it only copies the block
+    into the preallocated array and bumps a counter, with no allocation of
+    sample buffers and no locks. The positions are ever-increasing frame
+    counters; each side only updates its own, which the GIL keeps consistent.
+    """
+
+    def __init__(self, capacity, channels, dtype='float32'):
+        self.capacity = capacity
+        self.channels = channels
+        self._buffer = np.zeros((capacity, channels), dtype=dtype)
+        self._write_pos = 0
+        self._read_pos = 0
+        self.overruns = 0
+        self.frames_lost = 0
+
+    def write(self, block):
+        """Copy a block into the ring; drops it and counts an overrun if full"""
+        frames = len(block)
+        if frames > self.capacity - (self._write_pos - self._read_pos):
+            self.overruns += 1
+            self.frames_lost += frames
+            return False
+        start = self._write_pos % self.capacity
+        first = min(frames, self.capacity - start)
+        self._buffer[start:start + first] = block[:first]
+        if first < frames:
+            self._buffer[:frames - first] = block[first:]
+        self._write_pos += frames
+        return True
+
+    def available(self):
+        """Number of frames waiting to be read"""
+        return self._write_pos - self._read_pos
+
+    def peek(self):
+        """Views of the readable frames, at most two because of wrap-around"""
+        frames = self.available()
+        start = self._read_pos % self.capacity
+        first = min(frames, self.capacity - start)
+        views = [self._buffer[start:start + first]]
+        if first < frames:
+            views.append(self._buffer[:frames - first])
+        return views
+
+    def consume(self, frames):
+        """Mark frames as read so the producer can reuse their space"""
+        self._read_pos += frames
+
+
+class RawAudioSink:
+    """Write float32 samples as raw bytes to a file or a FIFO
+
+    Stands in for a sound file when FFmpeg reads the audio as f32le. Raw
+    samples have no header to finalize, so a file stays readable up to the
+    last write. A FIFO is opened without blocking, so a reader that never
+    shows up cannot hang the recorder.
+    """
+
+    def __init__(self, path, open_timeout=10.0):
+        self.path = path
+        self.open_timeout = open_timeout
+        self.error = None
+        self._fd = None
+
+    def write(self, block):
+        """Append a block of samples; after a write error the rest is dropped"""
+        if self.error is not None:
+            return
+        try:
+            if self._fd is None:
+                self._fd = self._open(self.open_timeout)
+            data = memoryview(np.ascontiguousarray(block, dtype='float32')).cast('B')
+            while data:
+                data = data[os.write(self._fd, data):]
+        except OSError as e:
+            self.error = e
+
+    def close(self):
+        """Close the sink; a FIFO nobody has written to is opened to send EOF"""
+        if self._fd is None and self.error is None and self._is_fifo():
+            try:
+                self._fd = self._open(min(self.open_timeout, 2.0))
+            except OSError:
+                pass
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _is_fifo(self):
+        try:
+            return stat.S_ISFIFO(os.stat(self.path).st_mode)
+        except OSError:
+            return False
+
+    def _open(self, timeout):
+        """Open for writing, waiting up to timeout seconds for a FIFO reader"""
+        if not self._is_fifo():
+            return os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND
+                           | getattr(os, 'O_BINARY', 0), 0o644)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO or time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+                continue
+            os.set_blocking(fd, True)
+            return fd
+
+
+class ChunkedAudioSink(RawAudioSink):
+    """Write raw float32 samples into files of chunk_seconds each, named by a %05d pattern
+
+    Chunk n starts n * chunk_seconds into the recording, so drop_before()
+    can delete what a segment quota no longer needs while recording goes on.
+    """
+
+    def __init__(self, pattern, sample_rate, channels, chunk_seconds):
+        super().__init__(pattern % 0)
+        self.pattern = pattern
+        self.chunk_seconds = chunk_seconds
+        self.chunk_frames = max(1, int(chunk_seconds * sample_rate))
+        self._chunk = 0
+        self._chunk_written = 0
+        self._dropped = 0
+
+    def write(self, block):
+        """Append samples, starting the next file whenever a chunk is full"""
+        while len(block):
+            if self._chunk_written == self.chunk_frames:
+                super().close()
+                self._chunk += 1
+                self._chunk_written = 0
+                self.path = self.pattern % self._chunk
+            part = block[:self.chunk_frames - self._chunk_written]
+            super().write(part)
+            self._chunk_written += len(part)
+            block = block[len(part):]
+
+    def drop_before(self, seconds):
+        """Delete the chunks that end before this time, never the one being written"""
+        last = min(int(seconds // self.chunk_seconds), self._chunk)
+        for number in range(self._dropped, last):
+            try:
+                os.remove(self.pattern % number)
+            except OSError:
+                pass
+        self._dropped = max(self._dropped, last)
+
+
+def capture_time_ns(frames, sample_rate, time_info):
+    """Monotonic time at which the first sample of a PortAudio input block was captured"""
+    latency = frames / sample_rate
+    try:
+        if 0 < time_info.inputBufferAdcTime <= time_info.currentTime:
+            latency = time_info.currentTime - time_info.inputBufferAdcTime
+    except AttributeError:
+        pass
+    return time.monotonic_ns() - int(latency * 1e9)
+
+
+class AudioRecorder:
+    """Record an input device to a sound file with flat memory use
+
+    The callback feeds an AudioRingBuffer and a writer thread drains it
+    incrementally into an open soundfile.SoundFile, or into `sink` (any
+    object with write(block) and close()) when one is given. A
+    PipelineMetrics gets the time of every callback and drain pass.
+    stream_factory stands in for sounddevice.InputStream, e.g.
+    SyntheticAudioStream.
+    """
+
+    def __init__(self, path, sample_rate, channels, device=None, ring_seconds=5.0,
+                 drain_interval=0.1, sink=None, metrics=None, stream_factory=None):
+        self.path = path
+        self.sink = sink
+        self.metrics = metrics
+        self.stream_factory = stream_factory
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.device = device
+        self.drain_interval = drain_interval
+        self.ring = AudioRingBuffer(int(sample_rate * ring_seconds), channels)
+        self.frames_written = 0
+        self.input_overflows = 0
+        self.input_underflows = 0
+        # (stream frame position, monotonic ns of that frame's capture) for the
+        # first and the latest block, mapping audio onto the shared clock
+        self.first_block = None
+        self.last_block = None
+        self._position = 0
+        # Frames still to drop from the front, None while waiting for align_to
+        self._skip = 0
+        self._timeline_start = None
+        self._running = False
+        self._stream = None
+        self._file = None
+        self._writer_thread = None
+
+    def start(self):
+        """Open the output file and the input stream"""
+        if self.sink is not None:
+            self._file = self.sink
+        else:
+            self._file = sf.SoundFile(self.path, mode='w', samplerate=self.sample_rate,
+                                      channels=self.channels)
+        try:
+            self._open_streams()
+            self._running = True
+            self._writer_thread = threading.Thread(target=self._drain_loop, daemon=True)
+            self._writer_thread.start()
+            self._stream.start()
+        except Exception:
+            self.stop()
+            raise
+
+    def _stream_factory(self):
+        """stream_factory, or sounddevice.InputStream"""
+        if self.stream_factory is not None:
+            return self.stream_factory
+        import sounddevice as sd
+        return sd.InputStream
+
+    def _open_streams(self):
+        """Create the input stream; started once the writer thread runs"""
+        self._stream = self._stream_factory()(device=self.device,
+                                              channels=self.channels,
+                                              samplerate=self.sample_rate,
+                                              dtype='float32',
+                                              callback=self._audio_callback)
+
+    def stop(self):
+        """Stop the stream, flush the ring and close the file"""
+        if self._stream is not None:
+            try:
+                self._stream.stop()
+                self._stream.close()
+            finally:
+                self._stream = None
+        self._running = False
+        if self._writer_thread is not None:
+            self._writer_thread.join()
+            self._writer_thread = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        """Snapshot of the audio counters"""
+        return {
+            'frames_written': self.frames_written,
+            'ring_overruns': self.ring.overruns,
+            'frames_lost': self.ring.frames_lost,
+            'input_overflows': self.input_overflows,
+            'input_underflows': self.input_underflows,
+        }
+
+    def align_to(self, timeline_start):
+        """Start the output at a moment on the monotonic clock
+
+        timeline_start() returns that moment in ns, or None while it is not
+        known yet; until then samples stay in the ring. Samples captured
+        earlier are dropped and a late start is padded with silence, so the
+        output needs no offset when it is muxed with the video.
+        """
+        self._timeline_start = timeline_start
+        self._skip = None
+
+    def clock(self):
+        """Return (first_sample_ns, measured_sample_rate) on the monotonic clock
+
+        The measured rate tells how fast the device clock runs relative to the
+        monotonic clock; it is None until enough audio has been seen.
+        """
+        if self.first_block is None:
+            return None
+        first_pos, first_ns = self.first_block
+        last_pos, last_ns = self.last_block
+        start_ns = first_ns - int(first_pos * 1e9 / self.sample_rate)
+        measured_rate = None
+        if last_ns - first_ns >= 10_000_000_000:
+            measured_rate = (last_pos - first_pos) * 1e9 / (last_ns - first_ns)
+        return start_ns, measured_rate
+
+    def _audio_callback(self, indata, frames, time_info, status):
+        """Audio recording callback"""
+        if self.metrics is not None:
+            began = time.perf_counter_ns()
+        if status:
+            if status.input_overflow:
+                self.input_overflows += 1
+            if status.input_underflow:
+                self.input_underflows += 1
+
+        stamp = (self._position, capture_time_ns(frames, self.sample_rate, time_info))
+        if self.first_block is None:
+            self.first_block = stamp
+        self.last_block = stamp
+        self._position += frames
+
+        self.ring.write(indata)
+        if self.metrics is not None:
+            self.metrics.record('audio_callback', time.perf_counter_ns() - began)
+
+    def _drain_loop(self):
+        """Write whatever the callback produced since the last pass"""
+        while True:
+            running = self._running
+            if self.metrics is None:
+                self._drain()
+            else:
+                began = time.perf_counter_ns()
+                self._drain()
+                self.metrics.record('audio_drain', time.perf_counter_ns() - began)
+            if not running:
+                break
+            time.sleep(self.drain_interval)
+
+    def _drain(self):
+        """Move all readable frames from the ring into the file"""
+        if self._skip is None:
+            clock = self.clock()
+            start_ns = self._timeline_start()
+            if clock is None or start_ns is None:
+                return
+            self._skip = round((start_ns - clock[0]) * self.sample_rate / 1e9)
+            if self._skip < 0:
+                self._file.write(np.zeros((-self._skip, self.channels), dtype='float32'))
+                self._skip = 0
+        for view in self.ring.peek():
+            if self._skip:
+                skipped = min(self._skip, len(view))
+                self.ring.consume(skipped)
+                self._skip -= skipped
+                view = view[skipped:]
+            if len(view):
+                self._file.write(view)
+                self.ring.consume(len(view))
+                self.frames_written += len(view)
+
+
+def fit_channels(block, channels):
+    """Block with the given number of channels: mono is copied, extra channels dropped"""
+    if block.shape[1] == channels:
+        return block
+    if channels == 1:
+        return block.mean(axis=1, keepdims=True)
+    if block.shape[1] == 1:
+        return np.repeat(block, channels, axis=1)
+    return block[:, :channels]
+
+
+class AudioInput:
+    """One device of a MultiDeviceRecorder: its ring, clock stamps and resampler
+
+    The callback only copies blocks into the ring and stamps them. read()
+    runs in the mixer thread and resamples by linear interpolation onto
+    the shared timeline. Its step follows the device's own timestamps, so
+    drift between device clocks is absorbed by a change of the ratio of at
+    most MAX_CORRECTION; a device that stalls is re-synced with silence.
+    """
+
+    MAX_CORRECTION = 0.002  # 0.2 %, far above real clock drift and inaudible
+    CORRECTION_SECONDS = 2.0  # A position error is worked off over this long
+    DRIFT_GAIN = 0.02  # Share of the correction that is learned as steady drift per read
+    RESYNC_SECONDS = 0.05  # Larger errors skip input or insert silence at once
+
+    def __init__(self, device, sample_rate, channels, name=None, ring_seconds=5.0):
+        self.device = device
+        self.name = name or str(device)
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.ring = AudioRingBuffer(int(sample_rate * ring_seconds), channels)
+        self.stream = None
+        self.metrics = None
+        self.input_overflows = 0
+        self.frames_padded = 0
+        self.resyncs = 0
+        self.ratio = 1.0
+        self.drift = 0.0  # Learned rate error of the device clock
+        self.first_block = None
+        self.last_block = None
+        self._position = 0
+        self._pending = np.zeros((0, channels), dtype='float32')
+        self._pending_start = 0  # Input position of _pending[0]
+        self._phase = 0.0  # Position of the next output sample, relative to _pending[0]
+        self._error = 0.0  # Smoothed position error in input samples
+
+    def callback(self, indata, frames, time_info, status):
+        """PortAudio callback of this device"""
+        if self.metrics is not None:
+            began = time.perf_counter_ns()
+        if status and status.input_overflow:
+            self.input_overflows += 1
+        stamp = (self._position, capture_time_ns(frames, self.sample_rate, time_info))
+        if self.first_block is None:
+            self.first_block = stamp
+        self.last_block = stamp
+        self._position += frames
+        self.ring.write(indata)
+        if self.metrics is not None:
+            self.metrics.record('audio_callback', time.perf_counter_ns() - began)
+
+    def start_ns(self):
+        """Monotonic time of the first sample, None before the first block"""
+        if self.first_block is None:
+            return None
+        position, stamp_ns = self.first_block
+        return stamp_ns - int(position * 1e9 / self.sample_rate)
+
+    def end_ns(self):
+        """Monotonic time just after the last sample delivered, None before the first block"""
+        if self.last_block is None:
+            return None
+        position, stamp_ns = self.last_block
+        return stamp_ns + int((self._position - position) * 1e9 / self.sample_rate)
+
+    def read(self, frames, out_rate, out_ns):
+        """Next frames samples at out_rate, the first one captured at out_ns"""
+        views = self.ring.peek()
+        available = sum(len(view) for view in views)
+        if available:
+            self._pending = np.concatenate([self._pending] + views)
+            self.ring.consume(available)
+        out = np.zeros((frames, self.channels), dtype='float32')
+        if self.last_block is None:
+            self.frames_padded += frames
+            return out
+
+        # Where the device's latest timestamp says the next sample should come from
+        position, stamp_ns = self.last_block
+        error = (position + (out_ns - stamp_ns) * self.sample_rate / 1e9 -
+                 (self._pending_start + self._phase))
+        if abs(error) > self.RESYNC_SECONDS * self.sample_rate:
+            self._phase += error
+            self._error = 0.0
+            self.resyncs += 1
+        else:
+            self._error += 0.1 * (error - self._error)
+        # Proportional to the error, plus the drift learned from it so
+        # a steady clock difference leaves no steady position error
+        correction = self._error / (self.sample_rate * self.CORRECTION_SECONDS)
+        self.drift = max(-self.MAX_CORRECTION, min(
+            self.MAX_CORRECTION, self.drift + self.DRIFT_GAIN * correction))
+        self.ratio = 1.0 + max(-self.MAX_CORRECTION, min(
+            self.MAX_CORRECTION, self.drift + correction))
+        step = self.sample_rate / out_rate * self.ratio
+
+        positions = self._phase + step * np.arange(frames)
+        valid = (positions >= 0) & (positions < len(self._pending) - 1)
+        index = positions[valid].astype(np.int64)
+        fraction = (positions[valid] - index)[:, None].astype('float32')
+        out[valid] = (self._pending[index] * (1 - fraction) +
+                      self._pending[index + 1] * fraction)
+        self.frames_padded += frames - int(np.count_nonzero(valid))
+
+        self._phase += step * frames
+        drop = min(max(int(self._phase), 0), len(self._pending))
+        self._pending = self._pending[drop:]
+        self._pending_start += drop
+        self._phase -= drop
+        return out
+
+    def stats(self):
+        """Counters of this device"""
+        return {
+            'name': self.name,
+            'sample_rate': self.sample_rate,
+            'ring_overruns': self.ring.overruns,
+            'frames_lost': self.ring.frames_lost,
+            'input_overflows': self.input_overflows,
+            'frames_padded': self.frames_padded,
+            'resyncs': self.resyncs,
+            'drift_ppm': self.drift * 1e6,
+        }
+
+
+class _StreamGroup:
+    """Start, stop and close the streams of several AudioInputs as one"""
+
+    def __init__(self, streams):
+        self.streams = streams
+
+    def start(self):
+        for stream in self.streams:
+            stream.start()
+
+    def stop(self):
+        for stream in self.streams:
+            stream.stop()
+
+    def close(self):
+        for stream in self.streams:
+            stream.close()
+
+
+class MultiDeviceRecorder(AudioRecorder):
+    """Record several input devices at once, mixed or as separate tracks
+
+    Each device streams at its own rate into its own AudioInput. The
+    drain thread resamples them all to sample_rate on a shared timeline
+    that trails the clock by LATENCY_SECONDS, then adds them up
+    (tracks="mix") or puts their channels side by side, `channels` per
+    device (tracks="separate"). The result goes through the AudioRecorder
+    ring, so alignment, sinks and clock() work as with a single device.
+    inputs are dicts of AudioInput arguments.
+    """
+
+    TRACKS = ("mix", "separate")
+    LATENCY_SECONDS = 0.2
+    START_TIMEOUT = 1.0  # Devices that have not delivered by then join later
+
+    def __init__(self, path, sample_rate, channels, inputs, tracks="mix", **kwargs):
+        if tracks not in self.TRACKS:
+            raise ValueError(f"Unknown audio track layout: {tracks}")
+        self.inputs = [AudioInput(**spec) for spec in inputs]
+        self.tracks = tracks
+        self.track_channels = channels
+        if tracks == "separate":
+            channels *= len(self.inputs)
+        super().__init__(path, sample_rate, channels, **kwargs)
+        self.mix_seconds = 0.0
+        self.mix_max_ms = 0.0
+        self._produced = 0
+        self._timeline_ns = None
+        self._first_input_ns = None
+
+    def _open_streams(self):
+        stream_factory = self._stream_factory()
+        for audio_input in self.inputs:
+            audio_input.metrics = self.metrics
+            audio_input.stream = stream_factory(device=audio_input.device,
+                                                channels=audio_input.channels,
+                                                samplerate=audio_input.sample_rate,
+                                                dtype='float32',
+                                                callback=audio_input.callback)
+        self._stream = _StreamGroup([audio_input.stream for audio_input in self.inputs])
+
+    def stats(self):
+        stats = super().stats()
+        devices = [audio_input.stats() for audio_input in self.inputs]
+        for name in ('ring_overruns', 'frames_lost', 'input_overflows'):
+            stats[name] += sum(device[name] for device in devices)
+        stats['devices'] = devices
+        stats['mix_max_ms'] = self.mix_max_ms
+        if self._produced:
+            stats['mix_ms_per_s'] = self.mix_seconds * 1e3 / (self._produced / self.sample_rate)
+        return stats
+
+    def _drain(self):
+        self._mix()
+        super()._drain()
+
+    def _mix(self):
+        """Resample and combine everything the devices delivered up to the timeline end"""
+        if self._timeline_ns is None and not self._start_timeline():
+            return
+        began = time.perf_counter()
+        if self._running:
+            end_ns = time.monotonic_ns() - int(self.LATENCY_SECONDS * 1e9)
+        else:
+            # The streams are stopped, flush up to the last sample of any device
+            end_ns = max(audio_input.end_ns() or 0 for audio_input in self.inputs)
+        end = int((end_ns - self._timeline_ns) * self.sample_rate / 1e9)
+        frames = min(end - self._produced, self.ring.capacity - self.ring.available())
+        if frames <= 0:
+            return
+        out_ns = self._timeline_ns + int(self._produced * 1e9 / self.sample_rate)
+        blocks = [fit_channels(audio_input.read(frames, self.sample_rate, out_ns),
+                               self.track_channels)
+                  for audio_input in self.inputs]
+        if self.tracks == "separate":
+            block = np.concatenate(blocks, axis=1)
+        elif len(blocks) == 1:
+            block = blocks[0]
+        else:
+            block = np.clip(np.sum(blocks, axis=0), -1.0, 1.0)
+        self.ring.write(block)
+        self._produced += frames
+        self.last_block = (self._produced,
+                           self._timeline_ns + int(self._produced * 1e9 / self.sample_rate))
+        elapsed = time.perf_counter() - began
+        self.mix_seconds += elapsed
+        self.mix_max_ms = max(self.mix_max_ms, elapsed * 1e3)
+
+    def _start_timeline(self):
+        """Start the shared timeline once every device (or the timeout) is there"""
+        starts = [audio_input.start_ns() for audio_input in self.inputs]
+        known = [start for start in starts if start is not None]
+        if not known:
+            return False
+        if self._first_input_ns is None:
+            self._first_input_ns = time.monotonic_ns()
+        if len(known) < len(starts) and \
+                time.monotonic_ns() - self._first_input_ns < self.START_TIMEOUT * 1e9:
+            return False
+        self._timeline_ns = max(known)
+        self.first_block = (0, self._timeline_ns)
+        self.last_block = self.first_block
+        return True
+
+
+class SyntheticAudioStream:
+    """Stands in for sounddevice.InputStream: a tone with a click on every second
+
+    Blocks are delivered in real time by a thread, as a device would. The
+    device clock runs drift_ppm fast or slow, and the clicks fall on whole
+    seconds of the monotonic clock, so they line up across devices when
+    the recorder compensates drift correctly.
+    """
+
+    def __init__(self, device=None, channels=2, samplerate=48000, dtype='float32',
+                 callback=None, blocksize=None, drift_ppm=0.0, frequency=440.0):
+        self.channels = channels
+        self.samplerate = samplerate
+        self.callback = callback
+        self.blocksize = blocksize or max(64, int(samplerate * 0.01))
+        self.drift_ppm = drift_ppm
+        self.frequency = frequency
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        pass
+
+    def _run(self):
+        true_rate = self.samplerate * (1 + self.drift_ppm * 1e-6)
+        start = time.monotonic()
+        position = 0
+        time_info = types.SimpleNamespace(currentTime=0.0, inputBufferAdcTime=0.0)
+        while self._running:
+            # The block is handed over once its last sample has been captured
+            block_end = start + (position + self.blocksize) / true_rate
+            delay = block_end - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            captured = start + position / true_rate + np.arange(self.blocksize) / true_rate
+            block = 0.1 * np.sin(2 * np.pi * self.frequency * captured)
+            block[(captured % 1.0) < 0.005] = 0.9
+            time_info.currentTime = time.monotonic()
+            time_info.inputBufferAdcTime = captured[0]
+            self.callback(np.repeat(block[:, None], self.channels, axis=1).astype('float32'),
+                          self.blocksize, time_info, None)
+            position += self.blocksize
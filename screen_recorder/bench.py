@@ -0,0 +1,476 @@
+"""Benchmarks and their per-machine baselines"""
+import json
+import math
+import tempfile
+import time
+import sys
+import threading
+import os
+import platform
+import shutil
+import subprocess
+
+from .lazy import LazyModule
+from .encoding import FFmpegStreamWriter, RawVideoWriter
+from .capture import frame_shape, convert_color, SyntheticCapture
+from .pipeline import peak_rss_mb
+from .audio import MultiDeviceRecorder, SyntheticAudioStream
+from .jobs import FinalizeQueue, finalize_stages
+from .spool import FrameSpool
+from .engine import RecorderEngine
+from .gui import ScreenRecorderGUI
+
+np = LazyModule('numpy', 'np', globals())
+sf = LazyModule('soundfile', 'sf', globals())
+
+# Where ScreenRecording.py is, one level above this package
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_startup(kind, start):
+    """Child side of the startup benchmark; prints one JSON result line
+
+    start is the perf_counter value taken right before importing this module.
+    """
+    result = {'import_s': time.perf_counter() - start}
+    if kind == 'engine':
+        RecorderEngine()
+        result['engine_ready_s'] = time.perf_counter() - start
+        result['engine_rss_mb'] = peak_rss_mb()
+        print(json.dumps(result), flush=True)
+        return
+
+    app = ScreenRecorderGUI()
+
+    def on_map(event=None):
+        if 'gui_first_window_s' not in result:
+            result['gui_first_window_s'] = time.perf_counter() - start
+            app.root.after_idle(finish)
+
+    def finish():
+        result['gui_rss_mb'] = peak_rss_mb()
+        print(json.dumps(result), flush=True)
+        app.preview_active = False
+        app.root.destroy()
+
+    app.root.bind('<Map>', on_map, add='+')
+    app.root.mainloop()
+
+
+def directory_bytes(path):
+    """Total size of the files below path; files that vanish meanwhile count as empty"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def measure_recording(config):
+    """Child side of the recording benchmark; prints one JSON result line
+
+    Records config['seconds'] of a synthetic screen and audio into
+    config['work_dir'] and finalizes it. Temporary captures, finalize jobs
+    and segment sessions all land below work_dir, where a thread samples
+    their size.
+    """
+    work_dir = config['work_dir']
+    temp_dir = os.path.join(work_dir, 'tmp')
+    output_dir = os.path.join(work_dir, 'out')
+    os.makedirs(temp_dir)
+    tempfile.tempdir = temp_dir
+    size = tuple(config['size'])
+    engine = RecorderEngine(
+        jobs_dir=os.path.join(temp_dir, 'jobs'),
+        capture_factory=lambda: SyntheticCapture(size, pattern=config['pattern']),
+        audio_stream_factory=SyntheticAudioStream)
+    engine.configure(output_dir=output_dir, capture_backend=SyntheticCapture.name,
+                     fps=config['fps'], encode_mode=config['encode'], adaptive=False,
+                     index_recordings=False,
+                     audio_enabled=config['audio'], sample_rate=48000, channels=2)
+
+    temp_peak = [0]
+    finished = threading.Event()
+
+    def watch_temp():
+        while not finished.wait(0.05):
+            sessions = sum(directory_bytes(entry.path) for entry in os.scandir(output_dir)
+                           if entry.is_dir())
+            temp_peak[0] = max(temp_peak[0], directory_bytes(temp_dir) + sessions)
+
+    engine.start()
+    watcher = threading.Thread(target=watch_temp, daemon=True)
+    watcher.start()
+    time.sleep(config['seconds'])
+    stopped = time.perf_counter()
+    engine.stop(wait=True)
+    engine.jobs.wait()
+    finalize_s = time.perf_counter() - stopped
+    finished.set()
+    watcher.join()
+    engine.jobs.shutdown()
+
+    if engine.last_output is None:
+        raise Exception(engine.message)
+    stats = engine.stats()
+    video = stats['video']
+    audio = stats.get('audio', {})
+    ticks = video['captured'] + video['ticks_missed']
+    print(json.dumps({
+        'fps': video['achieved_fps'],
+        'drop_pct': 100 * (video['ticks_missed'] + video['dropped']) / ticks if ticks else 0.0,
+        'finalize_s': finalize_s,
+        'peak_rss_mb': peak_rss_mb(),
+        'temp_mb': temp_peak[0] / (1024 * 1024),
+        'output_mb': os.path.getsize(engine.last_output) / (1024 * 1024),
+        'audio_overruns': audio.get('ring_overruns', 0) + audio.get('input_overflows', 0),
+    }), flush=True)
+
+
+# Timings only compare on the machine that made them, so there is one directory per host
+BASELINE_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'baselines')
+
+
+def default_baseline(benchmark):
+    """Where a benchmark's baseline lives on this machine"""
+    return os.path.join(BASELINE_DIR, platform.node() or 'localhost', f'{benchmark}.json')
+
+
+def compare_to_baseline(results, baseline, tolerance, higher_is_better=()):
+    """Return a description of every metric that regressed against the baseline"""
+    regressions = []
+    for name, value in results.items():
+        reference = baseline.get(name)
+        if not isinstance(value, (int, float)) or not isinstance(reference, (int, float)):
+            continue
+        if name in higher_is_better:
+            regressed = value < reference * (1 - tolerance)
+        else:
+            regressed = value > reference * (1 + tolerance)
+        if regressed:
+            regressions.append(f"{name}: {value:.4g} (baseline {reference:.4g})")
+    return regressions
+
+
+def report_benchmark(results, args, higher_is_better=()):
+    """Print results, save or compare a baseline; returns the exit code
+
+    Without --baseline the results are compared with this machine's
+    default baseline, if there is one; a bare --save-baseline writes it.
+    """
+    width = max(len(name) for name in results) if results else 0
+    for name, value in results.items():
+        shown = f"{value:.4f}" if isinstance(value, float) else str(value)
+        print(f"{name:<{width}}  {shown}")
+
+    default = default_baseline(args.benchmark)
+    baseline_path = args.baseline
+    if baseline_path is None and not args.no_baseline and args.save_baseline is None:
+        baseline_path = default if os.path.exists(default) else None
+        if baseline_path is None:
+            print(f"No baseline at {default}, --save-baseline creates it")
+
+    if args.save_baseline is not None:
+        path = args.save_baseline or default
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to: {path}")
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance, higher_is_better)
+        if regressions:
+            print(f"Regressions against baseline {baseline_path}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"No regressions against baseline {baseline_path}")
+    return 0
+
+
+def bench_startup(args):
+    """Median import time, time to a ready engine and time to the first window"""
+    code = ("import sys, time; start = time.perf_counter(); "
+            f"sys.path.insert(0, {ROOT_DIR!r}); "
+            "import ScreenRecording; "
+            "from screen_recorder.bench import measure_startup; "
+            "measure_startup(sys.argv[1], start)")
+    samples = {}
+    for kind in ('engine', 'gui'):
+        for _ in range(args.runs):
+            process = subprocess.run([sys.executable, '-c', code, kind],
+                                     capture_output=True, text=True, timeout=60)
+            lines = process.stdout.strip().splitlines()
+            if process.returncode != 0 or not lines:
+                print(f"Skipping {kind} startup: {process.stderr.strip().splitlines()[-1:]}",
+                      file=sys.stderr)
+                break
+            for name, value in json.loads(lines[-1]).items():
+                if value is not None:
+                    samples.setdefault(name, []).append(value)
+
+    results = {name: sorted(values)[len(values) // 2] for name, values in samples.items()}
+    return report_benchmark(results, args)
+
+
+def bench_convert(args):
+    """Time and memory allocated per frame turning a BGRA capture into encoder input
+
+    two_pass is the BGR hand-off, where the encoder converts to I420 itself;
+    single_pass converts straight into a preallocated I420 buffer.
+    """
+    import tracemalloc
+
+    results = {}
+    for size in args.sizes:
+        width, height = (int(value) for value in size.lower().split('x'))
+        frame = np.random.randint(0, 256, frame_shape((width, height), "BGRA"), dtype=np.uint8)
+        bgr = np.empty(frame_shape((width, height), "BGR"), dtype=np.uint8)
+        i420 = np.empty(frame_shape((width, height), "I420"), dtype=np.uint8)
+        paths = {
+            'two_pass': lambda: convert_color(convert_color(frame, "BGRA", "BGR", dst=bgr),
+                                              "BGR", "I420"),
+            'single_pass': lambda: convert_color(frame, "BGRA", "I420", dst=i420),
+        }
+        for name, convert in paths.items():
+            convert()
+            start = time.perf_counter()
+            for _ in range(args.frames):
+                convert()
+            results[f'{size}_{name}_ms'] = (time.perf_counter() - start) * 1000 / args.frames
+
+            # Whatever a conversion allocates is freed again, so look at the peak
+            allocated = 0
+            tracemalloc.start()
+            try:
+                for _ in range(args.frames):
+                    current = tracemalloc.get_traced_memory()[0]
+                    tracemalloc.reset_peak()
+                    convert()
+                    allocated += tracemalloc.get_traced_memory()[1] - current
+            finally:
+                tracemalloc.stop()
+            results[f'{size}_{name}_alloc_kb'] = allocated / args.frames / 1024
+    return report_benchmark(results, args)
+
+
+def bench_transcode(args):
+    """Wall-clock time of finalizing a raw capture in one process vs. in parallel chunks
+
+    Only --loop-seconds of uncompressed I420 are written to disk; FFmpeg's
+    concat protocol repeats them into a raw stream of the full length, which
+    the finalize commands read and seek like a capture of that length.
+    """
+    width, height = (int(value) for value in args.size.lower().split('x'))
+    chunks = args.chunks or os.cpu_count() or 1
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix="screen_recorder_bench_")
+    try:
+        loop_frames = int(args.loop_seconds * args.fps)
+        source = os.path.join(work_dir, 'capture.yuv')
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi',
+                        '-i', f'testsrc2=size={width}x{height}:rate={args.fps}',
+                        '-frames:v', str(loop_frames), '-pix_fmt', 'yuv420p',
+                        '-f', 'rawvideo', source], check=True)
+        video_format = ['-f', 'rawvideo', '-pix_fmt', 'yuv420p',
+                        '-video_size', f'{width}x{height}', '-framerate', str(args.fps)]
+        for minutes in args.minutes:
+            frames = int(minutes * 60 * args.fps)
+            # Nothing to delete after the job: the input is not a file
+            video = 'concat:' + '|'.join([source] * math.ceil(frames / loop_frames))
+            for name, count in (('single', 1), ('chunked', chunks)):
+                output = os.path.join(work_dir, f'{name}.mp4')
+                stages, files = finalize_stages(output, args.fps, frames, chunks=count,
+                                                video_format=video_format)
+                queue = FinalizeQueue(os.path.join(work_dir, 'jobs'))
+                job_id = queue.submit(name, stages, output, in_place={'video': video},
+                                      files=files, duration=frames / args.fps)
+                start = time.perf_counter()
+                queue.start()
+                queue.wait()
+                elapsed = time.perf_counter() - start
+                queue.shutdown()
+                job = next(job for job in queue.jobs() if job['id'] == job_id)
+                if job['state'] != 'done':
+                    raise Exception(f"{name} transcode failed: {job['error']}")
+                results[f'{args.size}_{minutes:g}min_{name}_s'] = elapsed
+                os.remove(output)
+            results[f'{args.size}_{minutes:g}min_speedup'] = (
+                results[f'{args.size}_{minutes:g}min_single_s'] /
+                results[f'{args.size}_{minutes:g}min_chunked_s'])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report_benchmark(results, args,
+                            higher_is_better={name for name in results if name.endswith('_speedup')})
+
+
+def bench_spool(args):
+    """Per-frame write time of the frame spool vs. the raw AVI writer, and random frame reads
+
+    The write times are what the pipeline's encode stage waits for; the
+    throughput includes flushing the file to disk. Frames go to --dir,
+    which should be the disk recordings are saved to.
+    """
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix="screen_recorder_bench_", dir=args.dir)
+    rng = np.random.default_rng(0)
+    try:
+        for size in args.sizes:
+            width, height = (int(value) for value in size.lower().split('x'))
+            frame_size = (width, height)
+            shape = frame_shape(frame_size, "I420")
+            frames = [rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(4)]
+            writers = {'spool': lambda: FrameSpool(os.path.join(work_dir, 'bench.spool'),
+                                                   args.fps, frame_size)}
+            if FFmpegStreamWriter.is_available():
+                writers['avi'] = lambda: RawVideoWriter(os.path.join(work_dir, 'bench.avi'),
+                                                        args.fps, frame_size)
+            for name, create in writers.items():
+                writer = create()
+                times = []
+                start = time.perf_counter()
+                for number in range(args.frames):
+                    began = time.perf_counter_ns()
+                    writer.write(frames[number % len(frames)])
+                    times.append(time.perf_counter_ns() - began)
+                writer.release()
+                path = writer.frames_path if name == 'spool' else writer.output_path
+                with open(path, 'rb') as f:
+                    os.fsync(f.fileno())
+                elapsed = time.perf_counter() - start
+                times.sort()
+                results[f'{size}_{name}_write_ms'] = sum(times) / len(times) / 1e6
+                results[f'{size}_{name}_write_p99_ms'] = times[int(len(times) * 0.99)] / 1e6
+                results[f'{size}_{name}_mb_per_s'] = (args.frames * frames[0].nbytes /
+                                                       elapsed / (1024 * 1024))
+
+            # Scrubbing: copy frames out of the spool in random order
+            spool = FrameSpool.open(os.path.join(work_dir, 'bench.spool'))
+            frame = np.empty(shape, dtype=np.uint8)
+            start = time.perf_counter()
+            for number in rng.integers(0, spool.frames, args.reads):
+                np.copyto(frame, spool.frame(number))
+            results[f'{size}_spool_read_ms'] = (time.perf_counter() - start) * 1000 / args.reads
+            spool.close()
+            shutil.rmtree(os.path.join(work_dir, 'bench.spool'))
+            if os.path.exists(os.path.join(work_dir, 'bench.avi')):
+                os.remove(os.path.join(work_dir, 'bench.avi'))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report_benchmark(results, args,
+                            higher_is_better={name for name in results if name.endswith('_mb_per_s')})
+
+
+def measure_audio_devices(path, count, drift, rate, seconds):
+    """Record count simulated devices for seconds; mixer cost, xruns and skew
+
+    Each SyntheticAudioStream runs its clock up to drift ppm off and clicks
+    on whole seconds of the monotonic clock; the skew is how far the clicks
+    of the separate tracks lie apart once drift compensation settled.
+    """
+    drifts = [drift * (2 * index / max(1, count - 1) - 1) for index in range(count)]
+    inputs = [{'device': index, 'sample_rate': rate, 'channels': 2} for index in range(count)]
+    recorder = MultiDeviceRecorder(
+        path, rate, 2, inputs, tracks="separate",
+        stream_factory=lambda device, **kwargs: SyntheticAudioStream(
+            drift_ppm=drifts[device], **kwargs))
+    recorder.start()
+    time.sleep(seconds)
+    recorder.stop()
+    stats = recorder.stats()
+    start_ns = recorder.clock()[0]
+
+    # Clicks in the second half, as offsets from the whole second in ms
+    data = sf.read(path, dtype='float32')[0]
+    half = len(data) // 2
+    offsets = []
+    for track in range(count):
+        loud = np.flatnonzero(np.abs(data[half:, 2 * track]) > 0.5) + half
+        onsets = loud[np.diff(loud, prepend=-rate) > rate // 2]
+        times = start_ns / 1e9 + onsets / rate
+        offsets.append((times - np.round(times)) * 1e3)
+    clicks = min(len(offset) for offset in offsets)
+    skew = np.ptp([offset[:clicks] for offset in offsets], axis=0) if clicks else [0.0]
+    return {
+        'mix_ms_per_s': stats.get('mix_ms_per_s', 0.0),
+        'mix_max_ms': stats['mix_max_ms'],
+        'xruns': stats['ring_overruns'] + stats['input_overflows'],
+        'clicks': clicks,
+        'skew_ms': float(np.max(skew)),
+    }
+
+
+def bench_audio(args):
+    """Mixer cost, xruns and alignment of several simulated input devices"""
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix="screen_recorder_bench_")
+    try:
+        for count in args.devices:
+            measured = measure_audio_devices(os.path.join(work_dir, f'{count}.wav'), count,
+                                             args.drift, args.rate, args.seconds)
+            for name in ('mix_ms_per_s', 'mix_max_ms', 'xruns', 'skew_ms'):
+                results[f'{count}dev_{name}'] = measured[name]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report_benchmark(results, args)
+
+
+def bench_record(args):
+    """Sustained FPS, drops, finalize time, peak RSS and temp disk use of whole recordings
+
+    Every size and pattern is recorded in a fresh process through the real
+    capture, encode and finalize path, with SyntheticCapture for the screen
+    and SyntheticAudioStream for the sound card. Rate control is off, so
+    the numbers show what the machine sustains at the requested FPS. The
+    peak RSS is the recorder's own, FFmpeg's is not included.
+    """
+    code = ("import sys, json; "
+            f"sys.path.insert(0, {ROOT_DIR!r}); "
+            "import ScreenRecording; "
+            "from screen_recorder.bench import measure_recording; "
+            "measure_recording(json.loads(sys.argv[1]))")
+    results = {}
+    failed = False
+    work_dir = tempfile.mkdtemp(prefix="screen_recorder_bench_")
+    try:
+        for size in args.sizes:
+            width, height = (int(value) for value in size.lower().split('x'))
+            for pattern in args.patterns:
+                config = {'work_dir': os.path.join(work_dir, f'{size}_{pattern}'),
+                          'size': [width, height], 'pattern': pattern, 'fps': args.fps,
+                          'seconds': args.seconds, 'encode': args.encode,
+                          'audio': not args.no_audio}
+                process = subprocess.run([sys.executable, '-c', code, json.dumps(config)],
+                                         capture_output=True, text=True)
+                lines = process.stdout.strip().splitlines()
+                if process.returncode != 0 or not lines:
+                    print(f"{size} {pattern} failed: {process.stderr.strip().splitlines()[-1:]}",
+                          file=sys.stderr)
+                    failed = True
+                    continue
+                for name, value in json.loads(lines[-1]).items():
+                    results[f'{size}_{pattern}_{name}'] = value
+                shutil.rmtree(config['work_dir'], ignore_errors=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    code = report_benchmark(results, args,
+                            higher_is_better={name for name in results if name.endswith('_fps')})
+    return code or int(failed)
+
+
+def add_baseline_arguments(parser):
+    """Options shared by all benchmarks"""
+    parser.add_argument('--baseline', default=None,
+                        help="JSON file from --save-baseline to compare against "
+                             "(default: this machine's baseline, if saved)")
+    parser.add_argument('--no-baseline', action='store_true',
+                        help="don't compare against the default baseline")
+    parser.add_argument('--save-baseline', nargs='?', const='', default=None, metavar='FILE',
+                        help="write the results to FILE (default: this machine's baseline)")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed relative regression (default: 0.25)")
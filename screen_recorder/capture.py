@@ -0,0 +1,808 @@
+"""Screen capture backends and the pixel formats they deliver"""
+import copy
+import time
+import sys
+import ctypes
+import ctypes.util
+import importlib.util
+import threading
+import multiprocessing
+import os
+
+from .lazy import LazyModule
+
+cv2 = LazyModule('cv2', 'cv2', globals())
+np = LazyModule('numpy', 'np', globals())
+
+
+class CaptureBackend:
+    """Base class for screen capture sources
+
+    grab() returns a (height, width, channels) uint8 array in pixel_format.
+    Backends may return the same reused buffer on every call, so the frame is
+    only valid until the next grab(). Resources are opened lazily on the first
+    grab() because some platforms tie them to the thread that created them.
+
+    region is (left, top, width, height) in desktop coordinates, None for
+    the backend's default area; open() fills it in. Only the region is read
+    from the screen, so a small region costs proportionally less. move()
+    shifts it, e.g. to follow a window; its size stays the same.
+    """
+
+    name = None
+    pixel_format = "RGB"
+
+    def __init__(self, region=None):
+        self._opened = False
+        self.size = None
+        self.region = tuple(region) if region else None
+        self.bounds = None  # (left, top, width, height) of the whole desktop
+
+    def __getstate__(self):
+        # Capture resources don't cross processes; a copy reopens lazily
+        return {key: value for key, value in self.__dict__.items() if not key.startswith('_')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._opened = False
+
+    @classmethod
+    def is_available(cls):
+        """Check whether the backend can run on this machine"""
+        return True
+
+    def open(self):
+        """Acquire capture resources and set self.size to (width, height)"""
+        self._opened = True
+
+    def _use_region(self, bounds, default=None):
+        """Settle region within the desktop bounds and set size from it"""
+        self.bounds = tuple(bounds)
+        if self.region is None:
+            self.region = tuple(default or bounds)
+        left, top, width, height = self.region
+        bound_left, bound_top, bound_width, bound_height = self.bounds
+        if (width < 1 or height < 1 or left < bound_left or top < bound_top or
+                left + width > bound_left + bound_width or
+                top + height > bound_top + bound_height):
+            raise ValueError(f"Capture region {self.region} is outside the desktop {self.bounds}")
+        self.size = (width, height)
+
+    def with_region(self, region):
+        """An unopened backend of the same kind that captures region"""
+        backend = copy.copy(self)
+        backend.region = tuple(region)
+        backend.size = None
+        return backend
+
+    def move(self, left, top):
+        """Shift the region to a new top left corner, clamped to the desktop"""
+        if self.region is None:
+            return
+        width, height = self.region[2:]
+        if self.bounds is not None:
+            bound_left, bound_top, bound_width, bound_height = self.bounds
+            left = min(max(left, bound_left), bound_left + bound_width - width)
+            top = min(max(top, bound_top), bound_top + bound_height - height)
+        self.region = (left, top, width, height)
+
+    def monitors(self):
+        """(left, top, width, height) of every monitor, the primary one first"""
+        if self.bounds is None:
+            self.frame_size()
+        return [self.bounds]
+
+    def find_window(self, title):
+        """Region of the first visible window whose title contains title, or None
+
+        Uses pygetwindow where it is installed (Windows and macOS).
+        """
+        if importlib.util.find_spec('pygetwindow') is None:
+            return None
+        import pygetwindow
+        for window in pygetwindow.getWindowsWithTitle(title):
+            if window.width > 0 and window.height > 0 and not window.isMinimized:
+                return (window.left, window.top, window.width, window.height)
+        return None
+
+    def grab(self):
+        """Capture one frame"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release capture resources"""
+        self._opened = False
+
+    def frame_size(self):
+        """Return (width, height), probing the backend once if needed"""
+        if self.size is None:
+            self.open()
+            self.close()
+        return self.size
+
+
+def clip_region(region, bounds):
+    """Part of region (left, top, width, height) inside bounds, None if there is none"""
+    left, top = max(region[0], bounds[0]), max(region[1], bounds[1])
+    right = min(region[0] + region[2], bounds[0] + bounds[2])
+    bottom = min(region[1] + region[3], bounds[1] + bounds[3])
+    if right <= left or bottom <= top:
+        return None
+    return (left, top, right - left, bottom - top)
+
+
+# cv2 conversion codes by name, so cv2 is not imported at module load
+COLOR_CONVERSIONS = {
+    ("RGB", "BGR"): 'COLOR_RGB2BGR',
+    ("BGRA", "BGR"): 'COLOR_BGRA2BGR',
+    ("RGB", "RGB"): None,
+    ("BGRA", "RGB"): 'COLOR_BGRA2RGB',
+    ("RGB", "I420"): 'COLOR_RGB2YUV_I420',
+    ("BGRA", "I420"): 'COLOR_BGRA2YUV_I420',
+    ("BGR", "I420"): 'COLOR_BGR2YUV_I420',
+}
+
+
+PIXEL_CHANNELS = {"RGB": 3, "BGR": 3, "BGRA": 4}
+
+
+def frame_shape(frame_size, pixel_format):
+    """Array shape of one frame; I420 is the Y plane with U and V stacked below it"""
+    width, height = frame_size
+    if pixel_format == "I420":
+        return (height * 3 // 2, width)
+    return (height, width, PIXEL_CHANNELS[pixel_format])
+
+
+def even_frame_size(frame_size):
+    """Largest even size that fits, as 4:2:0 chroma covers 2x2 pixel blocks"""
+    width, height = frame_size
+    return (width - width % 2, height - height % 2)
+
+
+def convert_color(frame, src_format, dst_format, dst=None):
+    """Convert between capture pixel formats, writing into dst when given"""
+    code = COLOR_CONVERSIONS[(src_format, dst_format)]
+    if code is None:
+        if dst is None:
+            return frame
+        np.copyto(dst, frame)
+        return dst
+    return cv2.cvtColor(frame, getattr(cv2, code), dst=dst)
+
+
+class XImage(ctypes.Structure):
+    """Leading fields of Xlib's XImage, enough to locate the pixel data"""
+    _fields_ = [
+        ('width', ctypes.c_int),
+        ('height', ctypes.c_int),
+        ('xoffset', ctypes.c_int),
+        ('format', ctypes.c_int),
+        ('data', ctypes.c_void_p),
+        ('byte_order', ctypes.c_int),
+        ('bitmap_unit', ctypes.c_int),
+        ('bitmap_bit_order', ctypes.c_int),
+        ('bitmap_pad', ctypes.c_int),
+        ('depth', ctypes.c_int),
+        ('bytes_per_line', ctypes.c_int),
+        ('bits_per_pixel', ctypes.c_int),
+    ]
+
+
+class XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ('shmseg', ctypes.c_ulong),
+        ('shmid', ctypes.c_int),
+        ('shmaddr', ctypes.c_void_p),
+        ('readOnly', ctypes.c_int),
+    ]
+
+
+class XWindowAttributes(ctypes.Structure):
+    _fields_ = [
+        ('x', ctypes.c_int),
+        ('y', ctypes.c_int),
+        ('width', ctypes.c_int),
+        ('height', ctypes.c_int),
+        ('border_width', ctypes.c_int),
+        ('depth', ctypes.c_int),
+        ('visual', ctypes.c_void_p),
+        ('root', ctypes.c_ulong),
+        ('class', ctypes.c_int),
+        ('bit_gravity', ctypes.c_int),
+        ('win_gravity', ctypes.c_int),
+        ('backing_store', ctypes.c_int),
+        ('backing_planes', ctypes.c_ulong),
+        ('backing_pixel', ctypes.c_ulong),
+        ('save_under', ctypes.c_int),
+        ('colormap', ctypes.c_ulong),
+        ('map_installed', ctypes.c_int),
+        ('map_state', ctypes.c_int),
+        ('all_event_masks', ctypes.c_long),
+        ('your_event_mask', ctypes.c_long),
+        ('do_not_propagate_mask', ctypes.c_long),
+        ('override_redirect', ctypes.c_int),
+        ('screen', ctypes.c_void_p),
+    ]
+
+
+class XRRMonitorInfo(ctypes.Structure):
+    _fields_ = [
+        ('name', ctypes.c_ulong),
+        ('primary', ctypes.c_int),
+        ('automatic', ctypes.c_int),
+        ('noutput', ctypes.c_int),
+        ('x', ctypes.c_int),
+        ('y', ctypes.c_int),
+        ('width', ctypes.c_int),
+        ('height', ctypes.c_int),
+        ('mwidth', ctypes.c_int),
+        ('mheight', ctypes.c_int),
+        ('outputs', ctypes.c_void_p),
+    ]
+
+
+class X11ShmCapture(CaptureBackend):
+    """X11 capture through the MIT-SHM extension
+
+    The X server copies the region of the root window straight into a shared
+    memory segment that is mapped once, and grab() returns a NumPy view of
+    it, so a frame costs one XShmGetImage round trip and no allocation. The
+    default region is the whole root window, i.e. all monitors.
+    """
+
+    name = "x11shm"
+    pixel_format = "BGRA"
+
+    @classmethod
+    def is_available(cls):
+        return (sys.platform.startswith('linux') and bool(os.environ.get('DISPLAY')) and
+                ctypes.util.find_library('X11') is not None and
+                ctypes.util.find_library('Xext') is not None)
+
+    def open(self):
+        xlib = ctypes.CDLL(ctypes.util.find_library('X11'))
+        xext = ctypes.CDLL(ctypes.util.find_library('Xext'))
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        xlib.XRootWindow.restype = ctypes.c_ulong
+        xlib.XRootWindow.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDefaultVisual.restype = ctypes.c_void_p
+        xlib.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDisplayWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDisplayHeight.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.restype = ctypes.POINTER(XImage)
+        xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint,
+                                         ctypes.c_int, ctypes.c_void_p,
+                                         ctypes.POINTER(XShmSegmentInfo),
+                                         ctypes.c_uint, ctypes.c_uint]
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XImage),
+                                      ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+        display = xlib.XOpenDisplay(None)
+        if not display:
+            raise Exception("Cannot open X display")
+        self._xlib, self._xext, self._libc, self._display = xlib, xext, libc, display
+        if not xext.XShmQueryExtension(display):
+            self.close()
+            raise Exception("X server does not support MIT-SHM")
+
+        screen = xlib.XDefaultScreen(display)
+        self._root = xlib.XRootWindow(display, screen)
+        try:
+            self._use_region((0, 0, xlib.XDisplayWidth(display, screen),
+                              xlib.XDisplayHeight(display, screen)))
+        except ValueError:
+            self.close()
+            raise
+        width, height = self.size
+        depth = xlib.XDefaultDepth(display, screen)
+        if depth not in (24, 32):
+            self.close()
+            raise Exception(f"Unsupported X display depth: {depth}")
+
+        self._shminfo = XShmSegmentInfo()
+        self._image = xext.XShmCreateImage(display, xlib.XDefaultVisual(display, screen), depth,
+                                           2,  # ZPixmap
+                                           None, ctypes.byref(self._shminfo), width, height)
+        if not self._image:
+            self.close()
+            raise Exception("XShmCreateImage failed")
+
+        image = self._image.contents
+        nbytes = image.bytes_per_line * image.height
+        shmid = libc.shmget(0, nbytes, 0o1000 | 0o600)  # IPC_PRIVATE, IPC_CREAT | rw
+        if shmid < 0:
+            self.close()
+            raise OSError(ctypes.get_errno(), "shmget failed")
+        address = libc.shmat(shmid, None, 0)
+        # Mark for removal right away; it goes when both sides have detached
+        libc.shmctl(shmid, 0, None)  # IPC_RMID
+        if address in (None, ctypes.c_void_p(-1).value):
+            self.close()
+            raise OSError(ctypes.get_errno(), "shmat failed")
+        self._shminfo.shmid = shmid
+        self._shminfo.shmaddr = address
+        self._shminfo.readOnly = 0
+        image.data = address
+        if not xext.XShmAttach(display, ctypes.byref(self._shminfo)):
+            self.close()
+            raise Exception("XShmAttach failed")
+        xlib.XSync(display, 0)
+
+        buffer = (ctypes.c_uint8 * nbytes).from_address(address)
+        self._frame = np.ndarray((height, width, 4), dtype=np.uint8, buffer=buffer,
+                                 strides=(image.bytes_per_line, 4, 1))
+        self._opened = True
+
+    def grab(self):
+        if not self._opened:
+            self.open()
+        left, top = self.region[:2]
+        if not self._xext.XShmGetImage(self._display, self._root, self._image, left, top,
+                                       0xFFFFFFFF):  # AllPlanes
+            raise Exception("XShmGetImage failed")
+        return self._frame
+
+    @staticmethod
+    def _open_display():
+        """A short-lived Xlib connection for queries outside of capturing"""
+        xlib = ctypes.CDLL(ctypes.util.find_library('X11'))
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xlib.XFree.argtypes = [ctypes.c_void_p]
+        display = xlib.XOpenDisplay(None)
+        if not display:
+            raise Exception("Cannot open X display")
+        return xlib, display
+
+    def monitors(self):
+        """Monitors from XRandR 1.5, the whole root window without it"""
+        if self.bounds is None:
+            self.frame_size()
+        library = ctypes.util.find_library('Xrandr')
+        if library is None:
+            return [self.bounds]
+        xrandr = ctypes.CDLL(library)
+        if not hasattr(xrandr, 'XRRGetMonitors'):
+            return [self.bounds]
+        xrandr.XRRGetMonitors.restype = ctypes.POINTER(XRRMonitorInfo)
+        xrandr.XRRGetMonitors.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int,
+                                          ctypes.POINTER(ctypes.c_int)]
+        xrandr.XRRFreeMonitors.argtypes = [ctypes.POINTER(XRRMonitorInfo)]
+        xlib, display = self._open_display()
+        try:
+            count = ctypes.c_int()
+            infos = xrandr.XRRGetMonitors(display, xlib.XDefaultRootWindow(display), 1,
+                                          ctypes.byref(count))
+            if not infos:
+                return [self.bounds]
+            monitors = sorted((not infos[i].primary, infos[i].x, infos[i].y,
+                               infos[i].width, infos[i].height) for i in range(count.value))
+            xrandr.XRRFreeMonitors(infos)
+        finally:
+            xlib.XCloseDisplay(display)
+        return [monitor[1:] for monitor in monitors] or [self.bounds]
+
+    def find_window(self, title):
+        """Walk the window tree for a viewable window whose name contains title"""
+        xlib, display = self._open_display()
+        window_p = ctypes.POINTER(ctypes.c_ulong)
+        xlib.XQueryTree.argtypes = [ctypes.c_void_p, ctypes.c_ulong, window_p, window_p,
+                                    ctypes.POINTER(window_p), ctypes.POINTER(ctypes.c_uint)]
+        xlib.XFetchName.argtypes = [ctypes.c_void_p, ctypes.c_ulong,
+                                    ctypes.POINTER(ctypes.c_char_p)]
+        xlib.XGetWindowAttributes.argtypes = [ctypes.c_void_p, ctypes.c_ulong,
+                                              ctypes.POINTER(XWindowAttributes)]
+        xlib.XTranslateCoordinates.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong,
+                                               ctypes.c_int, ctypes.c_int,
+                                               ctypes.POINTER(ctypes.c_int),
+                                               ctypes.POINTER(ctypes.c_int), window_p]
+        title = title.lower()
+        try:
+            root = xlib.XDefaultRootWindow(display)
+            pending = [root]
+            while pending:
+                window = pending.pop(0)
+                name = ctypes.c_char_p()
+                if window != root and xlib.XFetchName(display, window, ctypes.byref(name)):
+                    matches = name.value is not None and \
+                        title in name.value.decode(errors='replace').lower()
+                    xlib.XFree(name)
+                    attributes = XWindowAttributes()
+                    if matches and xlib.XGetWindowAttributes(display, window,
+                                                             ctypes.byref(attributes)) \
+                            and attributes.map_state == 2:  # IsViewable
+                        x, y, child = ctypes.c_int(), ctypes.c_int(), ctypes.c_ulong()
+                        xlib.XTranslateCoordinates(display, window, root, 0, 0, ctypes.byref(x),
+                                                   ctypes.byref(y), ctypes.byref(child))
+                        return (x.value, y.value, attributes.width, attributes.height)
+                root_return, parent, children = ctypes.c_ulong(), ctypes.c_ulong(), window_p()
+                count = ctypes.c_uint()
+                if xlib.XQueryTree(display, window, ctypes.byref(root_return),
+                                   ctypes.byref(parent), ctypes.byref(children),
+                                   ctypes.byref(count)):
+                    pending.extend(children[i] for i in range(count.value))
+                    if children:
+                        xlib.XFree(children)
+            return None
+        finally:
+            xlib.XCloseDisplay(display)
+
+    def close(self):
+        display = getattr(self, '_display', None)
+        if display:
+            shminfo = getattr(self, '_shminfo', None)
+            if shminfo is not None and shminfo.shmaddr:
+                self._xext.XShmDetach(display, ctypes.byref(shminfo))
+                self._libc.shmdt(shminfo.shmaddr)
+                shminfo.shmaddr = None
+            # The XImage itself is a small malloc'd struct; its data is the
+            # shared segment, which is released above
+            self._xlib.XCloseDisplay(display)
+            self._display = None
+        self._frame = None
+        self._opened = False
+
+
+class MSSCapture(CaptureBackend):
+    """Cross-platform capture through the mss package (BGRA, no PIL image)"""
+
+    name = "mss"
+    pixel_format = "BGRA"
+
+    @classmethod
+    def is_available(cls):
+        return importlib.util.find_spec('mss') is not None
+
+    @staticmethod
+    def _rect(monitor):
+        return (monitor['left'], monitor['top'], monitor['width'], monitor['height'])
+
+    def open(self):
+        import mss
+        self._sct = mss.mss()
+        # monitors[0] spans all monitors, the default is the primary one
+        try:
+            self._use_region(self._rect(self._sct.monitors[0]),
+                             default=self._rect(self._sct.monitors[1]))
+        except ValueError:
+            self._sct.close()
+            raise
+        self._opened = True
+
+    def grab(self):
+        if not self._opened:
+            self.open()
+        left, top, width, height = self.region
+        shot = self._sct.grab({'left': left, 'top': top, 'width': width, 'height': height})
+        width, height = shot.size
+        return np.frombuffer(shot.raw, dtype=np.uint8).reshape(height, width, 4)
+
+    def monitors(self):
+        import mss
+        with mss.mss() as sct:
+            return [self._rect(monitor) for monitor in sct.monitors[1:]]
+
+    def close(self):
+        if self._opened:
+            self._sct.close()
+        self._opened = False
+
+
+class PyAutoGUICapture(CaptureBackend):
+    """Capture through pyautogui.screenshot(), works wherever pyautogui does"""
+
+    name = "pyautogui"
+    pixel_format = "RGB"
+
+    @classmethod
+    def is_available(cls):
+        return importlib.util.find_spec('pyautogui') is not None
+
+    def open(self):
+        import pyautogui
+        self._pyautogui = pyautogui
+        self._use_region((0, 0) + tuple(pyautogui.size()))
+        self._opened = True
+
+    def grab(self):
+        if not self._opened:
+            self.open()
+        if self.region == self.bounds:
+            return np.asarray(self._pyautogui.screenshot())
+        return np.asarray(self._pyautogui.screenshot(region=self.region))
+
+
+class SyntheticCapture(CaptureBackend):
+    """Test pattern source for headless runs and benchmarks
+
+    The desktop is two monitors of monitor_size side by side, the default
+    region is the first one. A window titled "Synthetic" drifts across it,
+    for trying out window tracking. Patterns, from cheapest to hardest to
+    encode: "static" never changes, "gradient" moves a bar across it,
+    "text" scrolls a page of text and "noise" shows different random pixels
+    in every frame. All of them are the same for every run.
+    """
+
+    name = "synthetic"
+    pixel_format = "BGRA"
+    WINDOW_TITLE = "Synthetic"
+    PATTERNS = ("gradient", "static", "text", "noise")
+    SCROLL_PIXELS = 4  # Per frame, for "text"
+    NOISE_ROWS = 256  # Extra rows of noise; frames start at varying rows within them
+
+    def __init__(self, monitor_size=(1280, 720), region=None, pattern="gradient"):
+        super().__init__(region)
+        if pattern not in self.PATTERNS:
+            raise ValueError(f"Unknown synthetic pattern: {pattern}")
+        self.monitor_size = tuple(monitor_size)
+        self.pattern = pattern
+
+    def monitors(self):
+        width, height = self.monitor_size
+        return [(0, 0, width, height), (width, 0, width, height)]
+
+    def find_window(self, title):
+        if title.lower() not in self.WINDOW_TITLE.lower():
+            return None
+        width, height = self.monitor_size
+        # Drifts right and back over the first monitor, ten pixels a second
+        span = width // 2
+        offset = int(time.monotonic() * 10) % (2 * span)
+        return (min(offset, 2 * span - offset), height // 4, width // 2, height // 2)
+
+    def open(self):
+        width, height = self.monitor_size
+        self._use_region((0, 0, 2 * width, height), default=(0, 0, width, height))
+        if self.pattern == "text":
+            self._background = self._text_page(2 * width, height)
+        elif self.pattern == "noise":
+            rng = np.random.default_rng(0)
+            self._background = rng.integers(0, 256, (height + self.NOISE_ROWS, 2 * width, 4),
+                                            dtype=np.uint8)
+            self._background[..., 3] = 255
+        else:
+            ramp = np.linspace(0, 255, 2 * width, dtype=np.uint8)
+            self._background = np.empty((height, 2 * width, 4), dtype=np.uint8)
+            self._background[..., 0] = ramp
+            self._background[..., 1] = np.linspace(0, 255, height, dtype=np.uint8)[:, None]
+            self._background[..., 2] = ramp[::-1]
+            self._background[..., 3] = 255
+        self._frame = np.empty((self.size[1], self.size[0], 4), dtype=np.uint8)
+        self._frames = 0
+        self._opened = True
+
+    @staticmethod
+    def _text_page(width, height):
+        """Black on white lines of text, twice over so scrolling wraps around seamlessly"""
+        page = np.full((height, width, 4), 255, dtype=np.uint8)
+        scale = height / 1080
+        line_height = max(8, int(30 * scale))
+        text = "The quick brown fox jumps over the lazy dog. " * (width // (12 * line_height) + 1)
+        for line, y in enumerate(range(line_height, height, line_height)):
+            cv2.putText(page, f"{line:04d}  {text}", (int(10 * scale), y),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.8 * scale, (0, 0, 0, 255),
+                        max(1, int(2 * scale)), cv2.LINE_AA)
+        return np.concatenate([page, page])
+
+    def grab(self):
+        if not self._opened:
+            self.open()
+        left, top, width, height = self.region
+        if self.pattern == "text":
+            top += self._frames * self.SCROLL_PIXELS % self.monitor_size[1]
+        elif self.pattern == "noise":
+            # Jumps further than an encoder's motion search looks
+            top += self._frames * 97 % self.NOISE_ROWS
+        # Only the region is drawn, like a real backend only reads the region
+        np.copyto(self._frame, self._background[top:top + height, left:left + width])
+        if self.pattern == "gradient":
+            bar = max(1, self.monitor_size[0] // 32)
+            x = (self._frames * bar // 2) % (self.bounds[2] - bar + 1) - left
+            if x + bar > 0 and x < width:
+                self._frame[:, max(0, x):x + bar, :3] = 255
+        self._frames += 1
+        return self._frame
+
+
+def _capture_worker(backend, buffer, conn):
+    """Body of a ProcessCapture worker: grab into the shared buffer on request"""
+    frame = np.frombuffer(buffer, dtype=np.uint8).reshape(
+        frame_shape(backend.size, backend.pixel_format))
+    try:
+        # The first grab opens the backend in this process
+        np.copyto(frame, backend.grab())
+        conn.send(('ready',))
+        while True:
+            request = conn.recv()
+            if request[0] == 'grab':
+                np.copyto(frame, backend.grab())
+                conn.send(('ok',))
+            elif request[0] == 'move':
+                backend.move(*request[1:])
+            else:
+                break
+    except EOFError:
+        pass
+    except Exception as e:
+        conn.send(('error', str(e)))
+    finally:
+        backend.close()
+
+
+class ProcessCapture(CaptureBackend):
+    """Runs another backend in a worker process, handing frames over in shared memory
+
+    Sources grabbed by threads of one process take turns on the GIL; each in
+    its own process they capture in parallel. The worker fills a shared
+    buffer on every grab() request and grab() returns a view of it. Unlike
+    other backends it can be opened ahead of time from any thread, which
+    keeps the process start-up out of the first frame interval.
+    """
+
+    name = "process"
+
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+        self.pixel_format = backend.pixel_format
+        self.size = backend.frame_size()
+        self.region = backend.region
+        self.bounds = backend.bounds
+        self._lock = threading.Lock()
+
+    def open(self, timeout=30.0):
+        context = multiprocessing.get_context('spawn')
+        shape = frame_shape(self.size, self.pixel_format)
+        self._buffer = context.RawArray('B', int(np.prod(shape)))
+        self._frame = np.frombuffer(self._buffer, dtype=np.uint8).reshape(shape)
+        self._conn, worker_conn = context.Pipe()
+        self._process = context.Process(target=_capture_worker,
+                                        args=(self.backend, self._buffer, worker_conn),
+                                        daemon=True)
+        self._process.start()
+        worker_conn.close()
+        self._opened = True
+        if not self._conn.poll(timeout):
+            self.close()
+            raise Exception(f"{self.backend.name} capture process did not start")
+        self._reply()
+
+    def _reply(self):
+        try:
+            reply = self._conn.recv()
+        except EOFError:
+            reply = ('error', "capture process exited")
+        if reply[0] == 'error':
+            raise Exception(f"{self.backend.name} capture failed: {reply[1]}")
+
+    def grab(self):
+        if not self._opened:
+            self.open()
+        with self._lock:
+            self._conn.send(('grab',))
+        self._reply()
+        return self._frame
+
+    def move(self, left, top):
+        super().move(left, top)
+        if self._opened:
+            with self._lock:
+                self._conn.send(('move',) + self.region[:2])
+
+    def monitors(self):
+        return self.backend.monitors()
+
+    def find_window(self, title):
+        return self.backend.find_window(title)
+
+    def close(self):
+        if self._opened:
+            try:
+                with self._lock:
+                    self._conn.send(('close',))
+            except OSError:
+                pass
+            self._process.join(timeout=5.0)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._conn.close()
+        self._opened = False
+
+
+CAPTURE_BACKENDS = {
+    backend.name: backend
+    for backend in (X11ShmCapture, MSSCapture, PyAutoGUICapture, SyntheticCapture)
+}
+
+
+def create_capture_backend(name="auto", region=None):
+    """Create a capture backend by name, or pick the fastest one with "auto"
+
+    "auto" opens every available real backend, times a few grabs and keeps
+    the quickest. It never picks the synthetic test pattern, which has to be
+    named; when no real backend can grab the screen it raises RuntimeError.
+    """
+    if name != "auto":
+        if name not in CAPTURE_BACKENDS:
+            raise ValueError(f"Unknown capture backend: {name}")
+        return CAPTURE_BACKENDS[name](region=region)
+
+    best, best_time = None, None
+    failures = []
+    for backend_cls in CAPTURE_BACKENDS.values():
+        if backend_cls is SyntheticCapture:
+            continue
+        if not backend_cls.is_available():
+            failures.append(f"{backend_cls.name}: not available")
+            continue
+        backend = backend_cls(region=region)
+        try:
+            elapsed = benchmark_capture_backend(backend)
+        except Exception as e:
+            backend.close()
+            failures.append(f"{backend_cls.name}: {e}")
+            continue
+        if best_time is None or elapsed < best_time:
+            if best is not None:
+                best.close()
+            best, best_time = backend, elapsed
+        else:
+            backend.close()
+
+    if best is None:
+        raise RuntimeError("No usable capture backend, the screen cannot be recorded "
+                           f"({'; '.join(failures)})")
+    # The winner is reopened lazily by the thread that will use it
+    best.close()
+    return best
+
+
+def benchmark_capture_backend(backend, grabs=5):
+    """Median seconds per grab after one warm-up grab"""
+    backend.grab()
+    timings = []
+    for _ in range(grabs):
+        start = time.perf_counter()
+        backend.grab()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def parse_region(text):
+    """(left, top, width, height) from "X,Y,W,H" """
+    try:
+        region = tuple(int(value) for value in text.split(','))
+    except ValueError:
+        region = ()
+    if len(region) != 4:
+        raise ValueError(f"Region must be X,Y,WIDTH,HEIGHT, not '{text}'")
+    return region
+
+
+def parse_monitors(values):
+    """Monitors setting from command line words: None, "all" or monitor numbers"""
+    if not values:
+        return None
+    if values == ["all"]:
+        return "all"
+    return [int(value) for value in values]
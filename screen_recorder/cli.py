@@ -0,0 +1,391 @@
+"""Command line interface; without a subcommand the GUI is started"""
+import argparse
+import json
+import time
+import sys
+import os
+import signal
+
+from .capture import SyntheticCapture, CAPTURE_BACKENDS, parse_region, parse_monitors
+from .pipeline import FrameRing, FrameScheduler, PipelineMetrics
+from .audio import MultiDeviceRecorder
+from .spool import FrameSpool
+from .library import describe_recording
+from .engine import RecorderEngine
+from .gui import run_gui
+from .bench import (bench_startup, bench_convert, bench_transcode, bench_spool, bench_audio,
+                    bench_record, add_baseline_arguments)
+
+
+def record_from_cli(args):
+    """Run a headless recording from parsed command line arguments"""
+    engine = RecorderEngine(on_status=lambda message: print(message, flush=True))
+    if not args.no_audio:
+        engine.setup_audio()
+    settings = {
+        'mode': args.mode,
+        'fps': args.fps,
+        'quality': args.quality,
+        'adaptive': not args.no_adaptive,
+        'encode_mode': args.encode,
+        'segment_seconds': args.segment_seconds,
+        'segment_keep': args.segment_keep,
+        'replay_seconds': args.replay_seconds,
+        'replay_memory_mb': args.replay_memory,
+        'keep_spool': args.keep_spool,
+        'finalize_workers': args.finalize_workers,
+        'finalize_chunks': args.finalize_chunks,
+        'backpressure': args.backpressure,
+        'skip_static': args.skip_static,
+        'catch_up': args.catch_up,
+        'capture_backend': args.backend,
+        'region': args.region,
+        'window': args.window,
+        'monitors': parse_monitors(args.monitors),
+        'layout': args.layout,
+        'index_recordings': not args.no_index,
+        'metrics': args.metrics is not None,
+        'metrics_format': args.metrics or "json",
+        'audio_enabled': engine.audio_enabled and not args.no_audio,
+    }
+    if args.output_dir:
+        settings['output_dir'] = args.output_dir
+    if args.audio_device is not None:
+        settings['audio_device'] = parse_audio_device(args.audio_device)
+    if args.audio_devices:
+        settings['audio_devices'] = [parse_audio_device(device) for device in args.audio_devices]
+    settings['audio_tracks'] = args.audio_tracks
+    engine.configure(**settings)
+    if args.backend == "auto" and args.mode == "screen_and_audio":
+        # Reports through on_error why nothing can grab the screen
+        if engine.probe_capture_backends() is None:
+            return 1
+
+    errors = []
+    engine.on_error = lambda title, message: errors.append(f"{title}: {message}")
+    try:
+        engine.start()
+    except ValueError as e:
+        print(f"Invalid settings: {e}", file=sys.stderr)
+        return 2
+
+    # A replay buffer saves a clip on SIGUSR1 and once more when it ends
+    save_requests = []
+    replay = args.encode == "replay" and args.mode == "screen_and_audio"
+    if replay and hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: save_requests.append(signum))
+
+    # Record until the duration is over or Ctrl+C
+    try:
+        deadline = time.monotonic() + args.duration if args.duration else None
+        while engine.is_recording:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if save_requests:
+                save_requests.clear()
+                save_replay_from_cli(engine)
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    if replay and engine.is_recording:
+        save_replay_from_cli(engine)
+    engine.stop(wait=True)
+    if not wait_for_jobs(engine):
+        return 1
+
+    for error in errors:
+        print(error, file=sys.stderr)
+    if args.stats:
+        print(json.dumps(engine.stats(), indent=2, default=str))
+    return 0 if engine.last_output else 1
+
+
+def parse_audio_device(text):
+    """sounddevice device from the command line: an index or (part of) a name"""
+    return int(text) if text.isdigit() else text
+
+
+def save_replay_from_cli(engine):
+    """Save the replay buffer, reporting a failure instead of stopping the recording"""
+    try:
+        engine.save_replay()
+    except Exception as e:
+        print(f"Saving the replay failed: {e}", file=sys.stderr)
+
+
+def monitors_from_cli(args):
+    """Print the monitors of a capture backend, numbered as --monitors takes them"""
+    engine = RecorderEngine()
+    engine.configure(capture_backend=args.backend)
+    try:
+        monitors = engine.create_capture_backend().monitors()
+    except Exception as e:
+        print(f"Cannot list monitors: {e}", file=sys.stderr)
+        return 1
+    for number, (left, top, width, height) in enumerate(monitors, 1):
+        print(f"{number}: {width}x{height} at {left},{top}")
+    return 0
+
+
+def library_from_cli(args):
+    """Bring the library index up to date and print a page of it, newest first"""
+    engine = RecorderEngine()
+    if args.output_dir:
+        engine.configure(output_dir=args.output_dir)
+    library = engine.library()
+    try:
+        library.scan()
+        library.wait(thumbnails=args.thumbnails)
+        total = library.count(args.search)
+        for entry in library.page(args.offset, args.limit, args.search):
+            created, duration, picture, size = describe_recording(entry)
+            line = f"{created}  {duration:>9}  {picture:>9}  {size:>11}  {entry['name']}"
+            if entry['error']:
+                line += f"  ({entry['error']})"
+            print(line)
+        print(f"{total} recordings in {library.directory}")
+    except KeyboardInterrupt:
+        return 1
+    finally:
+        engine.close_libraries()
+    return 0
+
+
+def wait_for_jobs(engine):
+    """Wait for the finalize jobs; Ctrl+C leaves them queued for the next run"""
+    try:
+        engine.jobs.wait()
+        engine.close_libraries(wait=True)
+        return True
+    except KeyboardInterrupt:
+        engine.jobs.shutdown()
+        print(f"Unfinished jobs kept in {engine.jobs.jobs_dir}", file=sys.stderr)
+        return False
+
+
+def recover_from_cli(args):
+    """Rebuild interrupted segmented recordings from the command line"""
+    engine = RecorderEngine(on_status=lambda message: print(message, flush=True))
+    if args.output_dir:
+        engine.configure(output_dir=args.output_dir)
+    sessions = args.sessions or engine.interrupted_sessions()
+    if not sessions:
+        print(f"No interrupted recordings in {engine.output_dir}")
+        return 0
+    job_ids = engine.recover_sessions(sessions)
+    if not wait_for_jobs(engine):
+        return 1
+    done = [job for job in engine.jobs.jobs() if job['id'] in job_ids and job['state'] == 'done']
+    return 0 if len(done) == len(sessions) else 1
+
+
+def spool_from_cli(args):
+    """Describe a frame spool and, given a range or an output, encode that part of it"""
+    try:
+        spool = FrameSpool.open(args.spool)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Cannot open {args.spool}: {e}", file=sys.stderr)
+        return 1
+    width, height = spool.frame_size
+    print(f"{spool.frames} frames ({spool.repeats()} repeated), {spool.duration:.1f} s "
+          f"at {spool.fps} FPS, {width}x{height} {spool.pix_fmt}, "
+          f"audio: {'yes' if spool.audio_path() else 'no'}")
+    if 'frames' not in spool.info:
+        print("The recording did not finish, the spool ends at its last whole frame")
+    spool.close()
+    if args.output is None and args.start is None and args.end is None:
+        return 0
+
+    engine = RecorderEngine(on_status=lambda message: print(message, flush=True))
+    engine.configure(quality=args.quality)
+    try:
+        output = engine.encode_spool(args.spool, args.output, args.start or 0.0, args.end)
+    except ValueError as e:
+        print(f"Invalid range: {e}", file=sys.stderr)
+        return 2
+    if not wait_for_jobs(engine):
+        return 1
+    return 0 if os.path.exists(output) else 1
+
+
+def jobs_from_cli(args):
+    """List, retry, cancel or run the persisted finalize jobs"""
+    engine = RecorderEngine(on_status=lambda message: print(message, flush=True))
+    engine.configure(finalize_workers=args.workers)
+    for job_id in args.retry:
+        engine.jobs.retry(job_id)
+    for job_id in args.cancel:
+        engine.jobs.cancel(job_id)
+    if args.run:
+        engine.jobs.start()
+        if not wait_for_jobs(engine):
+            return 1
+    for job in engine.jobs.jobs():
+        line = f"{job['id']}  {job['state']:<9}  {job['progress']:4.0%}  {job['label']}"
+        if job['error']:
+            line += f"  ({job['error'].splitlines()[-1]})"
+        print(line)
+    return 0 if not any(job['state'] == 'failed' for job in engine.jobs.jobs()) else 1
+
+
+def region_argument(text):
+    """argparse type for --region"""
+    try:
+        return parse_region(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def build_arg_parser():
+    """Command line interface; without a subcommand the GUI is started"""
+    parser = argparse.ArgumentParser(description="Screen & Audio Recorder")
+    subparsers = parser.add_subparsers(dest='command')
+
+    record = subparsers.add_parser('record', help="record without a window")
+    record.add_argument('-d', '--duration', type=float, default=None,
+                        help="seconds to record (default: until Ctrl+C)")
+    record.add_argument('-o', '--output-dir', default=None)
+    record.add_argument('--mode', choices=RecorderEngine.MODES, default="screen_and_audio")
+    record.add_argument('--fps', type=int, default=30)
+    record.add_argument('--quality', type=int, default=95)
+    record.add_argument('--no-adaptive', action='store_true',
+                        help="keep FPS, scale and preset fixed under load")
+    record.add_argument('--backend', choices=["auto"] + list(CAPTURE_BACKENDS), default="auto")
+    record.add_argument('--region', type=region_argument, default=None, metavar='X,Y,W,H',
+                        help="record only this part of the desktop")
+    record.add_argument('--window', default=None, metavar='TITLE',
+                        help="record the window whose title contains TITLE")
+    record.add_argument('--monitors', nargs='+', default=None, metavar='N',
+                        help="monitor numbers to record, or all (see the monitors command)")
+    record.add_argument('--layout', choices=RecorderEngine.LAYOUTS, default="separate",
+                        help="several monitors: one file each, or composed side by side")
+    record.add_argument('--encode', choices=RecorderEngine.ENCODE_MODES, default="stream")
+    record.add_argument('--segment-seconds', type=int, default=10,
+                        help="segment length for --encode segments")
+    record.add_argument('--segment-keep', type=int, default=0,
+                        help="keep only the last N segments (default: all)")
+    record.add_argument('--replay-seconds', type=float, default=30,
+                        help="seconds kept by --encode replay; a clip is saved on SIGUSR1 "
+                             "and when the recording ends")
+    record.add_argument('--replay-memory', type=int, default=256, metavar='MB',
+                        help="memory limit of the replay buffer's video")
+    record.add_argument('--keep-spool', action='store_true',
+                        help="keep the raw frames of --encode spool after encoding them")
+    record.add_argument('--backpressure', choices=FrameRing.POLICIES, default="drop_oldest")
+    record.add_argument('--catch-up', choices=FrameScheduler.CATCH_UP, default="duplicate")
+    record.add_argument('--skip-static', action='store_true',
+                        help="skip unchanged frames (VFR output)")
+    record.add_argument('--no-audio', action='store_true')
+    record.add_argument('--audio-device', default=None, help="input device index or name")
+    record.add_argument('--audio-devices', nargs='+', default=None, metavar='DEVICE',
+                        help="record several input devices at once, e.g. a mic and a loopback")
+    record.add_argument('--audio-tracks', choices=MultiDeviceRecorder.TRACKS, default="mix",
+                        help="mix several devices into one track or keep one track each")
+    record.add_argument('--stats', action='store_true', help="print final stats as JSON")
+    record.add_argument('--metrics', nargs='?', const="json", choices=PipelineMetrics.FORMATS,
+                        help="time every stage and write a metrics file (default: json) "
+                             "next to the recording")
+    record.add_argument('--finalize-workers', type=int, default=1,
+                        help="finalize jobs to run at once")
+    record.add_argument('--finalize-chunks', type=int, default=0,
+                        help="parallel encoders for an avi capture (default: one per core)")
+    record.add_argument('--no-index', action='store_true',
+                        help="don't add the recording to the library or make thumbnails")
+
+    recover = subparsers.add_parser('recover', help="rebuild interrupted segmented recordings")
+    recover.add_argument('sessions', nargs='*',
+                         help="session directories (default: all in the output directory)")
+    recover.add_argument('-o', '--output-dir', default=None)
+
+    spool = subparsers.add_parser('spool', help="describe a frame spool or encode a range of it")
+    spool.add_argument('spool', help="a recording_*.spool directory")
+    spool.add_argument('--start', type=float, default=None, help="first second to encode")
+    spool.add_argument('--end', type=float, default=None, help="second to stop at")
+    spool.add_argument('-o', '--output', default=None,
+                       help="MP4 file (default: named after the recording and the range)")
+    spool.add_argument('--quality', type=int, default=95)
+
+    monitors = subparsers.add_parser('monitors', help="list the monitors that can be recorded")
+    monitors.add_argument('--backend', choices=["auto"] + list(CAPTURE_BACKENDS), default="auto")
+
+    library = subparsers.add_parser('library', help="list the recordings in the output directory")
+    library.add_argument('-o', '--output-dir', default=None)
+    library.add_argument('--search', default=None, help="only names containing this text")
+    library.add_argument('--limit', type=int, default=50)
+    library.add_argument('--offset', type=int, default=0)
+    library.add_argument('--thumbnails', action='store_true',
+                         help="wait until every thumbnail and contact sheet is made")
+
+    jobs = subparsers.add_parser('jobs', help="list, retry, cancel or run finalize jobs")
+    jobs.add_argument('--run', action='store_true', help="run the queued jobs and wait")
+    jobs.add_argument('--retry', action='append', default=[], metavar='JOB_ID')
+    jobs.add_argument('--cancel', action='append', default=[], metavar='JOB_ID')
+    jobs.add_argument('--workers', type=int, default=1, help="jobs to run at once")
+
+    bench = subparsers.add_parser('bench', help="run a benchmark")
+    benchmarks = bench.add_subparsers(dest='benchmark', required=True)
+    startup = benchmarks.add_parser('startup', help="import time and time to first window")
+    startup.add_argument('--runs', type=int, default=5)
+    add_baseline_arguments(startup)
+    convert = benchmarks.add_parser('convert', help="color conversion cost per frame")
+    convert.add_argument('--sizes', nargs='+', default=["1920x1080", "3840x2160"])
+    convert.add_argument('--frames', type=int, default=100)
+    add_baseline_arguments(convert)
+    transcode = benchmarks.add_parser('transcode',
+                                      help="single vs. chunked finalizing of a raw capture")
+    transcode.add_argument('--minutes', type=float, nargs='+', default=[10, 30, 60])
+    transcode.add_argument('--size', default="1280x720")
+    transcode.add_argument('--loop-seconds', type=float, default=10,
+                           help="seconds of raw video written to disk and repeated (default: 10)")
+    transcode.add_argument('--fps', type=int, default=30)
+    transcode.add_argument('--chunks', type=int, default=0,
+                           help="parallel encoders (default: one per core)")
+    add_baseline_arguments(transcode)
+    audio = benchmarks.add_parser('audio', help="multi-device mixer with simulated devices")
+    audio.add_argument('--devices', type=int, nargs='+', default=[4, 8])
+    audio.add_argument('--rate', type=int, default=48000)
+    audio.add_argument('--seconds', type=float, default=20)
+    audio.add_argument('--drift', type=float, default=300,
+                       help="largest clock drift of a device in ppm (default: 300)")
+    add_baseline_arguments(audio)
+    spool = benchmarks.add_parser('spool', help="frame spool vs. raw AVI writes, random reads")
+    spool.add_argument('--sizes', nargs='+', default=["1920x1080", "3840x2160"])
+    spool.add_argument('--frames', type=int, default=90)
+    spool.add_argument('--fps', type=int, default=30)
+    spool.add_argument('--reads', type=int, default=100, help="random frames read back")
+    spool.add_argument('--dir', default=None,
+                       help="where to write the frames (default: the temp directory)")
+    add_baseline_arguments(spool)
+    record = benchmarks.add_parser('record', help="whole recordings of a synthetic screen")
+    record.add_argument('--sizes', nargs='+', default=['1280x720', '1920x1080', '3840x2160'])
+    record.add_argument('--patterns', nargs='+', choices=SyntheticCapture.PATTERNS,
+                        default=['static', 'text', 'noise'])
+    record.add_argument('--seconds', type=float, default=10)
+    record.add_argument('--fps', type=int, default=30)
+    record.add_argument('--encode', choices=("stream", "avi", "segments", "spool"),
+                        default="stream")
+    record.add_argument('--no-audio', action='store_true', help="record the screen only")
+    add_baseline_arguments(record)
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.command == 'record':
+        return record_from_cli(args)
+    if args.command == 'recover':
+        return recover_from_cli(args)
+    if args.command == 'spool':
+        return spool_from_cli(args)
+    if args.command == 'jobs':
+        return jobs_from_cli(args)
+    if args.command == 'monitors':
+        return monitors_from_cli(args)
+    if args.command == 'library':
+        return library_from_cli(args)
+    if args.command == 'bench':
+        return {'startup': bench_startup, 'convert': bench_convert,
+                'transcode': bench_transcode, 'audio': bench_audio,
+                'spool': bench_spool, 'record': bench_record}[args.benchmark](args)
+
+    return run_gui()
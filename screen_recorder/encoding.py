@@ -0,0 +1,248 @@
+"""FFmpeg encoder processes and the raw video writers"""
+import tempfile
+import shutil
+import subprocess
+
+
+def decimate_args(fps):
+    """FFmpeg output options that turn exact repeated frames into VFR timestamps
+
+    At least one frame per second is kept so a trailing idle stretch still
+    ends within a second of the real recording length.
+    """
+    return [
+        '-vf', f'mpdecimate=hi=0:lo=0:frac=0:max={max(1, int(fps))}',
+        '-fps_mode', 'vfr',
+    ]
+
+
+def quality_encoder_settings(quality):
+    """x264 (crf, preset) for the 1-100 Quality setting
+
+    The default Quality of 95 keeps x264's default CRF 23; below it every
+    8 points add one, above it every point takes one off, down to 18.
+    """
+    quality = min(100, max(1, int(quality)))
+    if quality >= 95:
+        crf = 23 - (quality - 95)
+    else:
+        crf = round(23 + (95 - quality) * 12 / 94)
+    return crf, 'veryfast' if quality >= 50 else 'superfast'
+
+
+# FFmpeg rawvideo pixel formats and the matching convert_color names
+FFMPEG_PIXEL_FORMATS = {'bgr24': "BGR", 'yuv420p': "I420"}
+
+
+MATROSKA_FOURCC = {'bgr24': b'BGR\x18', 'yuv420p': b'I420'}
+
+
+MATROSKA_UNKNOWN_SIZE = b'\x01\xff\xff\xff\xff\xff\xff\xff'  # A live stream's Segment/Cluster
+
+
+def ebml_size(size):
+    """EBML variable-length integer holding an element's payload size"""
+    length = 1
+    while size >= (1 << (7 * length)) - 1:
+        length += 1
+    return (size | (1 << (7 * length))).to_bytes(length, 'big')
+
+
+def ebml_element(element_id, payload):
+    """One EBML element; integers are stored big-endian in as few bytes as needed"""
+    if isinstance(payload, int):
+        payload = payload.to_bytes(max(1, (payload.bit_length() + 7) // 8), 'big')
+    elif isinstance(payload, str):
+        payload = payload.encode()
+    return element_id + ebml_size(len(payload)) + payload
+
+
+def matroska_header(frame_size, pix_fmt):
+    """Start of a live Matroska stream of raw frames with microsecond timestamps
+
+    Raw frames on a pipe carry no time, FFmpeg numbers them at a fixed
+    rate. Wrapped in Matroska every frame brings its own timestamp; see
+    matroska_frame_header().
+    """
+    width, height = frame_size
+    video = (ebml_element(b'\xb0', width) + ebml_element(b'\xba', height) +
+             ebml_element(b'\x2e\xb5\x24', MATROSKA_FOURCC[pix_fmt]))
+    track = (ebml_element(b'\xd7', 1) + ebml_element(b'\x73\xc5', 1) +
+             ebml_element(b'\x83', 1) + ebml_element(b'\x86', 'V_UNCOMPRESSED') +
+             ebml_element(b'\xe0', video))
+    ebml = (ebml_element(b'\x42\x82', 'matroska') + ebml_element(b'\x42\x87', 4) +
+            ebml_element(b'\x42\x85', 2))
+    return (ebml_element(b'\x1a\x45\xdf\xa3', ebml) +
+            b'\x18\x53\x80\x67' + MATROSKA_UNKNOWN_SIZE +
+            ebml_element(b'\x15\x49\xa9\x66', ebml_element(b'\x2a\xd7\xb1', 1000)) +
+            ebml_element(b'\x16\x54\xae\x6b', ebml_element(b'\xae', track)))
+
+
+def matroska_frame_header(timestamp_us, frame_bytes):
+    """Cluster and SimpleBlock header written in front of a frame's pixels
+
+    Every frame gets a cluster of its own, so the timestamp is absolute
+    and the block's 16-bit relative time is always 0.
+    """
+    return (b'\x1f\x43\xb6\x75' + MATROSKA_UNKNOWN_SIZE +
+            ebml_element(b'\xe7', timestamp_us) +
+            b'\xa3' + ebml_size(4 + frame_bytes) + b'\x81\x00\x00\x80')
+
+
+class FFmpegStreamWriter:
+    """Encode raw frames on the fly by piping them into a long-lived FFmpeg process
+
+    Mirrors the small part of the cv2.VideoWriter interface the recorder uses
+    (write/isOpened/release) so either writer can be used by the capture loop.
+    pixel_format tells the pipeline what to hand over; planar I420 is what
+    the encoder works in, so FFmpeg does no conversion of its own. With
+    vfr=True every frame is written with the capture tick it shows and
+    ticks without a frame are simply left out, see CapturePipeline.
+    """
+
+    STDOUT = subprocess.DEVNULL  # Subclasses that read the encoded stream pipe it
+
+    def __init__(self, output_path, fps, frame_size, pix_fmt='yuv420p',
+                 preset='veryfast', crf=23, decimate=False, vfr=False, audio_input=None):
+        self.output_path = output_path
+        self.fps = fps
+        self.frame_size = frame_size
+        self.pixel_format = FFMPEG_PIXEL_FORMATS[pix_fmt]
+        self.preset = preset
+        self.crf = crf
+        self.vfr = vfr
+        self.error = None
+        self._stderr = tempfile.TemporaryFile()
+
+        width, height = frame_size
+        ffmpeg_cmd = ['ffmpeg', '-y', '-loglevel', 'error']
+        if vfr:
+            ffmpeg_cmd.extend(['-f', 'matroska', '-i', '-'])
+        else:
+            ffmpeg_cmd.extend([
+                '-f', 'rawvideo',
+                '-pix_fmt', pix_fmt,
+                '-s', f'{width}x{height}',
+                '-framerate', str(fps),
+                '-i', '-',
+            ])
+        if audio_input:
+            # Raw float32 samples, e.g. from a FIFO fed by a RawAudioSink.
+            # Raw PCM needs no probing, which would otherwise wait for
+            # seconds of live audio before encoding starts
+            ffmpeg_cmd.extend([
+                '-probesize', '32',
+                '-analyzeduration', '0',
+                '-f', 'f32le',
+                '-ar', str(audio_input['sample_rate']),
+                '-ac', str(audio_input['channels']),
+                '-thread_queue_size', '1024',
+                '-i', audio_input['path'],
+            ])
+        if decimate:
+            # Repeated frames are signalled by writing the same frame again;
+            # drop them here so the output becomes variable frame rate
+            ffmpeg_cmd.extend(decimate_args(fps))
+        elif vfr:
+            ffmpeg_cmd.extend(['-fps_mode', 'vfr'])
+        ffmpeg_cmd.extend(self._codec_args())
+        if audio_input:
+            ffmpeg_cmd.extend(['-c:a', 'aac', '-b:a', '128k'])
+        ffmpeg_cmd.extend(self._output_args(output_path))
+
+        try:
+            # Unbuffered stdin so frames go straight from the NumPy buffer to the pipe
+            self.process = subprocess.Popen(
+                ffmpeg_cmd,
+                stdin=subprocess.PIPE,
+                stdout=self.STDOUT,
+                stderr=self._stderr,
+                bufsize=0
+            )
+        except OSError as e:
+            self.process = None
+            self.error = str(e)
+        if vfr and self.process is not None:
+            try:
+                self._send(matroska_header(frame_size, pix_fmt))
+            except OSError:
+                pass  # Reported by the first write()
+
+    def _codec_args(self):
+        """Video encoder options of the encoder command"""
+        return ['-c:v', 'libx264', '-preset', self.preset, '-pix_fmt', 'yuv420p',
+                '-crf', str(self.crf)]
+
+    def _output_args(self, output_path):
+        """Muxer options and output file(s) of the encoder command"""
+        return [output_path]
+
+    @staticmethod
+    def is_available():
+        """Check whether an FFmpeg executable can be found"""
+        return shutil.which('ffmpeg') is not None
+
+    def isOpened(self):
+        """Check whether the encoder process is running"""
+        return self.process is not None and self.process.poll() is None
+
+    def write(self, frame, tick=None):
+        """Send one frame to the encoder straight from its buffer
+
+        With vfr, tick is the capture tick the frame shows.
+        """
+        view = memoryview(frame).cast('B')
+        try:
+            if self.vfr:
+                self._send(matroska_frame_header(round(tick * 1_000_000 / self.fps),
+                                                 view.nbytes))
+            self._send(view)
+        except (BrokenPipeError, OSError):
+            raise Exception(f"FFmpeg encoder stopped: {self._read_stderr()}")
+
+    def _send(self, data):
+        """Write all of data; a raw pipe may take less at once"""
+        view = memoryview(data)
+        while view:
+            view = view[self.process.stdin.write(view):]
+
+    def close_input(self):
+        """End the video stream without waiting for the encoder"""
+        if self.process is not None and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+    def release(self):
+        """Close the pipe and wait for the encoder to finish the file"""
+        if self.process is None:
+            return False
+        self.close_input()
+        returncode = self.process.wait()
+        if returncode != 0:
+            self.error = self._read_stderr() or f"FFmpeg exited with code {returncode}"
+        self._stderr.close()
+        self.process = None
+        return returncode == 0
+
+    def _read_stderr(self):
+        """Return whatever FFmpeg has logged so far"""
+        try:
+            self._stderr.seek(0)
+            return self._stderr.read().decode(errors='replace').strip()
+        except (OSError, ValueError):
+            return ""
+
+
+class RawVideoWriter(FFmpegStreamWriter):
+    """Store the piped frames uncompressed, e.g. I420 in an AVI file
+
+    With vfr=True the output needs a container with timestamps, e.g. Matroska.
+    """
+
+    def __init__(self, output_path, fps, frame_size, pix_fmt='yuv420p', vfr=False):
+        super().__init__(output_path, fps, frame_size, pix_fmt=pix_fmt, vfr=vfr)
+
+    def _codec_args(self):
+        return ['-c:v', 'rawvideo']
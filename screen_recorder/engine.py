@@ -0,0 +1,1175 @@
+"""RecorderEngine, the headless recorder the GUI and the CLI drive"""
+import tempfile
+import time
+import sys
+from pathlib import Path
+from datetime import datetime
+import threading
+import os
+import shutil
+
+from .lazy import LazyModule
+from .session import (SegmentedStreamWriter, SESSION_SUFFIX, read_segment_list, write_session_info,
+                      find_interrupted_sessions, join_segments_command)
+from .encoding import quality_encoder_settings, FFmpegStreamWriter, RawVideoWriter
+from .capture import (clip_region, even_frame_size, ProcessCapture, CAPTURE_BACKENDS,
+                      create_capture_backend)
+from .pipeline import (FrameRing, ChangeDetector, FrameScheduler, PipelineMetrics, PreviewTap,
+                       CapturePipeline, RateController)
+from .audio import RawAudioSink, ChunkedAudioSink, AudioRecorder, MultiDeviceRecorder
+from .replay import ReplayStreamWriter, save_replay_clip, ReplayAudioSink
+from .jobs import FinalizeQueue, finalize_stages
+from .spool import SPOOL_SUFFIX, FrameSpool
+from .library import RecordingLibrary
+
+cv2 = LazyModule('cv2', 'cv2', globals())
+sf = LazyModule('soundfile', 'sf', globals())
+
+
+class RecorderEngine:
+    """Headless recording engine: capture, encode, audio and finalization
+
+    Used directly by the command line and as the backend of the Tk GUI. It
+    never imports Tk; progress and errors are reported through the
+    on_status(message) and on_error(title, message) callbacks, which are
+    called from the recording thread. capture_factory() and
+    audio_stream_factory stand in for the screen and the sound card, e.g.
+    with SyntheticCapture and SyntheticAudioStream; jobs_dir keeps the
+    finalize jobs apart from those of other engines.
+    """
+
+    MODES = ("screen_and_audio", "audio_only")
+    ENCODE_MODES = ("stream", "avi", "segments", "replay", "spool")
+    LAYOUTS = ("separate", "compose")  # Several monitors: one file each, or side by side
+    MIN_CHUNK_SECONDS = 10  # Shorter chunks cost more in process start-up than they gain
+
+    def __init__(self, on_status=None, on_error=None, jobs_dir=None, capture_factory=None,
+                 audio_stream_factory=None):
+        self.on_status = on_status or (lambda message: None)
+        self.on_error = on_error or self._print_error
+        self.capture_factory = capture_factory
+        self.audio_stream_factory = audio_stream_factory
+
+        # Recording state
+        self.is_recording = False
+        self.state = "idle"  # idle, recording, processing
+        self.message = "Ready to record"
+        self.last_output = None
+        self.frame_pipeline = None
+        self.audio_recorder = None
+        self.recording_thread = None
+        self.preview_tap = PreviewTap()
+        self._last_stats = {}
+        self._metrics = None  # PipelineMetrics of the current or last recording
+        self._pending_metrics = {}  # Output -> metrics written once its job is done
+
+        # Default settings
+        self.output_dir = self._get_default_output_dir()
+        self.mode = "screen_and_audio"
+        self.metrics = False  # Time every stage, see stats()['metrics'] and metrics_format
+        self.metrics_format = "json"  # File written next to each recording, see PipelineMetrics
+        self.fps = 30
+        self.quality = 95
+        self.adaptive = True  # Lower FPS, scale and preset while the machine can't keep up
+        self.encode_mode = "stream"  # "stream" encodes while recording, "avi" writes raw I420 first,
+                                     # "segments" writes crash-safe chunks into a session directory,
+                                     # "spool" writes raw I420 into a FrameSpool next to the output
+        self.keep_spool = False  # Keep the spool once it is encoded, see encode_spool()
+        self.segment_seconds = 10
+        self.segment_keep = 0  # Keep only the last N segments, 0 keeps all
+        self.replay_seconds = 30  # "replay" keeps this much in memory for save_replay()
+        self.replay_memory_mb = 256  # Upper bound of the replay buffer's encoded video
+        self.session_dir = None  # Session directory of the running segmented recording
+        self._replay = None  # (ReplayStreamWriter, ReplayAudioSink or None) while it runs
+        self.backpressure = "drop_oldest"  # FrameRing policy: drop_oldest, drop_newest or block
+        self.ring_slots = 6
+        self.skip_static = False  # Don't encode unchanged frames, output becomes VFR
+        self.catch_up = "duplicate"  # Missed ticks: "duplicate" (CFR) or "drop" (VFR)
+        self.capture_backend = "auto"  # Name from CAPTURE_BACKENDS, or "auto"
+        self.auto_capture_backend = None  # Winner of the capture benchmark
+        self.capture_error = None  # Why the benchmark found no backend for "auto"
+        self.region = None  # (left, top, width, height) to capture, None for the whole screen
+        self.window = None  # Record the window with this title, following it as it moves
+        self.monitors = None  # Monitor numbers from 1 to record, or "all"
+        self.layout = "separate"  # How several monitors are saved, see LAYOUTS
+        self.audio_enabled = False
+        self.audio_device = None  # sounddevice device index or name, None for the default
+        self.audio_devices = None  # Several devices to record at once, e.g. a mic and a loopback
+        self.audio_tracks = "mix"  # Several devices: "mix" or "separate" tracks
+        self.channels = 2
+        self.sample_rate = 44100
+        self.available_devices = []
+        self._audio_probed = False
+        self._audio_probe_lock = threading.Lock()
+
+        # Finalization (mux, transcode, joining segments) runs as queued jobs,
+        # so a new recording can start while the last one is still processed
+        self.finalize_workers = 1
+        self.finalize_chunks = 0  # Parallel encoders for a raw capture, 0 = one per core
+        self.index_recordings = True  # Add finished recordings to the RecordingLibrary
+        self._libraries = {}  # Directory -> RecordingLibrary
+        self._library_lock = threading.Lock()
+        self.jobs = FinalizeQueue(jobs_dir or Path(tempfile.gettempdir()) / "screen_recorder_jobs",
+                                  workers=self.finalize_workers, on_update=self._on_job_update)
+
+    # Settings that configure() accepts, grouped by pipeline stage
+    SETTINGS = {
+        'output': ('output_dir', 'mode', 'metrics', 'metrics_format'),
+        'capture': ('capture_backend', 'fps', 'catch_up', 'skip_static',
+                    'region', 'window', 'monitors', 'layout'),
+        'pipeline': ('backpressure', 'ring_slots'),
+        'encode': ('encode_mode', 'quality', 'adaptive', 'segment_seconds', 'segment_keep',
+                   'replay_seconds', 'replay_memory_mb', 'keep_spool'),
+        'audio': ('audio_enabled', 'audio_device', 'audio_devices', 'audio_tracks',
+                  'channels', 'sample_rate'),
+        'finalize': ('finalize_workers', 'finalize_chunks', 'index_recordings'),
+    }
+
+    @staticmethod
+    def _print_error(title, message):
+        print(f"{title}: {message}", file=sys.stderr)
+
+    def _get_default_output_dir(self):
+        """Get or create default output directory"""
+        default_dirs = [
+            str(Path.home() / "Videos"),
+            str(Path.home() / "Documents" / "Recordings"),
+            str(Path.home() / "Recordings"),
+            str(Path.home())
+        ]
+        
+        # Try to find or create a suitable directory
+        for dir_path in default_dirs:
+            try:
+                path = Path(dir_path)
+                if not path.exists():
+                    path.mkdir(parents=True)
+                if os.access(dir_path, os.W_OK):
+                    return str(path)
+            except Exception:
+                continue
+                
+        # If no suitable directory found, use temp directory
+        return tempfile.gettempdir()
+
+    def setup_audio(self, refresh=False):
+        """Query the input devices; disables audio if there is none
+
+        The result is cached, so only the first call pays for loading
+        PortAudio and enumerating devices. refresh=True rescans them.
+        """
+        with self._audio_probe_lock:
+            if self._audio_probed and not refresh:
+                return self.audio_enabled
+            if refresh and self.is_recording:
+                raise RuntimeError("Cannot rescan audio devices while recording")
+            try:
+                import sounddevice as sd
+                if refresh and self._audio_probed:
+                    # PortAudio only enumerates devices when it is initialized
+                    sd._terminate()
+                    sd._initialize()
+                self.available_devices = sd.query_devices()
+                device_info = sd.query_devices(kind='input')
+                if device_info is not None:
+                    self.channels = min(device_info['max_input_channels'], 2)
+                    self.sample_rate = int(device_info['default_samplerate'])
+                    self.audio_enabled = True
+                else:
+                    self.audio_enabled = False
+            except Exception:
+                self.audio_enabled = False
+            self._audio_probed = True
+            return self.audio_enabled
+
+    def input_devices(self):
+        """Names of the cached input devices"""
+        return [device['name'] for device in self.available_devices
+                if device['max_input_channels'] > 0]
+
+    def probe_capture_backends(self):
+        """Benchmark the capture backends and remember the fastest for "auto"
+
+        Returns its name, or None after reporting through on_error that no
+        backend can grab the screen; "auto" then fails until probed again.
+        """
+        try:
+            self.auto_capture_backend = create_capture_backend("auto").name
+            self.capture_error = None
+        except Exception as e:
+            self.auto_capture_backend = None
+            self.capture_error = str(e)
+            self.on_error("Capture Error", self.capture_error)
+        return self.auto_capture_backend
+
+    def create_capture_backend(self, name=None):
+        """Create the configured capture backend, reusing the benchmark for auto"""
+        if self.capture_factory is not None:
+            return self.capture_factory()
+        name = name or self.capture_backend
+        if name == "auto" and self.auto_capture_backend:
+            name = self.auto_capture_backend
+        elif name == "auto" and self.capture_error:
+            raise RuntimeError(self.capture_error)
+        return create_capture_backend(name)
+
+    def _capture_sources(self):
+        """Capture backends for the configured area, one per recorded source
+
+        A region, a window or a list of monitors narrows the backend's
+        default area. Several sources each capture in their own process.
+        """
+        backend = self.create_capture_backend()
+        if self.window:
+            region = backend.find_window(self.window)
+            if region is not None:
+                backend.frame_size()
+                region = clip_region(region, backend.bounds)
+            if region is None:
+                raise Exception(f"No visible window titled '{self.window}'")
+            regions = [region]
+        elif self.monitors:
+            monitors = backend.monitors()
+            numbers = (range(1, len(monitors) + 1) if self.monitors == "all"
+                       else [int(number) for number in self.monitors])
+            for number in numbers:
+                if number > len(monitors):
+                    raise ValueError(f"There is no monitor {number}, found {len(monitors)}")
+            regions = [monitors[number - 1] for number in numbers]
+        elif self.region:
+            regions = [tuple(int(value) for value in self.region)]
+        else:
+            return [backend]
+        sources = [backend.with_region(region) for region in regions]
+        if len(sources) == 1:
+            return sources
+        return [ProcessCapture(source) for source in sources]
+
+    def _follow_window(self, source):
+        """Move the capture region to where the recorded window is now"""
+        region = source.find_window(self.window)
+        if region is not None and region[:2] != source.region[:2]:
+            source.move(*region[:2])
+
+    def configure(self, **settings):
+        """Update settings; names are listed per stage in SETTINGS"""
+        known = {name for names in self.SETTINGS.values() for name in names}
+        for name, value in settings.items():
+            if name not in known:
+                raise ValueError(f"Unknown setting: {name}")
+            setattr(self, name, value)
+        if 'finalize_workers' in settings:
+            self.jobs.set_workers(int(self.finalize_workers))
+
+    def settings(self):
+        """Current settings grouped by stage"""
+        return {stage: {name: getattr(self, name) for name in names}
+                for stage, names in self.SETTINGS.items()}
+
+    def validate(self):
+        """Check the settings before recording, raising ValueError"""
+        # Validate output directory
+        if not self.output_dir:
+            raise ValueError("Output directory not specified")
+        
+        # Create directory if it doesn't exist
+        Path(self.output_dir).mkdir(parents=True, exist_ok=True)
+        
+        # Check write permissions
+        if not os.access(self.output_dir, os.W_OK):
+            raise ValueError("Output directory is not writable")
+
+        if self.mode not in self.MODES:
+            raise ValueError(f"Unknown recording mode: {self.mode}")
+        if self.metrics_format not in PipelineMetrics.FORMATS:
+            raise ValueError(f"Unknown metrics format: {self.metrics_format}")
+        
+        # Validate FPS if screen recording
+        if self.mode == "screen_and_audio":
+            if not 1 <= int(self.fps) <= 60:
+                raise ValueError("FPS must be between 1 and 60")
+            if not 1 <= int(self.quality) <= 100:
+                raise ValueError("Quality must be between 1 and 100")
+            if self.encode_mode not in self.ENCODE_MODES:
+                raise ValueError(f"Unknown encoding mode: {self.encode_mode}")
+            if self.encode_mode == "segments":
+                if not FFmpegStreamWriter.is_available():
+                    raise ValueError("Segmented recording needs FFmpeg")
+                if int(self.segment_seconds) < 1:
+                    raise ValueError("Segment length must be at least 1 second")
+                if int(self.segment_keep) < 0:
+                    raise ValueError("Number of segments to keep cannot be negative")
+            if self.encode_mode == "replay":
+                if not FFmpegStreamWriter.is_available():
+                    raise ValueError("The replay buffer needs FFmpeg")
+                if float(self.replay_seconds) < 1:
+                    raise ValueError("The replay buffer must hold at least 1 second")
+                if int(self.replay_memory_mb) < 1:
+                    raise ValueError("The replay buffer needs at least 1 MB")
+            if self.backpressure not in FrameRing.POLICIES:
+                raise ValueError(f"Unknown backpressure policy: {self.backpressure}")
+            if self.catch_up not in FrameScheduler.CATCH_UP:
+                raise ValueError(f"Unknown catch-up policy: {self.catch_up}")
+            if self.capture_backend != "auto" and self.capture_backend not in CAPTURE_BACKENDS:
+                raise ValueError(f"Unknown capture backend: {self.capture_backend}")
+            if sum(1 for area in (self.region, self.window, self.monitors) if area) > 1:
+                raise ValueError("Choose only one of region, window and monitors")
+            if self.region and (len(self.region) != 4 or
+                                int(self.region[2]) < 1 or int(self.region[3]) < 1):
+                raise ValueError("Region must be left, top, width, height with a positive size")
+            if self.monitors and self.monitors != "all":
+                if any(int(number) < 1 for number in self.monitors):
+                    raise ValueError("Monitors are numbered from 1")
+                if self.encode_mode in ("segments", "replay", "spool") and len(self.monitors) > 1:
+                    raise ValueError(f"The {self.encode_mode} mode captures a single monitor")
+            if self.layout not in self.LAYOUTS:
+                raise ValueError(f"Unknown monitor layout: {self.layout}")
+        elif not self.audio_enabled:
+            raise ValueError("Audio only mode needs an audio input device")
+        if self.audio_tracks not in MultiDeviceRecorder.TRACKS:
+            raise ValueError(f"Unknown audio track layout: {self.audio_tracks}")
+        if (self._audio_track_count() > 1 and self.mode == "screen_and_audio" and
+                self.encode_mode in ("segments", "replay")):
+            raise ValueError(f"Separate audio tracks are not supported in {self.encode_mode} mode")
+        if int(self.finalize_workers) < 1:
+            raise ValueError("At least one finalize worker is needed")
+        if int(self.finalize_chunks) < 0:
+            raise ValueError("Number of finalize chunks cannot be negative")
+
+    def start(self):
+        """Start recording in the background"""
+        if self.is_recording or self.state == "processing":
+            raise RuntimeError("A recording is already in progress")
+        self.validate()
+        self.fps = int(self.fps)
+        self.quality = int(self.quality)
+        self.segment_seconds = int(self.segment_seconds)
+        self.segment_keep = int(self.segment_keep)
+
+        self.is_recording = True
+        self.state = "recording"
+        self.last_output = None
+        self._last_stats = {}
+        self._metrics = PipelineMetrics() if self.metrics else None
+        self.session_dir = None
+        if self.mode == "screen_and_audio":
+            target = self._record_screen_and_audio
+        else:
+            target = self._record_audio_only
+        self.recording_thread = threading.Thread(target=self._run_recording, args=(target,))
+        self.recording_thread.daemon = True
+        self.recording_thread.start()
+
+    def stop(self, wait=False, timeout=None):
+        """Stop recording; with wait=True also wait for finalization"""
+        if self.is_recording:
+            self.is_recording = False
+            self._set_status("Processing recording...")
+        if wait:
+            self.wait(timeout)
+
+    def wait(self, timeout=None):
+        """Block until the recording thread has finished"""
+        if self.recording_thread is not None:
+            self.recording_thread.join(timeout)
+        return self.state == "idle"
+
+    def status(self):
+        """Current state, last status message and last output file"""
+        return {
+            'state': self.state,
+            'recording': self.is_recording,
+            'message': self.message,
+            'output': self.last_output,
+            'jobs': self.jobs.jobs(),
+        }
+
+    def stats(self):
+        """Live counters of the running pipeline and audio recorder
+
+        After a recording has finished, the final counters are returned.
+        With metrics enabled, 'metrics' holds the stage latencies and the
+        latest gauges, see PipelineMetrics.
+        """
+        stats = dict(self._last_stats)
+        if self._metrics is not None:
+            stats['metrics'] = self._metrics.snapshot()
+        if self.frame_pipeline is not None:
+            stats['video'] = self.frame_pipeline.stats()
+        replay = self._replay
+        if replay is not None:
+            stats['replay'] = replay[0].buffer.stats()
+        if self.audio_recorder is not None:
+            stats['audio'] = self.audio_recorder.stats()
+        return stats
+
+    def interrupted_sessions(self):
+        """Session directories of segmented recordings that were never finished"""
+        owned = self.jobs.owned_paths()
+        return [path for path in find_interrupted_sessions(self.output_dir)
+                if path != self.session_dir and path not in owned]
+
+    def recover_sessions(self, sessions=None):
+        """Queue jobs rebuilding interrupted sessions from their segments, returns the job ids"""
+        job_ids = []
+        for session_dir in sessions if sessions is not None else self.interrupted_sessions():
+            try:
+                job_ids.append(self._submit_join(session_dir, message="recovered"))
+            except Exception as e:
+                self.on_error("Recovery Error", f"Could not recover {session_dir}: {str(e)}")
+        return job_ids
+
+    def encode_spool(self, directory, output=None, start=0.0, end=None):
+        """Queue a job encoding a FrameSpool from start to end seconds, returns the output path
+
+        The spool stays as it is, so any number of ranges can be cut from
+        it, including from one whose recording never finished. Without an
+        output the file is named after the recording and the range.
+        """
+        spool = FrameSpool.open(directory)
+        try:
+            first, count = spool.frame_range(start, end)
+            if output is None:
+                base = os.path.splitext(spool.info.get('output') or
+                                        spool.directory[:-len(SPOOL_SUFFIX)] + ".mp4")[0]
+                if first or count < spool.frames:
+                    base += f"_{first / spool.fps:.1f}-{(first + count) / spool.fps:.1f}"
+                output = f"{base}.mp4"
+            in_place = {'video': spool.frames_path}
+            audio = spool.audio_path()
+            if audio:
+                in_place['audio'] = audio
+            stages, files = finalize_stages(output, spool.fps, count,
+                                            audio=audio is not None,
+                                            av_sync=spool.info.get('av_sync'),
+                                            chunks=self._finalize_chunks(count),
+                                            tracks=spool.info.get('audio_tracks', 1),
+                                            track_channels=spool.info.get('channels', self.channels),
+                                            video_format=spool.input_args(),
+                                            start_frame=first,
+                                            **self._encoder_settings())
+        finally:
+            spool.close()
+        self.jobs.submit(os.path.basename(output), stages, output, in_place=in_place,
+                         files=files, duration=count / spool.fps, keep=in_place)
+        self.jobs.start()
+        return output
+
+    def library(self, directory=None):
+        """The started RecordingLibrary of a directory, by default the output directory"""
+        directory = os.path.abspath(directory or self.output_dir)
+        with self._library_lock:
+            library = self._libraries.get(directory)
+            if library is None:
+                # Through self, so a handler set later still gets the errors
+                library = self._libraries[directory] = RecordingLibrary(
+                    directory, on_error=lambda title, message: self.on_error(title, message))
+                library.start()
+        return library
+
+    def close_libraries(self, wait=False):
+        """Stop the libraries; with wait=True once their thumbnails are done"""
+        with self._library_lock:
+            libraries, self._libraries = list(self._libraries.values()), {}
+        for library in libraries:
+            library.close(wait=wait)
+
+    def cleanup(self):
+        """Stop any recording and the job workers, and remove temporary files
+
+        Unfinished jobs stay in the job directory and resume next time, as
+        do missing thumbnails.
+        """
+        if self.is_recording:
+            self.stop()
+            if self.recording_thread is not None:
+                self.recording_thread.join(timeout=2.0)
+        self.jobs.shutdown()
+        self.close_libraries()
+        
+        # Clean up temporary files
+        temp_dir = tempfile.gettempdir()
+        for file in os.listdir(temp_dir):
+            if file.startswith('screen_recorder_temp'):
+                try:
+                    os.remove(os.path.join(temp_dir, file))
+                except:
+                    pass
+
+    def _set_status(self, message):
+        self.message = message
+        self.on_status(message)
+
+    def _run_recording(self, target):
+        """Run a recording function and return to idle afterwards"""
+        try:
+            target()
+        finally:
+            self.is_recording = False
+            self.state = "idle"
+
+    def _record_screen_and_audio(self):
+        """Record both screen and audio
+
+        Every capture source gets its own pipeline and writer; several
+        sources share one tick grid so their frames line up.
+        """
+        outs = []
+        temp_videos = []
+        temp_audio = None
+        sources = []
+        pipelines = []
+        av_sync = None
+        streaming = False
+        parts = []
+        rate = None
+        replay_audio = None
+        try:
+            sources = self._capture_sources()
+            single = len(sources) == 1
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            final_output = str(Path(self.output_dir) / f"recording_{timestamp}.mp4")
+            streaming = self.encode_mode == "stream" and FFmpegStreamWriter.is_available()
+            # cleanup() sweeps everything with this prefix
+            temp_prefix = str(Path(tempfile.gettempdir()) / f"screen_recorder_temp_{timestamp}")
+
+            if self.encode_mode in ("segments", "replay", "spool") and not single:
+                raise Exception(f"The {self.encode_mode} mode captures a single monitor")
+            if self.encode_mode == "segments":
+                # Self-contained chunks next to the final output survive a crash
+                outs.append(self._open_session(timestamp, even_frame_size(sources[0].frame_size()),
+                                               final_output))
+            elif self.encode_mode == "replay":
+                # Encode into a bounded ring of GOPs, save_replay() writes it out
+                outs.append(ReplayStreamWriter(self.fps, even_frame_size(sources[0].frame_size()),
+                                               seconds=float(self.replay_seconds),
+                                               max_bytes=int(self.replay_memory_mb) << 20,
+                                               decimate=self.skip_static,
+                                               vfr=self.catch_up == "drop",
+                                               **self._encoder_settings()))
+            elif self.encode_mode == "spool":
+                # Raw frames next to the final output, readable up to the last one after a crash
+                spool_dir = Path(self.output_dir) / f"recording_{timestamp}{SPOOL_SUFFIX}"
+                outs.append(FrameSpool(str(spool_dir), self.fps,
+                                       even_frame_size(sources[0].frame_size())))
+                temp_videos.append(outs[0].frames_path)
+            else:
+                for number, source in enumerate(sources):
+                    suffix = f"_{number}" if number else ""
+                    out, temp_video = self._open_video_writer(f"{temp_prefix}_video{suffix}",
+                                                              source.frame_size(), streaming)
+                    outs.append(out)
+                    temp_videos.append(temp_video)
+                    if not out.isOpened():
+                        break
+                if streaming:
+                    parts.append(temp_videos[0])
+
+            if not all(out.isOpened() for out in outs):
+                raise Exception("Failed to create video writer")
+
+            # Start audio recording
+            if self.encode_mode == "replay":
+                if self.audio_enabled:
+                    # A clip may start up to a GOP before the requested window
+                    replay_audio = ReplayAudioSink(
+                        self.sample_rate, self.channels,
+                        float(self.replay_seconds) + 2 * ReplayStreamWriter.KEYFRAME_SECONDS)
+                    self._start_audio(None, sink=replay_audio)
+            elif self.encode_mode == "spool":
+                # Kept with the frames, so any range cut later has its audio
+                temp_audio = self._start_audio(os.path.join(outs[0].directory, 'audio.wav'))
+                if temp_audio:
+                    outs[0].save_info(audio='audio.wav', audio_tracks=self._audio_track_count(),
+                                      channels=self.channels)
+            elif self.session_dir is None:
+                temp_audio = self._start_audio(f"{temp_prefix}_audio.wav")
+
+            def reopen_writer(frame_size, preset):
+                # The rate controller changed scale or preset; the parts are
+                # joined and scaled back to full size when finalizing
+                parts.append(f"{temp_prefix}_video_{len(parts)}.mp4")
+                return FFmpegStreamWriter(parts[-1], self.fps, frame_size,
+                                          decimate=self.skip_static,
+                                          vfr=self.catch_up == "drop",
+                                          **self._encoder_settings(preset=preset))
+
+            start_ns = None
+            if not single:
+                # The worker processes start before tick 0 of the shared grid
+                for source in sources:
+                    source.open()
+                start_ns = time.monotonic_ns() + 100_000_000
+            for source, out in zip(sources, outs):
+                pipelines.append(CapturePipeline(
+                    source,
+                    out,
+                    self.fps,
+                    policy=self.backpressure,
+                    ring_slots=self.ring_slots,
+                    detector=ChangeDetector() if self.skip_static else None,
+                    preview=self.preview_tap if not pipelines else None,
+                    catch_up=self.catch_up,
+                    reopen_writer=reopen_writer if streaming and single else None,
+                    start_ns=start_ns,
+                    metrics=self._metrics
+                ))
+            self.frame_pipeline = pipelines[0]
+            if self.adaptive:
+                # Raw AVI has no encoder settings, the session encoder also
+                # carries the audio and several sources must keep one
+                # timeline, so there only the frame rate can change
+                knobs = RateController.KNOBS if streaming and single else ("stride",)
+                rate = RateController(self.fps, self.quality, knobs=knobs)
+            if temp_audio is None and self.audio_recorder is not None:
+                # Session and replay audio is cut to start exactly at video tick 0
+                pipeline = self.frame_pipeline
+                self.audio_recorder.align_to(lambda: pipeline.start_ns)
+            # Only every Nth frame is scaled for the ~10 FPS preview
+            self.preview_tap.every = max(1, round(self.fps / 10))
+            for pipeline in pipelines:
+                pipeline.start()
+            if self.encode_mode == "replay":
+                self._replay = (outs[0], replay_audio if self.audio_recorder is not None else None)
+
+            self._set_status("Recording started...")
+
+            last_update = time.monotonic()
+            while self.is_recording and all(pipeline.error is None for pipeline in pipelines):
+                time.sleep(0.1)
+                if self.is_recording and time.monotonic() - last_update >= 1.0:
+                    last_update = time.monotonic()
+                    if self.window:
+                        self._follow_window(sources[0])
+                    if rate is not None and rate.update(self._worst_load(pipelines)):
+                        for pipeline in pipelines:
+                            pipeline.set_rate(**rate.settings())
+                        self._set_status(f"Rate control: {rate.describe()} "
+                                         f"({rate.log[-1]['reason']})")
+                    if self._metrics is not None:
+                        self._sample_metrics(pipelines)
+                    stats = self.frame_pipeline.stats()
+                    self._set_status(f"Recording... Frames: {stats['written']} "
+                                     f"(skipped: {stats['skipped']}, dropped: {stats['dropped']})")
+
+            for pipeline in pipelines:
+                pipeline.stop()
+            for pipeline in pipelines:
+                if pipeline.error is not None:
+                    raise pipeline.error
+
+        except Exception as e:
+            self.on_error("Recording Error", f"Screen recording failed: {str(e)}")
+            self.is_recording = False
+            return
+
+        finally:
+            self.state = "processing"
+            self._replay = None
+            video_start_ns = None
+            source_stats = []
+            frame_size = None
+            for pipeline in pipelines:
+                pipeline.stop()
+            for source in sources:
+                source.close()
+            if self._metrics is not None and pipelines:
+                self._sample_metrics(pipelines)
+            if pipelines:
+                source_stats = [pipeline.stats() for pipeline in pipelines]
+                self._last_stats['video'] = source_stats[0]
+                if len(pipelines) > 1:
+                    self._last_stats['sources'] = source_stats
+                video_start_ns = self.frame_pipeline.start_ns
+                # The rate controller may have moved on to another writer
+                outs = [pipeline.writer for pipeline in pipelines]
+                parts = list(zip(parts, self.frame_pipeline.part_frames))
+                frame_size = self.frame_pipeline.out_size
+                self.frame_pipeline = None
+                self.preview_tap.every = 1
+            report = self._pipeline_report(source_stats[0]) if source_stats else None
+            if self.session_dir is not None and outs:
+                # The segment encoder reads the audio FIFO too and only
+                # finishes once both of its inputs have ended
+                outs[0].close_input()
+            audio_stats = self._stop_audio()
+            for out in outs:
+                out.release()
+            if audio_stats is not None:
+                av_sync = self._av_sync(video_start_ns, audio_stats['clock'])
+            if rate is not None:
+                self._last_stats['rate'] = rate.log
+            if self.encode_mode == "replay" and outs:
+                self._last_stats['replay'] = outs[0].buffer.stats()
+                if self._metrics is not None:
+                    # There is no recording, only the clips saved along the way
+                    self._write_metrics(str(Path(self.output_dir) / f"replay_{timestamp}.mp4"),
+                                        self._metrics, dict(self._last_stats),
+                                        self.metrics_format)
+                self._set_status("Replay buffer stopped")
+            elif self.session_dir is not None:
+                self._keep_metrics(final_output)
+                self._finish_session(report)
+            elif temp_videos and source_stats and all(
+                    os.path.exists(path) and os.path.getsize(path) > 0 for path in temp_videos):
+                merge = {
+                    'reencode_video': not streaming,
+                    'decimate': self.skip_static,
+                    'vfr': getattr(outs[0], 'vfr', False),
+                    'av_sync': av_sync,
+                    'audio_tracks': self._audio_track_count(),
+                }
+                if len(temp_videos) == 1:
+                    stats = source_stats[0]
+                    self._merge_audio_video(temp_videos[0], temp_audio, final_output,
+                                            report=report,
+                                            frames=self._timeline_frames(stats),
+                                            parts=parts if len(parts) > 1 else None,
+                                            frame_size=frame_size,
+                                            spool=outs[0] if self.encode_mode == "spool" else None,
+                                            **merge)
+                elif self.layout == "compose":
+                    # One picture laid out like the monitors on the desktop
+                    left = min(source.region[0] for source in sources)
+                    top = min(source.region[1] for source in sources)
+                    composite = [(path, (source.region[0] - left, source.region[1] - top))
+                                 for path, source in zip(temp_videos, sources)]
+                    self._merge_audio_video(temp_videos[0], temp_audio, final_output,
+                                            report=report,
+                                            frames=max(self._timeline_frames(stats)
+                                                       for stats in source_stats),
+                                            composite=composite, **merge)
+                else:
+                    self._merge_sources(temp_videos, temp_audio, final_output, source_stats,
+                                        **merge)
+            else:
+                self._set_status("Recording failed - no video data captured")
+
+    def save_replay(self, seconds=None):
+        """Save the last seconds of the running replay buffer, returns the file
+
+        The encoded GOPs and audio frames are only copied into an MP4 file,
+        which takes well under a second.
+        """
+        replay = self._replay
+        if replay is None:
+            raise RuntimeError("The replay buffer is not running")
+        writer, audio = replay
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output = Path(self.output_dir) / f"replay_{timestamp}.mp4"
+        number = 1
+        while output.exists():
+            number += 1
+            output = Path(self.output_dir) / f"replay_{timestamp}_{number}.mp4"
+        length = save_replay_clip(writer.buffer, audio, float(seconds or self.replay_seconds),
+                                  str(output))
+        self.last_output = str(output)
+        self._index_recording(str(output))
+        self._set_status(f"Replay saved to: {output} ({length:.1f} s)")
+        return str(output)
+
+    def _open_video_writer(self, temp_base, screen_size, streaming):
+        """Writer for one capture source and the temp file it writes to"""
+        if streaming:
+            # Encode while recording; only the compressed stream touches the disk
+            temp_video = f"{temp_base}.mp4"
+            out = FFmpegStreamWriter(temp_video, self.fps, even_frame_size(screen_size),
+                                     decimate=self.skip_static, vfr=self.catch_up == "drop",
+                                     **self._encoder_settings())
+        elif FFmpegStreamWriter.is_available():
+            # Uncompressed I420, stored as the pipeline converted it; with
+            # "drop" in Matroska, which keeps the tick of every frame
+            vfr = self.catch_up == "drop"
+            temp_video = f"{temp_base}.{'mkv' if vfr else 'avi'}"
+            out = RawVideoWriter(temp_video, self.fps, even_frame_size(screen_size), vfr=vfr)
+        else:
+            # Initialize video writer with uncompressed format
+            temp_video = f"{temp_base}.avi"
+            fourcc = cv2.VideoWriter_fourcc('I', '4', '2', '0')
+            out = cv2.VideoWriter(
+                temp_video,
+                fourcc,
+                self.fps,
+                screen_size,
+                isColor=True
+            )
+        return out, temp_video
+
+    def _merge_sources(self, temp_videos, temp_audio, final_output, source_stats, **merge):
+        """Queue one output file per capture source, each with a copy of the audio"""
+        base, ext = os.path.splitext(final_output)
+        for number, (temp_video, stats) in enumerate(zip(temp_videos, source_stats), 1):
+            audio = temp_audio
+            if temp_audio and number < len(temp_videos) and os.path.exists(temp_audio):
+                # Every job takes over its inputs, the last one gets the original
+                audio = f"{os.path.splitext(temp_audio)[0]}_{number}.wav"
+                shutil.copyfile(temp_audio, audio)
+            self._merge_audio_video(temp_video, audio, f"{base}_{number}{ext}",
+                                    report=self._pipeline_report(stats),
+                                    frames=self._timeline_frames(stats), **merge)
+
+    @staticmethod
+    def _timeline_frames(stats):
+        """Ticks a pipeline covered, also those a VFR writer left out"""
+        return stats['written'] + stats['repeated'] + stats['held']
+
+    @staticmethod
+    def _worst_load(pipelines):
+        """Highest load signals across the pipelines of all sources"""
+        loads = [pipeline.load() for pipeline in pipelines]
+        return {key: max(load[key] for load in loads) for key in loads[0]}
+
+    def _open_session(self, timestamp, screen_size, final_output):
+        """Create the session directory, start the audio and the segment encoder
+
+        With os.mkfifo the audio is fed through a FIFO into the segment
+        encoder, so every segment carries its own audio. Elsewhere it is
+        written as raw samples next to the segments, in chunks of one
+        segment length that segment_keep prunes along with the segments,
+        and added when they are joined. Either way it is cut to the video
+        timeline while recording (see AudioRecorder.align_to) and is not
+        drift corrected.
+        """
+        session_dir = Path(self.output_dir) / f"recording_{timestamp}{SESSION_SUFFIX}"
+        session_dir.mkdir()
+        self.session_dir = str(session_dir)
+        info = {
+            'output': final_output,
+            'fps': self.fps,
+            'size': list(screen_size),
+            'segment_seconds': self.segment_seconds,
+            'segment_keep': self.segment_keep,
+            'audio': None,
+        }
+
+        audio_input = None
+        sink = None
+        if self.audio_enabled:
+            in_band = hasattr(os, 'mkfifo')
+            audio_file = 'audio.fifo' if in_band else 'audio_%05d.f32'
+            audio_path = str(session_dir / audio_file)
+            if in_band:
+                os.mkfifo(audio_path)
+                sink = RawAudioSink(audio_path)
+            else:
+                sink = ChunkedAudioSink(audio_path, self.sample_rate, self.channels,
+                                        self.segment_seconds)
+                info['audio_chunk_seconds'] = self.segment_seconds
+            # Start the audio before FFmpeg so a failing device never leaves
+            # FFmpeg waiting on a FIFO nobody writes to
+            if self._start_audio(None, sink=sink):
+                info.update(audio='in_band' if in_band else 'sidecar', audio_file=audio_file,
+                            sample_rate=self.sample_rate, channels=self.channels)
+                if in_band:
+                    audio_input = {'path': audio_path, 'sample_rate': self.sample_rate,
+                                   'channels': self.channels}
+        write_session_info(self.session_dir, info)
+
+        return SegmentedStreamWriter(self.session_dir, self.fps, screen_size,
+                                     segment_seconds=self.segment_seconds,
+                                     keep=self.segment_keep,
+                                     on_prune=getattr(sink, 'drop_before', None),
+                                     decimate=self.skip_static,
+                                     vfr=self.catch_up == "drop",
+                                     audio_input=audio_input,
+                                     **self._encoder_settings())
+
+    def _finish_session(self, report):
+        """Join the segments into the final recording and remove the session"""
+        session_dir, self.session_dir = self.session_dir, None
+        if not read_segment_list(session_dir):
+            shutil.rmtree(session_dir, ignore_errors=True)
+            self._set_status("Recording failed - no video data captured")
+            return
+        try:
+            self._submit_join(session_dir, report)
+        except Exception as e:
+            self.on_error("Error", f"Failed to process recording: {str(e)}")
+            self._set_status(f"Segments kept in: {session_dir}")
+
+    def _submit_join(self, session_dir, message=None):
+        """Queue a job joining a session's segments; the job removes the session"""
+        ffmpeg_cmd, output_path, duration = join_segments_command(session_dir)
+        job_id = self.jobs.submit(os.path.basename(output_path),
+                                  [[{'command': ffmpeg_cmd, 'duration': duration}]], output_path,
+                                  in_place={'session': session_dir}, duration=duration,
+                                  message=message)
+        self.jobs.start()
+        return job_id
+
+    def _encoder_settings(self, preset=None):
+        """x264 preset and CRF for the Quality setting"""
+        crf, default = quality_encoder_settings(self.quality)
+        return {'preset': preset or default, 'crf': crf}
+
+    def _pipeline_report(self, stats):
+        """Short summary of achieved vs target FPS, jitter and skipped frames"""
+        report = (f"{stats['achieved_fps']:.1f}/{stats['target_fps']} FPS, "
+                  f"jitter {stats['jitter_std_ms']:.1f} ms (max {stats['jitter_max_ms']:.1f} ms)")
+        if stats['skipped']:
+            report += f", {stats['skipped']} unchanged frames skipped"
+        if stats['throttled']:
+            report += f", {stats['throttled']} frames throttled under load"
+        if stats['ticks_missed'] or stats['dropped']:
+            report += f", {stats['ticks_missed']} ticks missed, {stats['dropped']} frames dropped"
+        if stats['held']:
+            report += f", {stats['held']} ticks held over (VFR)"
+        return report
+    
+    def _av_sync(self, video_start_ns, audio_clock):
+        """Offset and tempo that put the audio on the video timeline
+
+        Both streams are stamped with time.monotonic_ns. The offset lines up
+        the first samples with tick 0; the tempo corrects the drift between
+        the sound card clock and the monotonic clock over long recordings.
+        """
+        if video_start_ns is None or audio_clock is None:
+            return None
+        audio_start_ns, measured_rate = audio_clock
+        sync = {'offset': (audio_start_ns - video_start_ns) / 1e9, 'tempo': 1.0}
+        if measured_rate:
+            ratio = measured_rate / self.sample_rate
+            if abs(ratio - 1.0) > 1e-5:
+                sync['tempo'] = ratio
+        return sync
+    
+    def _merge_audio_video(self, video_path, audio_path, final_output, reencode_video=True,
+                           decimate=False, av_sync=None, report=None, frames=0,
+                           parts=None, frame_size=None, composite=None, vfr=False,
+                           audio_tracks=1, spool=None):
+        """Queue a job that merges the audio and video files with FFmpeg
+
+        With reencode_video=False the video is already H.264 (streaming mode)
+        and is only copied into the final container. With decimate=True the
+        repeated frames of a raw capture are dropped during encoding (VFR);
+        with vfr=True the raw capture already has the ticks it skipped left out.
+        av_sync comes from _av_sync and shifts/stretches the audio track.
+        A long raw capture is encoded in parallel chunks, see finalize_stages.
+        parts are (path, frames) of a stream the rate controller split up;
+        they are re-encoded at frame_size. composite lists (path, (x, y)) of
+        every source when several monitors are composed into one picture.
+        audio_tracks > 1 splits the audio file into one track per device.
+        The temp files are handed over to the job. The files of a released
+        FrameSpool are read where they are; keep_spool leaves them there.
+        """
+        try:
+            self._keep_metrics(final_output)
+            # The audio recorder already streamed everything into a WAV file
+            inputs = {'video': video_path}
+            in_place = {}
+            video_format = ()
+            if spool is not None:
+                spool.save_info(output=final_output, av_sync=av_sync)
+                in_place = dict(inputs, spool=spool.directory)
+                inputs = {}
+                video_format = spool.input_args()
+            part_names = None
+            if parts:
+                for number, (path, count) in enumerate(parts[1:], 1):
+                    inputs[f'video{number}'] = path
+                part_names = [(os.path.basename(path), count) for path, count in parts]
+            layout = None
+            if composite:
+                for number, (path, position) in enumerate(composite[1:], 1):
+                    inputs[f'video{number}'] = path
+                layout = [position for path, position in composite]
+            if audio_path and os.path.exists(audio_path):
+                if sf.info(audio_path).frames > 0:
+                    (inputs if spool is None else in_place)['audio'] = audio_path
+                else:
+                    os.remove(audio_path)
+
+            stages, files = finalize_stages(final_output, self.fps, frames,
+                                            reencode=reencode_video,
+                                            decimate=decimate,
+                                            audio='audio' in inputs or 'audio' in in_place,
+                                            av_sync=av_sync,
+                                            chunks=1 if vfr else self._finalize_chunks(frames),
+                                            parts=part_names,
+                                            size=frame_size,
+                                            layout=layout,
+                                            vfr=vfr,
+                                            tracks=audio_tracks,
+                                            track_channels=self.channels,
+                                            video_format=video_format,
+                                            **self._encoder_settings())
+            self.jobs.submit(os.path.basename(final_output), stages, final_output,
+                             inputs=inputs, in_place=in_place, files=files,
+                             duration=frames / self.fps or None, message=report,
+                             keep=in_place if self.keep_spool else None)
+            self.jobs.start()
+
+        except Exception as e:
+            self.on_error("Error", f"Failed to process recording: {str(e)}")
+            if spool is not None:
+                self._set_status(f"Raw frames kept in: {spool.directory}")
+            # Try to save the raw video if it could not be queued
+            elif os.path.exists(video_path):
+                try:
+                    # Next to the final output, cleanup() sweeps the temp directory
+                    ext = os.path.splitext(video_path)[1]
+                    backup_path = f"{os.path.splitext(final_output)[0]}_backup{ext}"
+                    shutil.move(video_path, backup_path)
+                    self._set_status(f"Raw video saved to: {backup_path}")
+                except:
+                    self._set_status("Failed to save recording")
+
+    def _index_recording(self, path):
+        """Add a finished recording to its directory's library, which makes the thumbnails"""
+        if not self.index_recordings:
+            return
+        try:
+            self.library(os.path.dirname(path)).add(path)
+        except Exception as e:
+            self.on_error("Library Error", f"Could not index {path}: {str(e)}")
+
+    def _sample_metrics(self, pipelines=()):
+        """Add a row of pipeline and audio gauges to the recording's metrics"""
+        gauges, rates = {}, {}
+        if pipelines:
+            stats = [pipeline.stats() for pipeline in pipelines]
+            rates['fps'] = stats[0]['captured']
+            gauges.update(
+                convert_queue=max(source['convert_queue'] for source in stats),
+                encode_queue=max(source['encode_queue'] for source in stats),
+                dropped=sum(source['dropped'] for source in stats),
+                duplicated=sum(source['repeated'] for source in stats),
+                held=sum(source['held'] for source in stats),
+                skipped=sum(source['skipped'] for source in stats),
+                ticks_missed=sum(source['ticks_missed'] for source in stats),
+            )
+        recorder = self.audio_recorder
+        if recorder is not None:
+            audio = recorder.stats()
+            gauges['audio_queue'] = recorder.ring.available()
+            gauges['audio_overruns'] = audio['ring_overruns'] + audio['input_overflows']
+        self._metrics.sample(gauges, rates)
+
+    def _keep_metrics(self, output):
+        """Hold the recording's metrics until the job writing output is done"""
+        if self._metrics is not None:
+            self._pending_metrics[output] = (self._metrics, dict(self._last_stats),
+                                             self.metrics_format)
+
+    def _write_metrics(self, output, metrics, totals, format, stage_seconds=()):
+        """Write metrics next to output, adding the finalize stage times"""
+        for seconds in stage_seconds:
+            metrics.record('finalize', int(seconds * 1e9))
+        path = f"{os.path.splitext(output)[0]}.metrics.{format}"
+        try:
+            metrics.write(path, format, totals)
+        except OSError as e:
+            self.on_error("Metrics Error", f"Could not write {path}: {str(e)}")
+
+    def _finalize_chunks(self, frames):
+        """Number of parallel chunks for re-encoding a raw capture of this length"""
+        chunks = int(self.finalize_chunks) or os.cpu_count() or 1
+        return max(1, min(chunks, int(frames // (self.fps * self.MIN_CHUNK_SECONDS))))
+
+    def _on_job_update(self, job):
+        """Report finalization progress and results; called from job workers"""
+        if job['state'] == 'running':
+            if not self.is_recording:
+                self._set_status(f"Processing {job['label']}: {job['progress']:.0%}")
+        elif job['state'] == 'done':
+            self.last_output = job['output']
+            pending = self._pending_metrics.pop(job['output'], None)
+            if pending is not None:
+                self._write_metrics(job['output'], *pending,
+                                    stage_seconds=job.get('stage_seconds') or ())
+            self._index_recording(job['output'])
+            saved_msg = f"Recording saved to: {job['output']}"
+            if job['message']:
+                saved_msg += f" ({job['message']})"
+            self._set_status(saved_msg)
+        elif job['state'] == 'failed':
+            self.on_error("Error", f"Failed to process recording {job['label']}: {job['error']}")
+            self._set_status(f"Processing failed, inputs kept for a retry in: "
+                             f"{os.path.join(self.jobs.jobs_dir, job['id'])}")
+
+    
+    def _record_audio_only(self):
+        """Record audio only"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.audio_file = str(Path(self.output_dir) / f"audio_{timestamp}.wav")
+        
+        try:
+            self.audio_recorder = self._create_audio_recorder(self.audio_file)
+            self.audio_recorder.start()
+            self._set_status("Recording audio...")
+            last_update = time.monotonic()
+            while self.is_recording:
+                time.sleep(0.1)
+                if self._metrics is not None and time.monotonic() - last_update >= 1.0:
+                    last_update = time.monotonic()
+                    self._sample_metrics()
+            self.state = "processing"
+            stats = self._stop_audio()
+            
+            if stats['frames_written'] > 0:
+                self.last_output = self.audio_file
+                if self._metrics is not None:
+                    self._write_metrics(self.audio_file, self._metrics, dict(self._last_stats),
+                                        self.metrics_format)
+                self._index_recording(self.audio_file)
+                self._set_status(f"Audio saved to: {self.audio_file}")
+            else:
+                os.remove(self.audio_file)
+                self._set_status("No audio data recorded")
+                
+        except Exception as e:
+            self._stop_audio()
+            self.on_error("Error", f"Audio recording failed: {str(e)}")
+            self._set_status("Recording failed")
+    
+    def _start_audio(self, path, sink=None):
+        """Start recording audio for video recording, returns the output path or None"""
+        if not self.audio_enabled:
+            return None
+        try:
+            self.audio_recorder = self._create_audio_recorder(path, sink=sink)
+            self.audio_recorder.start()
+            return path or sink.path
+        except Exception as e:
+            self.audio_recorder = None
+            self.on_error("Audio Error", f"Audio recording failed: {str(e)}")
+            return None
+    
+    def _create_audio_recorder(self, path, sink=None):
+        """AudioRecorder for the selected device, or a MultiDeviceRecorder for several"""
+        if not self.audio_devices or len(self.audio_devices) < 2:
+            device = self.audio_devices[0] if self.audio_devices else self.audio_device
+            return AudioRecorder(path, self.sample_rate, self.channels, device=device, sink=sink,
+                                 metrics=self._metrics, stream_factory=self.audio_stream_factory)
+        import sounddevice as sd
+        inputs = []
+        for device in self.audio_devices:
+            # Every device runs at its own native rate, the mixer resamples
+            info = sd.query_devices(device, 'input')
+            inputs.append({'device': device, 'name': info['name'],
+                           'sample_rate': int(info['default_samplerate']),
+                           'channels': min(info['max_input_channels'], 2)})
+        return MultiDeviceRecorder(path, self.sample_rate, self.channels, inputs,
+                                   tracks=self.audio_tracks, sink=sink, metrics=self._metrics,
+                                   stream_factory=self.audio_stream_factory)
+
+    def _audio_track_count(self):
+        """Audio tracks of the recording: one per device when they are kept separate"""
+        if self.audio_tracks == "separate" and self.audio_devices:
+            return len(self.audio_devices)
+        return 1
+
+    def _stop_audio(self):
+        """Stop the audio recorder if one is running and return its counters"""
+        recorder, self.audio_recorder = self.audio_recorder, None
+        if recorder is None:
+            return None
+        recorder.stop()
+        stats = recorder.stats()
+        stats['clock'] = recorder.clock()
+        self._last_stats['audio'] = recorder.stats()
+        if stats['ring_overruns'] or stats['input_overflows'] or stats['input_underflows']:
+            self._set_status(f"Audio glitches: {stats['ring_overruns']} overruns, "
+                             f"{stats['input_overflows']} input overflows, "
+                             f"{stats['input_underflows']} input underflows")
+        return stats
@@ -0,0 +1,771 @@
+"""Tk window around RecorderEngine"""
+import time
+import sys
+import threading
+import os
+import subprocess
+
+from .lazy import LazyModule
+from .capture import SyntheticCapture, CAPTURE_BACKENDS, parse_region, parse_monitors
+from .library import describe_recording
+from .engine import RecorderEngine
+
+cv2 = LazyModule('cv2', 'cv2', globals())
+
+
+def _import_tk():
+    """Import the Tk modules used by the GUI; the engine and CLI never load them"""
+    global tk, ttk, filedialog, messagebox, Image, ImageTk
+    import tkinter as tk
+    from tkinter import ttk, filedialog, messagebox
+    from PIL import Image, ImageTk
+
+
+class ScreenRecorderGUI:
+    ENCODE_LABELS = {
+        "Streaming (FFmpeg)": "stream",
+        "Segmented (crash-safe)": "segments",
+        "Raw AVI (fallback)": "avi",
+        "Replay buffer (in memory)": "replay",
+        "Raw frame spool (lossless)": "spool",
+    }
+    # What to record; the entry next to the combobox holds the details
+    SOURCE_LABELS = {
+        "Full screen": None,
+        "Monitors (numbers)": "monitors",
+        "All monitors, one file each": "separate",
+        "All monitors side by side": "compose",
+        "Region (X,Y,W,H)": "region",
+        "Window (title)": "window",
+    }
+    NO_DEVICE = "None"
+
+    def __init__(self, engine=None):
+        _import_tk()
+        self.root = tk.Tk()
+        self.root.title("Screen & Audio Recorder")
+        self.root.geometry("500x900")
+        self.root.resizable(False, False)
+        
+        # All recording work is done by the engine; the GUI only drives it
+        self.engine = engine or RecorderEngine()
+        self.engine.on_status = lambda message: self.root.after(0, self.status_var.set, message)
+        self.engine.on_error = lambda title, message: self.root.after(
+            0, messagebox.showerror, title, message)
+        self.preview_active = False
+        self._audio_probe_thread = None
+        self._audio_probe_done = threading.Event()
+        self._first_paint_done = False
+        self.library_window = None
+        
+        # Default settings
+        self.output_dir = self.engine.output_dir
+        self.fps = self.engine.fps
+        self.quality = self.engine.quality
+        
+        self._create_gui()
+        # Device probing, backend benchmarking and the preview wait for the
+        # window to be drawn so they don't delay it
+        self.root.bind('<Map>', self._on_first_paint, add='+')
+    
+    def _on_first_paint(self, event=None):
+        """Start the background work once the window is on screen"""
+        if self._first_paint_done:
+            return
+        self._first_paint_done = True
+        self.root.after_idle(self._start_background_tasks)
+    
+    def _start_background_tasks(self):
+        """Probe audio devices and capture backends, then start the preview"""
+        self._probe_audio()
+        self._setup_capture()
+        self._setup_preview()
+        self._offer_recovery()
+        # Resume jobs left over from an earlier run
+        self.engine.jobs.start()
+        self._refresh_jobs()
+    
+    def _refresh_jobs(self):
+        """Mirror the finalize jobs in the list; runs on the Tk thread via root.after"""
+        jobs = self.engine.jobs.jobs()
+        shown = set(self.jobs_tree.get_children())
+        for job in jobs:
+            values = (job['state'], f"{job['progress']:.0%}")
+            if job['id'] in shown:
+                self.jobs_tree.item(job['id'], values=values)
+            else:
+                self.jobs_tree.insert("", 0, iid=job['id'], text=job['label'], values=values)
+        self.root.after(500, self._refresh_jobs)
+    
+    def _job_action(self, action):
+        """Apply cancel or retry to the selected jobs"""
+        for job_id in self.jobs_tree.selection():
+            action(job_id)
+    
+    def _offer_recovery(self):
+        """Offer to rebuild segmented recordings that were interrupted by a crash"""
+        sessions = self.engine.interrupted_sessions()
+        if not sessions:
+            return
+        if messagebox.askyesno("Recover Recordings",
+                               f"{len(sessions)} interrupted recording(s) found in "
+                               f"{self.engine.output_dir}. Recover them now?"):
+            threading.Thread(target=self.engine.recover_sessions, args=(sessions,),
+                             daemon=True).start()
+    
+    def _probe_audio(self, refresh=False):
+        """Enumerate audio devices on a background thread"""
+        if self.is_recording or (self._audio_probe_thread and self._audio_probe_thread.is_alive()):
+            return
+        self.audio_device_combo.configure(state="disabled")
+        self.audio_device_var.set("Detecting devices...")
+        self._audio_probe_done.clear()
+        
+        def probe():
+            try:
+                self.engine.setup_audio(refresh=refresh)
+            finally:
+                self._audio_probe_done.set()
+                self.root.after(0, self._populate_audio_devices)
+        self._audio_probe_thread = threading.Thread(target=probe, daemon=True)
+        self._audio_probe_thread.start()
+    
+    def _populate_audio_devices(self):
+        """Fill the audio device combobox from the engine's cached device list"""
+        audio_devices = self.engine.input_devices() if self.audio_enabled else []
+        self.audio_device_combo.configure(values=audio_devices)
+        self.audio_device2_combo.configure(values=[self.NO_DEVICE] + audio_devices)
+        if audio_devices:
+            self.audio_device_combo.configure(state="normal")
+            self.audio_device_combo.set(audio_devices[0])
+        else:
+            self.audio_device_var.set("No input devices")
+    
+    @property
+    def is_recording(self):
+        return self.engine.is_recording
+    
+    @property
+    def audio_enabled(self):
+        return self.engine.audio_enabled
+    
+    @property
+    def available_devices(self):
+        return self.engine.available_devices
+    
+    def _create_gui(self):
+        """Create the GUI elements"""
+        style = ttk.Style()
+        style.configure('Custom.TButton', padding=10)
+        
+        # Main container
+        main_frame = ttk.Frame(self.root, padding="10")
+        main_frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        
+        # Preview frame
+        self.preview_frame = ttk.LabelFrame(main_frame, text="Preview", padding="5")
+        self.preview_frame.grid(row=0, column=0, columnspan=2, pady=5, sticky="nsew")
+        self.preview_label = ttk.Label(self.preview_frame)
+        self.preview_label.grid(row=0, column=0)
+        
+        # Settings frame
+        settings_frame = ttk.LabelFrame(main_frame, text="Settings", padding="10")
+        settings_frame.grid(row=1, column=0, columnspan=2, pady=10, sticky="nsew")
+        
+        # Recording mode selection
+        ttk.Label(settings_frame, text="Recording Mode:").grid(row=0, column=0, sticky=tk.W)
+        self.mode_var = tk.StringVar(value="Screen & Audio")
+        mode_combo = ttk.Combobox(settings_frame, textvariable=self.mode_var, 
+                                 values=["Screen & Audio", "Audio Only"], 
+                                 width=27, state="readonly")
+        mode_combo.grid(row=0, column=1, columnspan=2, sticky=tk.W)
+        mode_combo.bind('<<ComboboxSelected>>', self._on_mode_change)
+        
+        # Output directory
+        ttk.Label(settings_frame, text="Output Directory:").grid(row=1, column=0, sticky=tk.W, pady=5)
+        self.output_path_var = tk.StringVar(value=self.output_dir)
+        ttk.Entry(settings_frame, textvariable=self.output_path_var, width=30).grid(row=1, column=1, padx=5)
+        ttk.Button(settings_frame, text="Browse", command=self._browse_output).grid(row=1, column=2)
+        
+        # FPS setting (only for screen recording)
+        self.fps_label = ttk.Label(settings_frame, text="FPS:")
+        self.fps_label.grid(row=2, column=0, sticky=tk.W, pady=5)
+        self.fps_var = tk.StringVar(value=str(self.fps))
+        self.fps_spinbox = ttk.Spinbox(settings_frame, from_=1, to=60, textvariable=self.fps_var, width=10)
+        self.fps_spinbox.grid(row=2, column=1, sticky=tk.W, pady=5)
+        
+        # Quality setting
+        self.quality_label = ttk.Label(settings_frame, text="Quality:")
+        self.quality_label.grid(row=3, column=0, sticky=tk.W)
+        self.quality_var = tk.StringVar(value=str(self.quality))
+        self.quality_spinbox = ttk.Spinbox(settings_frame, from_=1, to=100, textvariable=self.quality_var, width=10)
+        self.quality_spinbox.grid(row=3, column=1, sticky=tk.W)
+        self.adaptive_var = tk.BooleanVar(value=self.engine.adaptive)
+        self.adaptive_check = ttk.Checkbutton(settings_frame, text="Adapt to load",
+                                              variable=self.adaptive_var)
+        self.adaptive_check.grid(row=3, column=2, sticky=tk.W)
+        
+        # Encoding mode (only for screen recording)
+        self.encode_label = ttk.Label(settings_frame, text="Encoding:")
+        self.encode_label.grid(row=5, column=0, sticky=tk.W, pady=5)
+        self.encode_var = tk.StringVar(value="Streaming (FFmpeg)")
+        self.encode_combo = ttk.Combobox(settings_frame, textvariable=self.encode_var,
+                                         values=list(self.ENCODE_LABELS),
+                                         width=27, state="readonly")
+        self.encode_combo.grid(row=5, column=1, columnspan=2, sticky=tk.W, pady=5)
+        
+        # Static screen deduplication (only for screen recording)
+        self.skip_static_var = tk.BooleanVar(value=self.engine.skip_static)
+        self.skip_static_check = ttk.Checkbutton(settings_frame, text="Skip unchanged frames (VFR)",
+                                                 variable=self.skip_static_var)
+        self.skip_static_check.grid(row=6, column=1, columnspan=2, sticky=tk.W)
+        
+        # Capture backend (only for screen recording)
+        self.capture_label = ttk.Label(settings_frame, text="Capture:")
+        self.capture_label.grid(row=7, column=0, sticky=tk.W, pady=5)
+        self.capture_var = tk.StringVar(value=self.engine.capture_backend)
+        # The synthetic test pattern is for headless runs only
+        backends = [name for name in CAPTURE_BACKENDS if name != SyntheticCapture.name]
+        self.capture_combo = ttk.Combobox(settings_frame, textvariable=self.capture_var,
+                                          values=["auto"] + backends,
+                                          width=27, state="readonly")
+        self.capture_combo.grid(row=7, column=1, columnspan=2, sticky=tk.W, pady=5)
+        
+        # Capture area (only for screen recording)
+        self.source_label = ttk.Label(settings_frame, text="Source:")
+        self.source_label.grid(row=8, column=0, sticky=tk.W, pady=5)
+        self.source_var = tk.StringVar(value="Full screen")
+        self.source_combo = ttk.Combobox(settings_frame, textvariable=self.source_var,
+                                         values=list(self.SOURCE_LABELS),
+                                         width=27, state="readonly")
+        self.source_combo.grid(row=8, column=1, sticky=tk.W, padx=5, pady=5)
+        self.source_detail_var = tk.StringVar()
+        self.source_entry = ttk.Entry(settings_frame, textvariable=self.source_detail_var, width=15)
+        self.source_entry.grid(row=8, column=2, sticky=tk.W)
+        
+        # Audio device selection, filled in by the background device probe
+        ttk.Label(settings_frame, text="Audio Device:").grid(row=4, column=0, sticky=tk.W, pady=5)
+        self.audio_device_var = tk.StringVar()
+        self.audio_device_combo = ttk.Combobox(settings_frame, textvariable=self.audio_device_var, width=27)
+        self.audio_device_combo.grid(row=4, column=1, sticky=tk.W, padx=5, pady=5)
+        ttk.Button(settings_frame, text="Refresh",
+                   command=lambda: self._probe_audio(refresh=True)).grid(row=4, column=2)
+        
+        # A second device recorded at the same time, e.g. a system loopback
+        ttk.Label(settings_frame, text="Also Record:").grid(row=9, column=0, sticky=tk.W, pady=5)
+        self.audio_device2_var = tk.StringVar(value=self.NO_DEVICE)
+        self.audio_device2_combo = ttk.Combobox(settings_frame, textvariable=self.audio_device2_var,
+                                                values=[self.NO_DEVICE], width=27, state="readonly")
+        self.audio_device2_combo.grid(row=9, column=1, sticky=tk.W, padx=5, pady=5)
+        self.separate_tracks_var = tk.BooleanVar(value=self.engine.audio_tracks == "separate")
+        ttk.Checkbutton(settings_frame, text="Separate tracks",
+                        variable=self.separate_tracks_var).grid(row=9, column=2, sticky=tk.W)
+
+        # Stage timings on the preview and in a file next to the recording
+        self.metrics_var = tk.BooleanVar(value=self.engine.metrics)
+        ttk.Checkbutton(settings_frame, text="Show and save metrics",
+                        variable=self.metrics_var).grid(row=10, column=1, columnspan=2, sticky=tk.W)
+        
+        # Control buttons frame
+        control_frame = ttk.Frame(main_frame, padding="5")
+        control_frame.grid(row=2, column=0, columnspan=2, pady=10)
+        
+        # Record button
+        self.record_button = ttk.Button(control_frame, text="Start Recording", 
+                                      command=self._toggle_recording, style='Custom.TButton')
+        self.record_button.grid(row=0, column=0, padx=5)
+        
+        # Saves the last seconds while a replay buffer is running
+        self.replay_button = ttk.Button(control_frame, text="Save Replay", state="disabled",
+                                        command=self._save_replay, style='Custom.TButton')
+        self.replay_button.grid(row=0, column=1, padx=5)
+        
+        # Recordings of the output directory, with their thumbnails
+        ttk.Button(control_frame, text="Library", command=self._open_library,
+                   style='Custom.TButton').grid(row=0, column=2, padx=5)
+        
+        # Status label
+        self.status_var = tk.StringVar(value="Ready to record")
+        self.status_label = ttk.Label(main_frame, textvariable=self.status_var)
+        self.status_label.grid(row=3, column=0, columnspan=2, pady=10)
+        
+        # Finalize jobs, processed in the background while recording goes on
+        jobs_frame = ttk.LabelFrame(main_frame, text="Processing", padding="5")
+        jobs_frame.grid(row=4, column=0, columnspan=2, sticky="nsew")
+        self.jobs_tree = ttk.Treeview(jobs_frame, columns=("state", "progress"), height=3)
+        self.jobs_tree.heading("#0", text="Recording")
+        self.jobs_tree.heading("state", text="State")
+        self.jobs_tree.heading("progress", text="Progress")
+        self.jobs_tree.column("#0", width=250)
+        self.jobs_tree.column("state", width=90)
+        self.jobs_tree.column("progress", width=80)
+        self.jobs_tree.grid(row=0, column=0, columnspan=2)
+        ttk.Button(jobs_frame, text="Cancel",
+                   command=lambda: self._job_action(self.engine.jobs.cancel)).grid(row=1, column=0, pady=5)
+        ttk.Button(jobs_frame, text="Retry",
+                   command=lambda: self._job_action(self.engine.jobs.retry)).grid(row=1, column=1, pady=5)
+    
+    def _on_mode_change(self, event=None):
+        """Handle recording mode changes"""
+        mode = self.mode_var.get()
+        is_screen_recording = mode == "Screen & Audio"
+        
+        # Show/hide screen recording specific controls
+        if is_screen_recording:
+            self.fps_label.grid()
+            self.fps_spinbox.grid()
+            self.quality_label.grid()
+            self.quality_spinbox.grid()
+            self.adaptive_check.grid()
+            self.encode_label.grid()
+            self.encode_combo.grid()
+            self.skip_static_check.grid()
+            self.capture_label.grid()
+            self.capture_combo.grid()
+            self.source_label.grid()
+            self.source_combo.grid()
+            self.source_entry.grid()
+            self.preview_frame.grid()
+        else:
+            self.fps_label.grid_remove()
+            self.fps_spinbox.grid_remove()
+            self.quality_label.grid_remove()
+            self.quality_spinbox.grid_remove()
+            self.adaptive_check.grid_remove()
+            self.encode_label.grid_remove()
+            self.encode_combo.grid_remove()
+            self.skip_static_check.grid_remove()
+            self.capture_label.grid_remove()
+            self.capture_combo.grid_remove()
+            self.source_label.grid_remove()
+            self.source_combo.grid_remove()
+            self.source_entry.grid_remove()
+            self.preview_frame.grid_remove()
+    
+    def _setup_capture(self):
+        """Benchmark the capture backends in the background to pick the default"""
+        threading.Thread(target=self.engine.probe_capture_backends, daemon=True).start()
+    
+    def _setup_preview(self):
+        """Setup the preview window
+
+        While recording, the pipeline feeds the preview tap from frames it has
+        already captured. Otherwise a low-rate idle thread grabs frames for it.
+        The Tk widgets are only touched from _refresh_preview on the Tk thread.
+        """
+        self.preview_active = True
+        self.preview_tap = self.engine.preview_tap
+        self._preview_sequence = 0
+        self._preview_backend_name = self.capture_var.get()
+        self.preview_thread = threading.Thread(target=self._update_preview)
+        self.preview_thread.daemon = True
+        self.preview_thread.start()
+        self.root.after(100, self._refresh_preview)
+    
+    def _update_preview(self):
+        """Grab preview frames while no recording pipeline is running"""
+        backend = None
+        backend_name = None
+        while self.preview_active:
+            idle = self.engine.frame_pipeline is None and not self.is_recording
+            if idle and self.preview_tap.enabled:
+                try:
+                    if backend is None or backend_name != self._preview_backend_name:
+                        if backend is not None:
+                            backend.close()
+                        backend_name = self._preview_backend_name
+                        backend = self.engine.create_capture_backend(backend_name)
+                    self.preview_tap.offer(backend.grab(), backend.pixel_format)
+                except Exception:
+                    pass
+            elif backend is not None:
+                # Leave the capture source to the recording pipeline
+                backend.close()
+                backend = None
+            time.sleep(1/10)
+        if backend is not None:
+            backend.close()
+    
+    def _refresh_preview(self):
+        """Show the latest preview frame; runs on the Tk thread via root.after"""
+        if not self.preview_active:
+            return
+        visible = (self.mode_var.get() == "Screen & Audio" and
+                   self.root.state() != 'iconic')
+        self.preview_tap.enabled = visible
+        self._preview_backend_name = self.capture_var.get()
+        if visible:
+            sequence, frame = self.preview_tap.latest()
+            if frame is not None and sequence != self._preview_sequence:
+                self._preview_sequence = sequence
+                if self.engine.is_recording and self.engine.metrics:
+                    frame = self._draw_metrics(frame)
+                photo = ImageTk.PhotoImage(Image.fromarray(frame))
+                self.preview_label.configure(image=photo)
+                self.preview_label.image = photo
+        self.root.after(100, self._refresh_preview)
+    
+    def _draw_metrics(self, frame):
+        """Copy of a preview frame with the latest metrics written over it"""
+        gauges = self.engine.stats().get('metrics', {}).get('gauges')
+        if not gauges:
+            return frame
+        stages = "  ".join(f"{stage} {gauges[f'{stage}_p99_ms']:.1f}"
+                           for stage in ('capture', 'convert', 'encode', 'audio_callback')
+                           if f'{stage}_p99_ms' in gauges)
+        lines = [
+            f"{gauges.get('fps', 0.0):.1f} fps  CPU {gauges['cpu_percent']:.0f}%  "
+            f"RSS {gauges['rss_mb'] or 0:.0f} MB",
+            f"p99 ms: {stages}",
+            f"queues {gauges.get('convert_queue', 0)}/{gauges.get('encode_queue', 0)}  "
+            f"dropped {gauges.get('dropped', 0)}  duplicated {gauges.get('duplicated', 0)}  "
+            f"audio overruns {gauges.get('audio_overruns', 0)}",
+        ]
+        frame = frame.copy()
+        cv2.rectangle(frame, (0, 0), (frame.shape[1], 14 * len(lines) + 4), (0, 0, 0), -1)
+        for number, line in enumerate(lines, 1):
+            cv2.putText(frame, line, (4, 14 * number), cv2.FONT_HERSHEY_SIMPLEX, 0.35,
+                        (255, 255, 255), 1, cv2.LINE_AA)
+        return frame
+
+    def _browse_output(self):
+        """Open directory browser"""
+        directory = filedialog.askdirectory(initialdir=self.output_dir)
+        if directory:
+            if os.access(directory, os.W_OK):
+                self.output_dir = directory
+                self.output_path_var.set(directory)
+            else:
+                messagebox.showerror("Error", "Selected directory is not writable. Please choose another location.")
+    
+    def _toggle_recording(self):
+        """Toggle recording state"""
+        if not self.is_recording:
+            self.start_recording()
+        else:
+            self.stop_recording()
+    
+    def start_recording(self):
+        """Start recording"""
+        try:
+            if self._audio_probe_thread is not None:
+                # Don't start before we know whether there is an input device
+                self._audio_probe_done.wait(timeout=5.0)
+            if not self._validate_settings():
+                return
+
+            self.engine.start()
+            self.record_button.configure(text="Stop Recording")
+            if self.engine.encode_mode == "replay":
+                self.replay_button.configure(state="normal")
+            
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to start recording: {str(e)}")
+            self.stop_recording()
+    
+    def stop_recording(self):
+        """Stop recording"""
+        self.engine.stop()
+        self.record_button.configure(text="Start Recording")
+        self.replay_button.configure(state="disabled")
+        self.status_var.set("Processing recording...")
+    
+    def _save_replay(self):
+        """Write the replay buffer to a file without blocking the window"""
+        def save():
+            try:
+                self.engine.save_replay()
+            except Exception as e:
+                self.engine.on_error("Replay Error", f"Saving the replay failed: {str(e)}")
+        threading.Thread(target=save, daemon=True).start()
+    
+    def _open_library(self):
+        """Show the recordings of the output directory in their own window"""
+        if self.library_window is not None:
+            self.library_window.window.lift()
+            return
+        try:
+            library = self.engine.library(self.output_path_var.get())
+        except Exception as e:
+            messagebox.showerror("Library", f"Cannot open the library: {str(e)}")
+            return
+        self.library_window = LibraryWindow(self.root, library, on_close=self._library_closed)
+    
+    def _library_closed(self):
+        self.library_window = None
+    
+    def _apply_settings(self):
+        """Push the values of the settings widgets into the engine"""
+        self.output_dir = self.output_path_var.get()
+        settings = {'output_dir': self.output_dir, 'metrics': self.metrics_var.get()}
+        if self.mode_var.get() == "Screen & Audio":
+            self.fps = int(self.fps_var.get())
+            self.quality = int(self.quality_var.get())
+            settings.update(
+                mode="screen_and_audio",
+                fps=self.fps,
+                quality=self.quality,
+                adaptive=self.adaptive_var.get(),
+                encode_mode=self.ENCODE_LABELS[self.encode_var.get()],
+                skip_static=self.skip_static_var.get(),
+                capture_backend=self.capture_var.get(),
+                **self._source_settings(),
+            )
+        else:
+            settings['mode'] = "audio_only"
+        if self.audio_enabled:
+            device = self.audio_device_var.get() or None
+            second = self.audio_device2_var.get()
+            settings.update(
+                audio_device=device,
+                audio_devices=[device, second] if device and second != self.NO_DEVICE else None,
+                audio_tracks="separate" if self.separate_tracks_var.get() else "mix",
+            )
+        self.engine.configure(**settings)
+
+    def _source_settings(self):
+        """Engine settings for the selected capture area, raising ValueError"""
+        source = self.SOURCE_LABELS[self.source_var.get()]
+        detail = self.source_detail_var.get().strip()
+        settings = {'region': None, 'window': None, 'monitors': None}
+        if source == "monitors":
+            try:
+                settings['monitors'] = parse_monitors(detail.replace(',', ' ').split())
+            except ValueError:
+                raise ValueError(f"Monitors must be numbers, not '{detail}'")
+            if not settings['monitors']:
+                raise ValueError("Enter the numbers of the monitors to record")
+            settings['layout'] = "separate"
+        elif source in RecorderEngine.LAYOUTS:
+            settings.update(monitors="all", layout=source)
+        elif source == "region":
+            settings['region'] = parse_region(detail)
+        elif source == "window":
+            if not detail:
+                raise ValueError("Enter the title of the window to record")
+            settings['window'] = detail
+        return settings
+    
+    def _validate_settings(self):
+        """Validate all settings before recording"""
+        try:
+            self._apply_settings()
+            self.engine.validate()
+            
+            # Validate audio device if audio is enabled
+            if self.audio_enabled:
+                if not self.audio_device_var.get():
+                    raise ValueError("No audio device selected")
+            
+            return True
+            
+        except ValueError as e:
+            messagebox.showerror("Validation Error", str(e))
+            return False
+        except Exception as e:
+            messagebox.showerror("Error", f"Settings validation failed: {str(e)}")
+            return False
+    
+    def _cleanup(self):
+        """Clean up resources before closing"""
+        try:
+            self.preview_active = False
+            if self.library_window is not None:
+                self.library_window.close()
+            if hasattr(self, 'preview_thread'):
+                self.preview_thread.join(timeout=1.0)
+            
+            # Stop any ongoing recording and remove temporary files
+            self.engine.cleanup()
+                        
+        except Exception as e:
+            print(f"Cleanup error: {str(e)}")
+    
+    def run(self):
+        """Start the GUI application"""
+        try:
+            # Register cleanup on window close
+            self.root.protocol("WM_DELETE_WINDOW", self._on_closing)
+            self.root.mainloop()
+        except Exception as e:
+            messagebox.showerror("Error", f"Application error: {str(e)}")
+            self._cleanup()
+    
+    def _on_closing(self):
+        """Handle window closing"""
+        if self.is_recording:
+            if messagebox.askyesno("Quit", "Recording is in progress. Stop recording and quit?"):
+                self._cleanup()
+                self.root.destroy()
+        elif self.engine.jobs.pending():
+            if messagebox.askyesno("Quit", "Recordings are still being processed. Quit anyway? "
+                                           "Processing resumes the next time."):
+                self._cleanup()
+                self.root.destroy()
+        else:
+            self._cleanup()
+            self.root.destroy()
+
+
+class LibraryWindow:
+    """Browse a RecordingLibrary: newest first, searchable, with the contact sheet of the selection
+
+    Rows are fetched PAGE at a time and more as the list is scrolled to its
+    end, so a directory of thousands of recordings opens at once. While the
+    window is open the library watches the directory and the list follows.
+    """
+    PAGE = 200
+    IMAGE_SIZE = 360
+    # Coalesces the changes of a burst of new files into one refresh
+    REFRESH_MS = 500
+
+    def __init__(self, root, library, on_close=None):
+        self.library = library
+        self.on_close = on_close or (lambda: None)
+        self._loaded = 0
+        self._total = 0
+        self._loading = False
+        self._refresh_pending = False
+
+        self.window = tk.Toplevel(root)
+        self.window.title(f"Recordings - {library.directory}")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        frame = ttk.Frame(self.window, padding="5")
+        frame.grid(row=0, column=0, sticky="nsew")
+        self.window.columnconfigure(0, weight=1)
+        self.window.rowconfigure(0, weight=1)
+        frame.columnconfigure(1, weight=1)
+        frame.rowconfigure(1, weight=1)
+
+        ttk.Label(frame, text="Search:").grid(row=0, column=0, sticky=tk.W)
+        self.search_var = tk.StringVar()
+        ttk.Entry(frame, textvariable=self.search_var, width=30).grid(row=0, column=1, sticky=tk.W, padx=5)
+        self.count_var = tk.StringVar()
+        ttk.Label(frame, textvariable=self.count_var).grid(row=0, column=2, sticky=tk.E)
+
+        self.tree = ttk.Treeview(frame, columns=("date", "duration", "picture", "size"), height=20)
+        for column, heading, width in (("#0", "Recording", 260), ("date", "Date", 140),
+                                       ("duration", "Length", 70), ("picture", "Picture", 80),
+                                       ("size", "Size", 80)):
+            self.tree.heading(column, text=heading)
+            self.tree.column(column, width=width, stretch=column == "#0")
+        scrollbar = ttk.Scrollbar(frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=lambda first, last: self._on_scroll(scrollbar, first, last))
+        self.tree.grid(row=1, column=0, columnspan=3, sticky="nsew")
+        scrollbar.grid(row=1, column=3, sticky="ns")
+        self.image_label = ttk.Label(frame, text="", width=40, anchor=tk.CENTER)
+        self.image_label.grid(row=1, column=4, sticky=tk.N, padx=5)
+
+        self.tree.bind('<<TreeviewSelect>>', lambda event: self._show_image())
+        self.tree.bind('<Double-1>', lambda event: self._open_selected())
+        self.search_var.trace_add('write', lambda *args: self.reload())
+        library.on_change = lambda: root.after(0, self._on_library_change)
+        library.watch()
+        self.reload()
+
+    def reload(self, keep=False):
+        """Fetch the list again; keep=True keeps the rows loaded so far, the selection and the scroll position"""
+        rows = max(self.PAGE, self._loaded) if keep else self.PAGE
+        selection = self.tree.selection() if keep else ()
+        position = self.tree.yview()[0] if keep else 0.0
+        self.tree.delete(*self.tree.get_children())
+        self._loaded = 0
+        self._total = self.library.count(self._search())
+        self._load(rows)
+        selection = [item for item in selection if self.tree.exists(item)]
+        if selection:
+            self.tree.selection_set(selection)
+        self.tree.yview_moveto(position)
+
+    def close(self):
+        if self.window is None:
+            return
+        self.library.on_change = lambda: None
+        self.window.destroy()
+        self.window = None
+        self.on_close()
+
+    def _search(self):
+        return self.search_var.get().strip() or None
+
+    def _load(self, rows):
+        """Append the next rows of the list"""
+        for entry in self.library.page(self._loaded, rows, self._search()):
+            self.tree.insert("", tk.END, iid=entry['name'], text=entry['name'],
+                             values=describe_recording(entry))
+            self._loaded += 1
+        self.count_var.set(f"{self._total} recordings")
+
+    def _on_scroll(self, scrollbar, first, last):
+        scrollbar.set(first, last)
+        # Near the end of what is loaded: fetch the next page
+        if float(last) > 0.95 and self._loaded < self._total and not self._loading:
+            self._loading = True
+            self.window.after_idle(self._load_more)
+
+    def _load_more(self):
+        self._loading = False
+        if self.window is not None:
+            self._load(self.PAGE)
+
+    def _on_library_change(self):
+        if self.window is None or self._refresh_pending:
+            return
+        self._refresh_pending = True
+        self.window.after(self.REFRESH_MS, self._refresh)
+
+    def _refresh(self):
+        self._refresh_pending = False
+        if self.window is not None:
+            self.reload(keep=True)
+            # Thumbnails are made after indexing, so the selection may have one now
+            self._show_image()
+
+    def _show_image(self):
+        """Show the contact sheet, or the thumbnail, of the selected recording"""
+        selection = self.tree.selection()
+        entry = self.library.get(selection[0]) if selection else None
+        path = None
+        if entry is not None:
+            path = (self.library.image_path(entry, 'contact_sheet')
+                    or self.library.image_path(entry, 'thumbnail'))
+        if path is None:
+            text = "No preview yet" if entry is not None and entry['thumbnail'] is None else ""
+            self.image_label.configure(image="", text=text)
+            self.image_label.image = None
+            return
+        try:
+            image = Image.open(path)
+            image.thumbnail((self.IMAGE_SIZE, self.IMAGE_SIZE))
+            photo = ImageTk.PhotoImage(image)
+        except OSError:
+            self.image_label.configure(image="", text="")
+            return
+        self.image_label.configure(image=photo, text="")
+        self.image_label.image = photo  # keep a reference
+
+    def _open_selected(self):
+        """Open the selected recording with the default application"""
+        for name in self.tree.selection()[:1]:
+            path = os.path.join(self.library.directory, name)
+            try:
+                if sys.platform == 'win32':
+                    os.startfile(path)
+                else:
+                    subprocess.Popen(['open' if sys.platform == 'darwin' else 'xdg-open', path])
+            except OSError as e:
+                messagebox.showerror("Library", f"Cannot open {name}: {str(e)}")
+
+
+def run_gui():
+    """Open the recorder window and run it until it is closed; returns the exit code"""
+    try:
+        app = ScreenRecorderGUI()
+        app.run()
+    except Exception as e:
+        if 'messagebox' in globals():
+            messagebox.showerror("Fatal Error", f"Failed to start application: {str(e)}")
+        else:
+            print(f"Failed to start application: {str(e)}", file=sys.stderr)
+        return 1
+    return 0
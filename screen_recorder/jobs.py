@@ -0,0 +1,487 @@
+"""Finalization jobs that run in the background and survive restarts"""
+import json
+import tempfile
+import time
+from datetime import datetime
+import threading
+import uuid
+import os
+import shutil
+import subprocess
+
+from .session import write_json
+from .encoding import decimate_args
+
+
+class FinalizeQueue:
+    """Persistent queue of FFmpeg finalization jobs run by a pool of workers
+
+    Every job has its own directory under jobs_dir holding job.json and the
+    inputs moved in when it was submitted, so jobs never share files and
+    survive a restart: queued jobs, and jobs cut off while running, are
+    picked up again when the queue is created. At most `workers` jobs run at
+    once. on_update(job) gets a copy of a job on every state change and
+    progress step, from a worker thread.
+    """
+
+    STATES = ("queued", "running", "done", "failed", "cancelled")
+    JOB_FILE = 'job.json'
+
+    def __init__(self, jobs_dir, workers=1, on_update=None):
+        self.jobs_dir = str(jobs_dir)
+        self.workers = workers
+        self.on_update = on_update or (lambda job: None)
+        self._jobs = {}
+        self._processes = {}
+        self._threads = []
+        self._running = False
+        self._cond = threading.Condition()
+        self._load()
+
+    def _load(self):
+        """Read back the jobs that did not finish in an earlier run"""
+        try:
+            names = os.listdir(self.jobs_dir)
+        except OSError:
+            return
+        jobs = []
+        for name in names:
+            try:
+                with open(os.path.join(self.jobs_dir, name, self.JOB_FILE)) as f:
+                    jobs.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        for job in sorted(jobs, key=lambda job: job['created']):
+            if job['state'] == 'running':
+                job['state'] = 'queued'
+                job['progress'] = 0.0
+            self._jobs[job['id']] = job
+
+    def start(self):
+        """Start the worker threads"""
+        with self._cond:
+            self._running = True
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify_all()
+
+    def set_workers(self, workers):
+        """Change how many jobs may run at once"""
+        with self._cond:
+            self.workers = workers
+        if self._running:
+            self.start()
+
+    def shutdown(self):
+        """Stop the workers; running jobs are stopped and queued again for next time"""
+        with self._cond:
+            self._running = False
+            processes = [process for job_processes in self._processes.values()
+                         for process in job_processes]
+            self._cond.notify_all()
+        for process in processes:
+            process.terminate()
+        for thread in self._threads:
+            thread.join(timeout=5.0)
+        self._threads = []
+
+    def submit(self, label, stages, output, inputs=None, in_place=None, files=None,
+               duration=None, message=None, keep=None):
+        """Queue FFmpeg commands and return the job id
+
+        stages run one after the other; the commands of a stage run at the
+        same time, each as {'command': [...], 'duration': seconds}. Progress
+        is measured against the durations; commands without one (e.g. a
+        final stream copy) don't count. inputs maps names to files that are
+        moved into the job directory; in_place maps names to files or
+        directories the job uses where they are; files maps file names to
+        text written into the job directory. A command argument starting
+        with "{name}" gets that path substituted when the job runs, "{job}"
+        is the job directory. The job deletes all of its inputs once it
+        has succeeded, except the in_place names listed in keep.
+        """
+        job_id = datetime.now().strftime("%Y%m%d_%H%M%S_") + uuid.uuid4().hex[:6]
+        job_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(job_dir)
+        paths = dict(in_place or {})
+        for name, path in (inputs or {}).items():
+            paths[name] = os.path.join(job_dir, os.path.basename(path))
+            shutil.move(path, paths[name])
+        for name, text in (files or {}).items():
+            with open(os.path.join(job_dir, name), 'w') as f:
+                f.write(text)
+        job = {
+            'id': job_id,
+            'label': label,
+            'stages': [[dict(step) for step in stage] for stage in stages],
+            'output': output,
+            'inputs': paths,
+            'moved': sorted(inputs or ()),
+            'keep': sorted(keep or ()),
+            'duration': duration,
+            'message': message,
+            'state': 'queued',
+            'progress': 0.0,
+            'error': None,
+            'attempts': 0,
+            'created': time.time(),
+        }
+        with self._cond:
+            self._jobs[job_id] = job
+            self._save(job)
+            self._cond.notify_all()
+        self.on_update(dict(job))
+        return job_id
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; its inputs are kept for a retry"""
+        with self._cond:
+            job = self._jobs[job_id]
+            if job['state'] not in ('queued', 'running'):
+                return False
+            job['state'] = 'cancelled'
+            processes = self._processes.get(job_id, [])
+            self._save(job)
+        for process in processes:
+            process.terminate()
+        self.on_update(dict(job))
+        return True
+
+    def retry(self, job_id):
+        """Queue a failed or cancelled job again"""
+        with self._cond:
+            job = self._jobs[job_id]
+            if job['state'] not in ('failed', 'cancelled'):
+                return False
+            job.update(state='queued', progress=0.0, error=None)
+            self._save(job)
+            self._cond.notify_all()
+        self.on_update(dict(job))
+        return True
+
+    def jobs(self):
+        """Copies of all jobs, oldest first"""
+        with self._cond:
+            return [dict(job) for job in self._jobs.values()]
+
+    def owned_paths(self):
+        """Inputs of the jobs that have not finished yet"""
+        with self._cond:
+            return {path for job in self._jobs.values() if job['state'] != 'done'
+                    for path in job['inputs'].values()}
+
+    def pending(self):
+        """Number of queued and running jobs"""
+        with self._cond:
+            return sum(job['state'] in ('queued', 'running') for job in self._jobs.values())
+
+    def wait(self, timeout=None):
+        """Block until no job is queued or running; False on timeout
+
+        A cancelled job counts as running until its commands have stopped
+        and its partial output is gone.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._processes and not any(
+                job['state'] in ('queued', 'running') for job in self._jobs.values()), timeout)
+
+    def _run_stage(self, job, stage, paths, done, first, total):
+        """Run the commands of one stage in parallel; returns an error message or None"""
+        processes = []
+        with self._cond:
+            if job['state'] != 'running' or not self._running:
+                return None
+            stderrs = [tempfile.TemporaryFile() for step in stage]
+            try:
+                for step, stderr in zip(stage, stderrs):
+                    command = [self._resolve(arg, paths) for arg in step['command']]
+                    command[1:1] = ['-progress', 'pipe:1', '-nostats']
+                    processes.append(subprocess.Popen(command, stdout=subprocess.PIPE,
+                                                      stderr=stderr))
+            except OSError as e:
+                for process in processes:
+                    process.kill()
+                    process.wait()
+                for stderr in stderrs:
+                    stderr.close()
+                return str(e)
+            self._processes[job['id']] = processes
+
+        readers = [threading.Thread(target=self._read_progress,
+                                    args=(job, process, step, first + i, done, total),
+                                    daemon=True)
+                   for i, (process, step) in enumerate(zip(processes, stage))]
+        for reader in readers:
+            reader.start()
+        error = None
+        for process, reader, stderr in zip(processes, readers, stderrs):
+            reader.join()
+            returncode = process.wait()
+            if returncode != 0 and error is None:
+                stderr.seek(0)
+                error = (stderr.read().decode(errors='replace').strip()
+                         or f"FFmpeg exited with code {returncode}")
+                # One failed command fails the job, don't wait for the rest
+                for other in processes:
+                    if other.poll() is None:
+                        other.terminate()
+            stderr.close()
+        return error
+
+    def _read_progress(self, job, process, step, index, done, total):
+        """Follow one command's -progress output and update the job's progress"""
+        for line in process.stdout:
+            key, _, value = line.decode(errors='replace').strip().partition('=')
+            if (key == 'out_time_us' and value.isdigit() and step['duration']
+                    and job['state'] == 'running'):
+                with self._cond:
+                    done[index] = min(step['duration'], int(value) / 1e6)
+                    job['progress'] = min(1.0, sum(done) / total)
+                self.on_update(dict(job))
+
+    @staticmethod
+    def _resolve(arg, paths):
+        """Substitute a leading "{name}" with that input's path"""
+        if arg.startswith('{') and '}' in arg:
+            name, rest = arg[1:].split('}', 1)
+            if name in paths:
+                return paths[name] + rest
+        return arg
+
+    def _save(self, job):
+        """Persist a job next to its inputs; finished jobs leave nothing behind"""
+        job_dir = os.path.join(self.jobs_dir, job['id'])
+        if job['state'] == 'done':
+            shutil.rmtree(job_dir, ignore_errors=True)
+        elif os.path.isdir(job_dir):
+            write_json(os.path.join(job_dir, self.JOB_FILE), job)
+
+    def _next_job(self):
+        """Wait for a queued job while there is a free worker; None on shutdown"""
+        with self._cond:
+            while True:
+                if not self._running:
+                    return None
+                running = sum(job['state'] == 'running' for job in self._jobs.values())
+                queued = [job for job in self._jobs.values() if job['state'] == 'queued']
+                if queued and running < self.workers:
+                    job = queued[0]
+                    job['state'] = 'running'
+                    job['attempts'] += 1
+                    self._save(job)
+                    return job
+                self._cond.wait()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            self.on_update(dict(job))
+            self._run(job)
+
+    def _run(self, job):
+        """Run a job's stages, tracking progress from FFmpeg's -progress output
+
+        The wall time of every stage ends up in the job's stage_seconds.
+        """
+        paths = dict(job['inputs'], job=os.path.join(self.jobs_dir, job['id']))
+        steps = [step for stage in job['stages'] for step in stage]
+        total = sum(step['duration'] or 0 for step in steps)
+        done = [0.0] * len(steps)
+        stage_seconds = []
+        error = None
+        first = 0
+        for stage in job['stages']:
+            began = time.monotonic()
+            error = self._run_stage(job, stage, paths, done, first, total)
+            stage_seconds.append(round(time.monotonic() - began, 3))
+            first += len(stage)
+            if error is not None or job['state'] != 'running' or not self._running:
+                break
+
+        with self._cond:
+            self._processes.pop(job['id'], None)
+            if job['state'] != 'running' or not self._running:
+                # Cancelled, or stopped by shutdown and left queued for the next run
+                if job['state'] == 'running':
+                    job.update(state='queued', progress=0.0)
+                if os.path.exists(job['output']):
+                    os.remove(job['output'])
+                self._save(job)
+                self._cond.notify_all()
+                return
+
+        if error is None and os.path.exists(job['output']):
+            result = {'state': 'done', 'progress': 1.0, 'stage_seconds': stage_seconds}
+            for name, path in job['inputs'].items():
+                if name not in job['moved'] and name not in job.get('keep', ()):
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    elif os.path.exists(path):
+                        os.remove(path)
+        else:
+            result = {'state': 'failed', 'error': error or "FFmpeg did not write the output",
+                      'stage_seconds': stage_seconds}
+            if os.path.exists(job['output']):
+                os.remove(job['output'])
+        # Report before wait() can see the job finish
+        self.on_update({**job, **result})
+        with self._cond:
+            job.update(result)
+            self._save(job)
+            self._cond.notify_all()
+
+
+def chunk_ranges(frames, chunks):
+    """Split frames into at most `chunks` contiguous (first_frame, count) ranges"""
+    chunks = max(1, min(chunks, frames))
+    bounds = [frames * i // chunks for i in range(chunks + 1)]
+    return [(bounds[i], bounds[i + 1] - bounds[i]) for i in range(chunks)]
+
+
+def finalize_stages(output, fps, frames, reencode=True, decimate=False, audio=False,
+                    av_sync=None, chunks=1, crf=23, preset='veryfast', parts=None, size=None,
+                    layout=None, video_format=(), vfr=False, tracks=1, track_channels=2,
+                    start_frame=None):
+    """FinalizeQueue stages and files that turn {video} (+ {audio}) into output
+
+    With reencode=False the video is already H.264 and only copied. With
+    chunks > 1 a raw capture is split at frame boundaries, the pieces are
+    encoded by concurrent FFmpeg processes and then joined by stream copy
+    with the concat demuxer; the audio is muxed once, in that last step.
+    parts lists (file name, frames) of a stream whose encoder was restarted
+    at another scale or preset; they are joined and re-encoded at size.
+    layout lists the (x, y) position of {video}, {video1}, ... in a
+    composed picture, e.g. monitors recorded side by side.
+    video_format holds input options of {video}, e.g. the rawvideo format
+    of a FrameSpool. With a start_frame only `frames` frames from there on
+    are encoded, and the audio is cut to match. With vfr=True {video}
+    carries the tick of every frame and is encoded in one piece, since
+    chunks are cut by frame count. With tracks > 1 {audio} holds
+    track_channels channels per device side by side; each device becomes
+    an audio track of its own.
+    Returns (stages, files).
+    """
+    duration = frames / fps
+    video_input = list(video_format) + ['-i', '{video}']
+    cut = []
+    if start_frame is not None:
+        # Seeking raw frames is exact; the audio moves along with the video
+        offset = start_frame / fps
+        if offset:
+            video_input[:0] = ['-ss', f'{offset:.6f}']
+        av_sync = dict(av_sync or {'tempo': 1.0, 'offset': 0.0})
+        av_sync['offset'] -= offset
+        cut = ['-t', f'{duration:.6f}']
+    audio_input = []
+    audio_output = []
+    tempo = None
+    if audio:
+        if av_sync and av_sync['offset'] > 0:
+            audio_input.extend(['-itsoffset', f"{av_sync['offset']:.6f}"])
+        elif av_sync and av_sync['offset'] < 0:
+            # Audio started before tick 0, skip the samples in front of it
+            audio_input.extend(['-ss', f"{-av_sync['offset']:.6f}"])
+        audio_input.extend(['-i', '{audio}'])
+        if av_sync and av_sync['tempo'] != 1.0:
+            tempo = f"atempo={av_sync['tempo']:.8f}"
+            if tracks <= 1:
+                audio_output.extend(['-af', tempo])
+        audio_output.extend(['-c:a', 'aac', '-b:a', '128k'])
+
+    def audio_map(index):
+        """Map the audio input `index`, split into its tracks"""
+        if not audio:
+            return []
+        if tracks <= 1:
+            return ['-map', f'{index}:a']
+        split = ''.join(f'[s{track}]' for track in range(tracks))
+        graph = f"[{index}:a]{tempo + ',' if tempo else ''}asplit={tracks}{split}"
+        channel_layout = 'mono' if track_channels == 1 else 'stereo'
+        for track in range(tracks):
+            channels = '|'.join(f'c{channel}=c{track * track_channels + channel}'
+                                for channel in range(track_channels))
+            graph += f";[s{track}]pan={channel_layout}|{channels}[a{track}]"
+        maps = []
+        for track in range(tracks):
+            maps.extend(['-map', f'[a{track}]'])
+        return ['-filter_complex', graph] + maps
+
+    x264_args = [
+        '-c:v', 'libx264',
+        '-preset', preset,
+        '-pix_fmt', 'yuv420p',
+        '-crf', str(crf),
+    ]
+    if decimate:
+        video_output = decimate_args(fps) + x264_args
+    else:
+        video_output = (['-fps_mode', 'vfr'] if vfr else []) + x264_args
+
+    if layout and len(layout) > 1:
+        ffmpeg_cmd = ['ffmpeg', '-y', '-loglevel', 'error']
+        for index in range(len(layout)):
+            ffmpeg_cmd.extend(['-i', f'{{video{index or ""}}}'])
+        ffmpeg_cmd.extend(audio_input)
+        streams = ''.join(f'[{index}:v]' for index in range(len(layout)))
+        positions = '|'.join(f'{x}_{y}' for x, y in layout)
+        ffmpeg_cmd.extend([
+            '-filter_complex',
+            f'{streams}xstack=inputs={len(layout)}:layout={positions}:fill=black[v]',
+            '-map', '[v]',
+        ])
+        ffmpeg_cmd.extend(audio_map(len(layout)))
+        ffmpeg_cmd.extend(x264_args + audio_output + [output])
+        return [[{'command': ffmpeg_cmd, 'duration': duration}]], {}
+
+    if parts and len(parts) > 1:
+        # The durations keep every part in place on the timeline even when
+        # repeated frames were dropped from its end
+        width, height = size
+        ffmpeg_cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+                      '-f', 'concat', '-safe', '0', '-i', '{job}/parts.txt'] + audio_input
+        ffmpeg_cmd.extend(['-map', '0:v'] + audio_map(1))
+        ffmpeg_cmd.extend(['-vf', f'scale={width}:{height}', '-fps_mode', 'vfr'])
+        ffmpeg_cmd.extend(x264_args + audio_output + [output])
+        parts_list = ''.join(f"file '{name}'\nduration {count / fps:.6f}\n"
+                             for name, count in parts)
+        return [[{'command': ffmpeg_cmd, 'duration': duration}]], {'parts.txt': parts_list}
+
+    if not reencode or chunks <= 1 or vfr:
+        ffmpeg_cmd = ['ffmpeg', '-y', '-loglevel', 'error'] + video_input + audio_input
+        ffmpeg_cmd.extend(['-map', '0:v'] + audio_map(1))
+        # Already encoded video is only copied into the final container
+        ffmpeg_cmd.extend(video_output if reencode else ['-c:v', 'copy'])
+        ffmpeg_cmd.extend(audio_output + cut)
+        ffmpeg_cmd.append(output)
+        return [[{'command': ffmpeg_cmd, 'duration': duration}]], {}
+
+    # Share the cores between the chunk encoders instead of oversubscribing them
+    threads = max(1, (os.cpu_count() or 1) // chunks)
+    encode_stage = []
+    concat_list = []
+    for index, (first, count) in enumerate(chunk_ranges(frames, chunks)):
+        ffmpeg_cmd = ['ffmpeg', '-y', '-loglevel', 'error']
+        first += start_frame or 0
+        if first:
+            # Accurate seeking rounds to the nearest frame, so the exact time
+            # of `first` is safe; a half-frame offset would land on the edge
+            ffmpeg_cmd.extend(['-ss', f'{first / fps:.6f}'])
+        ffmpeg_cmd.extend(list(video_format) + ['-i', '{video}', '-frames:v', str(count), '-an'])
+        ffmpeg_cmd.extend(video_output)
+        ffmpeg_cmd.extend(['-threads', str(threads), f'{{job}}/chunk_{index:03d}.mp4'])
+        encode_stage.append({'command': ffmpeg_cmd, 'duration': count / fps})
+        # The nominal duration keeps later chunks in place even when
+        # decimation dropped frames at the end of this one
+        concat_list.append(f"file 'chunk_{index:03d}.mp4'\nduration {count / fps:.6f}\n")
+
+    ffmpeg_cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+                  '-f', 'concat', '-safe', '0', '-i', '{job}/chunks.txt'] + audio_input
+    ffmpeg_cmd.extend(['-map', '0:v'] + audio_map(1))
+    ffmpeg_cmd.extend(['-c:v', 'copy'] + audio_output + cut + [output])
+    return [encode_stage, [{'command': ffmpeg_cmd, 'duration': None}]], \
+        {'chunks.txt': ''.join(concat_list)}
@@ -0,0 +1,22 @@
+"""Stand-ins for heavy modules that are imported on first use"""
+import importlib
+
+
+class LazyModule:
+    """Stand-in for a heavy module that is imported on first attribute access
+
+    On first use the real module replaces the stand-in in the namespace it
+    was bound in, so later lookups cost nothing extra:
+
+        np = LazyModule('numpy', 'np', globals())
+    """
+
+    def __init__(self, module_name, alias, namespace):
+        self._module_name = module_name
+        self._alias = alias
+        self._namespace = namespace
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._module_name)
+        self._namespace[self._alias] = module
+        return getattr(module, attr)
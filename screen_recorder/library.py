@@ -0,0 +1,511 @@
+"""SQLite index of finished recordings, with metadata and thumbnails"""
+import math
+import sqlite3
+import time
+import struct
+from datetime import datetime
+import threading
+from collections import deque
+import os
+import re
+import subprocess
+
+from .lazy import LazyModule
+from .encoding import FFmpegStreamWriter
+from .replay import child_boxes
+
+np = LazyModule('numpy', 'np', globals())
+sf = LazyModule('soundfile', 'sf', globals())
+
+
+def _read_moov(f):
+    """Payload of the moov box, seeking past everything else (mdat)"""
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        if box_type == b'moov':
+            return f.read(size - header_size) if size else f.read()
+        if size < header_size:
+            return None
+        f.seek(size - header_size, os.SEEK_CUR)
+
+
+def probe_mp4(path):
+    """Duration, picture size, codecs and keyframe table of an MP4 file
+
+    Only the moov box is read, the media data is skipped. frames counts the
+    video samples, keyframes lists (seconds, byte offset) of every video
+    sync sample in decode order.
+    Fragmented files have no sample tables, their keyframe list is empty.
+    """
+    with open(path, 'rb') as f:
+        moov = _read_moov(f)
+    if moov is None:
+        raise ValueError("No moov box, not an MP4 file or not finished")
+    info = {'duration': None, 'width': None, 'height': None, 'fps': None, 'frames': None,
+            'video_codec': None, 'audio_codec': None, 'sample_rate': None, 'channels': None,
+            'keyframes': []}
+    boxes = {box[0]: box for box in child_boxes(moov, 0, len(moov))}
+    if b'mvhd' in boxes:
+        start = boxes[b'mvhd'][1]
+        if moov[start]:
+            timescale, duration = struct.unpack_from('>IQ', moov, start + 20)
+        else:
+            timescale, duration = struct.unpack_from('>II', moov, start + 12)
+        if timescale and duration:
+            info['duration'] = duration / timescale
+
+    for box_type, start, end in child_boxes(moov, 0, len(moov)):
+        if box_type != b'trak':
+            continue
+        mdia = next((box for box in child_boxes(moov, start, end) if box[0] == b'mdia'), None)
+        if mdia is None:
+            continue
+        media = {box[0]: box for box in child_boxes(moov, mdia[1], mdia[2])}
+        if b'hdlr' not in media or b'mdhd' not in media or b'minf' not in media:
+            continue
+        handler = moov[media[b'hdlr'][1] + 8:media[b'hdlr'][1] + 12]
+        mdhd = media[b'mdhd'][1]
+        if moov[mdhd]:
+            timescale, track_duration = struct.unpack_from('>IQ', moov, mdhd + 20)
+        else:
+            timescale, track_duration = struct.unpack_from('>II', moov, mdhd + 12)
+        stbl = next((box for box in child_boxes(moov, *media[b'minf'][1:])
+                     if box[0] == b'stbl'), None)
+        if stbl is None:
+            continue
+        tables = {box[0]: box for box in child_boxes(moov, stbl[1], stbl[2])}
+        stsd = tables.get(b'stsd')
+        if stsd is None or not struct.unpack_from('>I', moov, stsd[1] + 4)[0]:
+            continue
+        # First sample entry: size, format, then the format's fields
+        entry = stsd[1] + 8
+        codec = moov[entry + 4:entry + 8].decode('latin-1').strip()
+        fields = entry + 8
+
+        if handler == b'soun' and info['audio_codec'] is None:
+            info['audio_codec'] = codec
+            info['channels'] = struct.unpack_from('>H', moov, fields + 16)[0]
+            info['sample_rate'] = struct.unpack_from('>I', moov, fields + 24)[0] >> 16
+        elif handler == b'vide' and info['video_codec'] is None:
+            info['video_codec'] = codec
+            info['width'], info['height'] = struct.unpack_from('>HH', moov, fields + 24)
+            if not timescale:
+                continue
+            if info['duration'] is None and track_duration:
+                info['duration'] = track_duration / timescale
+            stts = tables.get(b'stts')
+            if stts is None:
+                continue
+            count = struct.unpack_from('>I', moov, stts[1] + 4)[0]
+            stts = np.frombuffer(moov, dtype='>u4', count=2 * count,
+                                 offset=stts[1] + 8).reshape(-1, 2).astype(np.int64)
+            deltas = np.repeat(stts[:, 1], stts[:, 0])
+            if not len(deltas):
+                continue
+            info['frames'] = len(deltas)
+            if track_duration:
+                info['fps'] = len(deltas) * timescale / track_duration
+            times = np.concatenate(([0], np.cumsum(deltas)[:-1])) / timescale
+            info['keyframes'] = _keyframe_offsets(moov, tables, times)
+    return info
+
+
+def _keyframe_offsets(data, tables, times):
+    """(seconds, byte offset) of the sync samples of a track's sample tables"""
+    samples = len(times)
+    if b'stss' in tables:
+        start = tables[b'stss'][1]
+        count = struct.unpack_from('>I', data, start + 4)[0]
+        sync = np.frombuffer(data, dtype='>u4', count=count, offset=start + 8).astype(np.int64) - 1
+    else:
+        sync = np.arange(samples)
+    if b'stsz' not in tables or b'stsc' not in tables or \
+            not (b'stco' in tables or b'co64' in tables):
+        return [(float(times[index]), None) for index in sync]
+
+    start = tables[b'stsz'][1]
+    size, count = struct.unpack_from('>II', data, start + 4)
+    sizes = (np.full(count, size, dtype=np.int64) if size else
+             np.frombuffer(data, dtype='>u4', count=count, offset=start + 12).astype(np.int64))
+    if b'co64' in tables:
+        start = tables[b'co64'][1]
+        count = struct.unpack_from('>I', data, start + 4)[0]
+        chunk_offsets = np.frombuffer(data, dtype='>u8', count=count, offset=start + 8)
+    else:
+        start = tables[b'stco'][1]
+        count = struct.unpack_from('>I', data, start + 4)[0]
+        chunk_offsets = np.frombuffer(data, dtype='>u4', count=count, offset=start + 8)
+    chunk_offsets = chunk_offsets.astype(np.int64)
+    start = tables[b'stsc'][1]
+    count = struct.unpack_from('>I', data, start + 4)[0]
+    stsc = np.frombuffer(data, dtype='>u4', count=3 * count,
+                         offset=start + 8).reshape(-1, 3).astype(np.int64)
+
+    # Samples per chunk: every stsc entry holds until the next one's first chunk
+    chunks = len(chunk_offsets)
+    runs = np.diff(np.append(stsc[:, 0] - 1, chunks))
+    per_chunk = np.repeat(stsc[:, 1], runs)
+    chunk_of_sample = np.repeat(np.arange(chunks), per_chunk)[:len(sizes)]
+    first_of_chunk = np.concatenate(([0], np.cumsum(per_chunk)[:-1]))
+    size_before = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    offsets = (chunk_offsets[chunk_of_sample]
+               + size_before - size_before[first_of_chunk[chunk_of_sample]])
+    sync = sync[sync < min(samples, len(offsets))]
+    return [(float(times[index]), int(offsets[index])) for index in sync]
+
+
+def recording_time(name):
+    """Start time encoded in a recording's file name, e.g. recording_20240101_120000.mp4"""
+    match = re.search(r'(\d{8}_\d{6})', name)
+    if match is None:
+        return None
+    try:
+        return datetime.strptime(match.group(1), "%Y%m%d_%H%M%S").timestamp()
+    except ValueError:
+        return None
+
+
+def thumbnail_commands(path, info, keyframes, thumbnail, contact_sheet, width=320, tiles=16):
+    """FFmpeg commands for a recording's thumbnail and contact sheet
+
+    The thumbnail is the keyframe at about a tenth of the recording, so
+    only one frame is decoded. The sheet shows up to `tiles` frames evenly
+    spread over the recording, picked from the keyframes alone (decoding
+    nothing else) when there are enough of them. An audio file gets a
+    waveform as thumbnail and no sheet.
+    """
+    base = ['ffmpeg', '-y', '-loglevel', 'error']
+    if not info.get('video_codec'):
+        return [base + ['-i', path, '-filter_complex',
+                        f'showwavespic=s={width}x{width // 3}:split_channels=1',
+                        '-frames:v', '1', '-update', '1', thumbnail]]
+
+    at = max((time for time, offset in keyframes
+              if time <= (info.get('duration') or 0) / 10), default=0.0)
+    commands = [base + ['-ss', f'{at:.3f}', '-i', path, '-an', '-frames:v', '1',
+                        '-vf', f'scale={width}:-2', '-update', '1', thumbnail]]
+
+    use_keyframes = len(keyframes) >= tiles
+    units = len(keyframes) if use_keyframes else info.get('frames') or 0
+    # A square grid that is filled completely, the tile filter only writes full grids
+    side = int(math.sqrt(min(tiles, units)))
+    if side:
+        picks = [index * units // (side * side) for index in range(side * side)]
+        select = '+'.join(f'eq(n,{pick})' for pick in picks)
+        commands.append(base + (['-skip_frame', 'nokey'] if use_keyframes else []) +
+                        ['-i', path, '-an', '-frames:v', '1',
+                         '-vf', f"select='{select}',scale={width * 3 // 4}:-2,tile={side}x{side}",
+                         '-update', '1', contact_sheet])
+    return commands
+
+
+class RecordingLibrary:
+    """SQLite index of the recordings in a directory, with thumbnails
+
+    The index lives in DIR_NAME inside the directory, next to the JPEG
+    thumbnails and contact sheets. Files are probed without FFmpeg (MP4
+    sample tables, WAV headers), and only again when their size or
+    modification time changes, so opening the library costs one directory
+    listing. A worker thread indexes queued files first and makes missing
+    thumbnails after that. watch() polls the directory and picks up new,
+    changed and removed files once they have stopped changing. on_change()
+    is called from the worker after every change to the index, and
+    on_error(title, message) when a file could not be worked on.
+    """
+
+    DIR_NAME = ".recordings"
+    INDEX_FILE = "index.sqlite"
+    EXTENSIONS = (".mp4", ".wav")
+    SETTLE_SECONDS = 2.0  # Younger files are only indexed once a second scan sees them unchanged
+    COLUMNS = ('name', 'size', 'mtime', 'created', 'duration', 'width', 'height', 'fps', 'frames',
+               'video_codec', 'audio_codec', 'sample_rate', 'channels', 'error')
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS recordings (
+            name TEXT PRIMARY KEY, size INTEGER, mtime REAL, created REAL,
+            duration REAL, width INTEGER, height INTEGER, fps REAL, frames INTEGER,
+            video_codec TEXT, audio_codec TEXT, sample_rate INTEGER, channels INTEGER,
+            error TEXT, thumbnail TEXT, contact_sheet TEXT);
+        CREATE INDEX IF NOT EXISTS recordings_created ON recordings (created);
+        CREATE TABLE IF NOT EXISTS keyframes (name TEXT, time REAL, offset INTEGER);
+        CREATE INDEX IF NOT EXISTS keyframes_name ON keyframes (name, time);
+    """
+
+    def __init__(self, directory, on_change=None, on_error=None):
+        self.directory = str(directory)
+        self.index_dir = os.path.join(self.directory, self.DIR_NAME)
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.on_change = on_change or (lambda: None)
+        self.on_error = on_error or (lambda title, message: None)
+        self._db = sqlite3.connect(os.path.join(self.index_dir, self.INDEX_FILE),
+                                   check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(self.SCHEMA)
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._queued = set()
+        self._thumbnails = deque()
+        self._busy = False
+        self._seen = {}  # name -> (size, mtime) at the last scan
+        self._running = False
+        self._worker_thread = None
+        self._watch_thread = None
+
+    def start(self):
+        """Start the worker, resuming thumbnails an earlier run did not finish"""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        with self._lock:
+            names = [row[0] for row in self._db.execute(
+                "SELECT name FROM recordings WHERE thumbnail IS NULL AND error IS NULL")]
+        with self._cond:
+            self._thumbnails.extend(names)
+        self._worker_thread = threading.Thread(target=self._work, daemon=True)
+        self._worker_thread.start()
+
+    def watch(self, interval=2.0):
+        """Scan the directory now and then every interval seconds"""
+        self.start()
+        if self._watch_thread is None:
+            self._watch_thread = threading.Thread(target=self._watch, args=(interval,),
+                                                  daemon=True)
+            self._watch_thread.start()
+
+    def close(self, wait=False):
+        """Stop the threads; with wait=True after the queued work is done"""
+        if wait:
+            self.wait()
+        with self._cond:
+            self._running = False
+            self._queue.clear()
+            self._queued.clear()
+            self._thumbnails.clear()
+            self._cond.notify_all()
+        for thread in (self._worker_thread, self._watch_thread):
+            if thread is not None:
+                thread.join()
+        self._worker_thread = self._watch_thread = None
+        with self._lock:
+            self._db.close()
+
+    def wait(self, thumbnails=True, timeout=None):
+        """Block until the queued files (and thumbnails) are done; False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._running or not (
+                    self._queue or self._busy or (thumbnails and self._thumbnails)), timeout)
+
+    def add(self, path):
+        """Queue a file of the directory for (re)indexing, e.g. a finished recording"""
+        name = os.path.basename(path)
+        with self._cond:
+            if name in self._queued:
+                return False
+            self._queued.add(name)
+            self._queue.append(name)
+            self._cond.notify_all()
+        return True
+
+    def scan(self):
+        """Queue new and changed files and forget removed ones; returns (queued, removed)"""
+        files = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.lower().endswith(self.EXTENSIONS) and entry.is_file():
+                stat_result = entry.stat()
+                files[entry.name] = (stat_result.st_size, stat_result.st_mtime)
+        with self._lock:
+            indexed = {row[0]: (row[1], row[2])
+                       for row in self._db.execute("SELECT name, size, mtime FROM recordings")}
+        now = time.time()
+        queued = 0
+        for name, signature in files.items():
+            if indexed.get(name) == signature:
+                continue
+            # A file that is still being written changes between two scans
+            if signature == self._seen.get(name) or now - signature[1] > self.SETTLE_SECONDS:
+                queued += self.add(name)
+        removed = [name for name in indexed if name not in files]
+        if removed:
+            self._remove(removed)
+        self._seen = files
+        return queued, len(removed)
+
+    def count(self, search=None):
+        """Number of indexed recordings whose name contains search"""
+        query, params = self._filter(search)
+        with self._lock:
+            return self._db.execute(f"SELECT COUNT(*) FROM recordings{query}", params).fetchone()[0]
+
+    def page(self, offset=0, limit=200, search=None):
+        """Indexed recordings as dicts, newest first"""
+        query, params = self._filter(search)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT * FROM recordings{query} ORDER BY created DESC, name LIMIT ? OFFSET ?",
+                params + [limit, offset]).fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, name):
+        """The index entry of one file as a dict, or None"""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM recordings WHERE name = ?",
+                                   (os.path.basename(name),)).fetchone()
+        return dict(row) if row is not None else None
+
+    def keyframes(self, name):
+        """(seconds, byte offset) of a recording's keyframes"""
+        with self._lock:
+            return [tuple(row) for row in self._db.execute(
+                "SELECT time, offset FROM keyframes WHERE name = ? ORDER BY time",
+                (os.path.basename(name),))]
+
+    def keyframe_before(self, name, seconds):
+        """(seconds, byte offset) of the last keyframe at or before a time, for seeking"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT time, offset FROM keyframes WHERE name = ? AND time <= ? "
+                "ORDER BY time DESC LIMIT 1", (os.path.basename(name), seconds)).fetchone()
+        return tuple(row) if row is not None else (0.0, None)
+
+    def image_path(self, entry, kind='thumbnail'):
+        """Path of an entry's 'thumbnail' or 'contact_sheet', None if there is none"""
+        name = entry.get(kind)
+        return os.path.join(self.index_dir, name) if name else None
+
+    @staticmethod
+    def _filter(search):
+        """WHERE clause and parameters for names containing search"""
+        if not search:
+            return "", []
+        return " WHERE name LIKE ? ESCAPE '\\'", [
+            "%" + re.sub(r'([%_\\])', r'\\\1', search) + "%"]
+
+    def _watch(self, interval):
+        """Rescan the directory until close()"""
+        while self._running:
+            try:
+                self.scan()
+            except OSError:
+                pass  # The directory may be gone for a moment, e.g. an unmounted drive
+            with self._cond:
+                self._cond.wait_for(lambda: not self._running, interval)
+
+    def _work(self):
+        """Index queued files, then make missing thumbnails"""
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: not self._running or self._queue or self._thumbnails)
+                if not self._running:
+                    return
+                if self._queue:
+                    name, task = self._queue.popleft(), self._index
+                    self._queued.discard(name)
+                else:
+                    name, task = self._thumbnails.popleft(), self._make_thumbnails
+                self._busy = True
+            try:
+                task(name)
+            except Exception as e:
+                self.on_error("Library Error", f"Could not index {name}: {str(e)}")
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+            self.on_change()
+
+    def _index(self, name):
+        """Probe a file and replace its index entry and keyframes"""
+        path = os.path.join(self.directory, name)
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            self._remove([name])
+            return
+        entry = dict.fromkeys(self.COLUMNS)
+        entry.update(name=name, size=stat_result.st_size, mtime=stat_result.st_mtime,
+                     created=recording_time(name) or stat_result.st_mtime)
+        keyframes = []
+        try:
+            if name.lower().endswith('.wav'):
+                info = sf.info(path)
+                entry.update(duration=info.duration, sample_rate=info.samplerate,
+                             channels=info.channels, audio_codec=info.subtype.lower())
+            else:
+                info = probe_mp4(path)
+                keyframes = info.pop('keyframes')
+                entry.update(info)
+        except Exception as e:
+            # Kept with the error, so it is not probed again until it changes
+            entry['error'] = str(e) or type(e).__name__
+        with self._lock, self._db:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO recordings ({', '.join(self.COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                [entry[column] for column in self.COLUMNS])
+            self._db.execute("DELETE FROM keyframes WHERE name = ?", (name,))
+            self._db.executemany("INSERT INTO keyframes VALUES (?, ?, ?)",
+                                 [(name, time, offset) for time, offset in keyframes])
+        if entry['error'] is None:
+            with self._cond:
+                self._thumbnails.append(name)
+
+    def _make_thumbnails(self, name):
+        """Render a file's thumbnail and contact sheet; '' marks one that cannot be made"""
+        entry = self.get(name)
+        if entry is None or entry['error'] or entry['thumbnail'] is not None:
+            return
+        images = {'thumbnail': f"{name}.jpg", 'contact_sheet': f"{name}_sheet.jpg"}
+        results = dict.fromkeys(images, '')
+        if FFmpegStreamWriter.is_available():
+            paths = {kind: os.path.join(self.index_dir, image) for kind, image in images.items()}
+            for command in thumbnail_commands(os.path.join(self.directory, name), entry,
+                                              self.keyframes(name), paths['thumbnail'],
+                                              paths['contact_sheet']):
+                subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+            for kind, path in paths.items():
+                if os.path.exists(path):
+                    results[kind] = images[kind]
+        with self._lock, self._db:
+            # Only if the file was not re-indexed meanwhile
+            self._db.execute(
+                "UPDATE recordings SET thumbnail = ?, contact_sheet = ? "
+                "WHERE name = ? AND mtime = ?",
+                (results['thumbnail'], results['contact_sheet'], name, entry['mtime']))
+
+    def _remove(self, names):
+        """Forget files that are gone, with their keyframes and images"""
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM recordings WHERE name = ?",
+                                 [(name,) for name in names])
+            self._db.executemany("DELETE FROM keyframes WHERE name = ?",
+                                 [(name,) for name in names])
+        for name in names:
+            for image in (f"{name}.jpg", f"{name}_sheet.jpg"):
+                try:
+                    os.remove(os.path.join(self.index_dir, image))
+                except OSError:
+                    pass
+        self.on_change()
+
+
+def describe_recording(entry):
+    """Date, length, picture size and file size of a library entry as display strings"""
+    created = datetime.fromtimestamp(entry['created']).strftime("%Y-%m-%d %H:%M:%S")
+    duration = f"{entry['duration']:.1f}s" if entry['duration'] else ""
+    if entry['width']:
+        picture = f"{entry['width']}x{entry['height']}"
+    else:
+        picture = "audio" if entry['audio_codec'] else ""
+    return created, duration, picture, f"{entry['size'] / (1024 * 1024):.1f} MB"
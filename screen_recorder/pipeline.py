@@ -0,0 +1,806 @@
+"""The capture, convert and encode stages and their scheduling"""
+import csv
+import time
+import sys
+import threading
+from collections import deque
+import os
+
+from .lazy import LazyModule
+from .session import write_json
+from .encoding import quality_encoder_settings
+from .capture import frame_shape, even_frame_size, convert_color
+
+cv2 = LazyModule('cv2', 'cv2', globals())
+np = LazyModule('numpy', 'np', globals())
+
+
+class FrameRing:
+    """Bounded ring of preallocated, reusable frame buffers between two pipeline stages
+
+    A producer acquires a free slot, fills buffers[slot] in place and commits it;
+    a consumer acquires the oldest committed slot and releases it when done.
+    When every slot is busy the backpressure policy decides what happens:
+    "drop_oldest" recycles the oldest frame that has not been consumed yet,
+    "drop_newest" makes the producer skip the new frame, and "block" waits.
+    """
+
+    POLICIES = ("drop_oldest", "drop_newest", "block")
+
+    def __init__(self, slots, shape, dtype='uint8', policy="drop_oldest"):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {policy}")
+        self.policy = policy
+        self.buffers = [np.empty(shape, dtype=dtype) for _ in range(slots)]
+        self.timestamps = [0.0] * slots
+        self.indices = [0] * slots
+        self.dropped = 0
+        self.closed = False
+        self._free = deque(range(slots))
+        self._ready = deque()
+        self._cond = threading.Condition()
+
+    def acquire_write(self, timeout=None):
+        """Get a free slot to fill, or None if the frame has to be dropped"""
+        with self._cond:
+            while not self._free:
+                if self.closed:
+                    return None
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return None
+                if self.policy == "drop_oldest" and self._ready:
+                    self.dropped += 1
+                    return self._ready.popleft()
+                if not self._cond.wait(timeout):
+                    self.dropped += 1
+                    return None
+            return self._free.popleft()
+
+    def commit(self, slot, timestamp, index):
+        """Hand a filled slot to the consumer"""
+        with self._cond:
+            self.timestamps[slot] = timestamp
+            self.indices[slot] = index
+            self._ready.append(slot)
+            self._cond.notify_all()
+
+    def acquire_read(self, timeout=None):
+        """Get the oldest committed slot, or None once closed and drained"""
+        with self._cond:
+            while not self._ready:
+                if self.closed:
+                    return None
+                if not self._cond.wait(timeout):
+                    return None
+            return self._ready.popleft()
+
+    def release(self, slot):
+        """Return a consumed slot to the free list"""
+        with self._cond:
+            self._free.append(slot)
+            self._cond.notify_all()
+
+    def close(self):
+        """Stop accepting frames; consumers drain what is left and then get None"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def depth(self):
+        """Number of frames waiting for the consumer"""
+        return len(self._ready)
+
+
+class ChangeDetector:
+    """Cheap check whether a frame differs from the previous one
+
+    Each frame is reduced to block averages with cv2.resize(INTER_AREA) into a
+    preallocated buffer, and the max absolute difference against the previous
+    reduction is compared with the threshold.
+    """
+
+    def __init__(self, block=4, threshold=0):
+        self.block = block
+        self.threshold = threshold
+        self._current = None
+        self._previous = None
+        self._has_previous = False
+
+    def changed(self, frame):
+        """Return True if frame differs from the one passed in the last call"""
+        height, width = frame.shape[:2]
+        size = (max(1, width // self.block), max(1, height // self.block))
+        if self._current is None or self._current.shape[:2] != (size[1], size[0]):
+            shape = (size[1], size[0]) + frame.shape[2:]
+            self._current = np.empty(shape, dtype=frame.dtype)
+            self._previous = np.empty(shape, dtype=frame.dtype)
+            self._has_previous = False
+
+        cv2.resize(frame, size, dst=self._current, interpolation=cv2.INTER_AREA)
+        changed = (not self._has_previous or
+                   cv2.norm(self._current, self._previous, cv2.NORM_INF) > self.threshold)
+        self._current, self._previous = self._previous, self._current
+        self._has_previous = True
+        return changed
+
+
+class FrameScheduler:
+    """Paces capture ticks on an absolute time.monotonic_ns grid
+
+    Tick k is due at start_ns + k / fps, so a late frame never pushes later
+    ticks back and the achieved rate converges on the target. Ticks that are
+    already a full interval overdue are not captured in a burst; catch_up
+    decides how they show up in the output:
+    "duplicate" keeps them, the encoder repeats the previous frame (CFR);
+    "drop" removes them, the previous frame simply lasts longer (VFR).
+    Schedulers given the same start_ns tick in step, e.g. for several
+    sources; by default the grid starts with the first wait().
+    """
+
+    CATCH_UP = ("duplicate", "drop")
+
+    def __init__(self, fps, catch_up="duplicate", start_ns=None):
+        if catch_up not in self.CATCH_UP:
+            raise ValueError(f"Unknown catch-up policy: {catch_up}")
+        self.fps = fps
+        self.catch_up = catch_up
+        self.start_ns = start_ns
+        self.next_tick = 0
+        self.ticks_missed = 0
+        self.frames = 0
+        self.last_ns = None
+        self._lateness_sum = 0
+        self._lateness_sq_sum = 0
+        self._lateness_max = 0
+
+    def due_ns(self, tick):
+        """Absolute monotonic time at which a tick is due"""
+        return self.start_ns + int(tick * 1_000_000_000 / self.fps)
+
+    def wait(self):
+        """Sleep until the next tick is due and return (tick, due_ns)"""
+        now = time.monotonic_ns()
+        if self.start_ns is None:
+            self.start_ns = now
+        due = self.due_ns(self.next_tick)
+        if now < due:
+            time.sleep((due - now) / 1e9)
+        else:
+            # Skip straight to the most recent tick instead of bursting
+            behind = int((now - due) * self.fps / 1_000_000_000)
+            if behind:
+                self.ticks_missed += behind
+                self.next_tick += behind
+                due = self.due_ns(self.next_tick)
+        tick = self.next_tick
+        self.next_tick += 1
+        return tick, due
+
+    def record(self, due_ns, captured_ns):
+        """Account for a captured frame, for the FPS and jitter report"""
+        lateness = captured_ns - due_ns
+        self.frames += 1
+        self.last_ns = captured_ns
+        self._lateness_sum += lateness
+        self._lateness_sq_sum += lateness * lateness
+        self._lateness_max = max(self._lateness_max, lateness)
+
+    def stats(self):
+        """Target vs achieved FPS and capture jitter in milliseconds"""
+        if not self.frames or self.last_ns is None:
+            return {'target_fps': self.fps, 'achieved_fps': 0.0, 'ticks_missed': 0,
+                    'jitter_mean_ms': 0.0, 'jitter_std_ms': 0.0, 'jitter_max_ms': 0.0}
+        elapsed = (self.last_ns - self.start_ns) / 1e9
+        mean = self._lateness_sum / self.frames
+        variance = max(0.0, self._lateness_sq_sum / self.frames - mean * mean)
+        return {
+            'target_fps': self.fps,
+            'achieved_fps': (self.frames - 1) / elapsed if elapsed > 0 else 0.0,
+            'ticks_missed': self.ticks_missed,
+            'jitter_mean_ms': mean / 1e6,
+            'jitter_std_ms': variance ** 0.5 / 1e6,
+            'jitter_max_ms': self._lateness_max / 1e6,
+        }
+
+
+class LatencyHistogram:
+    """Log-scale latency histogram with constant-time record()
+
+    Buckets are a quarter octave wide (about 19%) starting at 1 us;
+    percentiles report a bucket's upper edge, capped at the maximum seen,
+    so they never look better than the measurements.
+    """
+
+    SUB_BUCKETS = 4
+    OCTAVES = 40  # 1 us up to ~12 days
+
+    def __init__(self):
+        self.counts = [0] * (self.SUB_BUCKETS * self.OCTAVES)
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, ns):
+        """Add one latency in nanoseconds"""
+        units = max(1, ns >> 10)
+        octave = units.bit_length() - 1
+        if octave >= 2:
+            sub = (units >> (octave - 2)) & 3
+        else:
+            sub = (units << (2 - octave)) & 3
+        index = min(octave * self.SUB_BUCKETS + sub, len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    def copy(self):
+        """Independent copy, e.g. to subtract later with since()"""
+        other = LatencyHistogram()
+        other.counts = list(self.counts)
+        other.count, other.total_ns, other.max_ns = self.count, self.total_ns, self.max_ns
+        return other
+
+    def since(self, earlier):
+        """Histogram of what was recorded after the copy `earlier` was taken"""
+        other = LatencyHistogram()
+        other.counts = [now - then for now, then in zip(self.counts, earlier.counts)]
+        other.count = self.count - earlier.count
+        other.total_ns = self.total_ns - earlier.total_ns
+        # The maximum of an interval is unknown, its largest bucket edge stands in
+        other.max_ns = self.max_ns
+        return other
+
+    def percentile(self, q):
+        """Latency in ms below which a fraction q of the measurements lie"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                octave, sub = divmod(index, self.SUB_BUCKETS)
+                upper = (self.SUB_BUCKETS + sub + 1) * 2.0 ** (octave - 2) * 1024
+                return min(upper, self.max_ns) / 1e6
+        return self.max_ns / 1e6
+
+    def summary(self):
+        """Count, mean, percentiles and maximum in milliseconds"""
+        return {
+            'count': self.count,
+            'mean_ms': self.total_ns / self.count / 1e6 if self.count else 0.0,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': self.max_ns / 1e6,
+        }
+
+
+def current_rss_mb():
+    """Resident set size of this process in MB, the peak where the current one is unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+
+class PipelineMetrics:
+    """Latency histograms of the recording stages and a once-a-second gauge series
+
+    Stages add their latencies with record(stage, ns) from their own
+    threads. sample(gauges, rates) appends a row of gauges (queue depths,
+    counters), the per-second increase of the running totals in rates
+    (e.g. frames -> FPS), the CPU use and RSS of this process and the p99
+    latency of every stage in that interval. CPU and RSS leave out capture
+    worker processes. Nothing creates one unless metrics are
+    enabled and the stages only test `metrics is not None`, so disabled
+    metrics cost one comparison per frame.
+    """
+
+    FORMATS = ("json", "csv")
+
+    def __init__(self):
+        self.histograms = {}
+        self.samples = []
+        self.started = time.monotonic()
+        self._cpu = (self.started, time.process_time())
+        self._previous = {}
+        self._totals = {}
+
+    def record(self, stage, ns):
+        """Add a latency in nanoseconds to a stage's histogram"""
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms.setdefault(stage, LatencyHistogram())
+        histogram.record(ns)
+
+    def sample(self, gauges, rates=None):
+        """Append and return a row: gauges, rates, CPU %, RSS and interval p99 per stage"""
+        now, cpu = time.monotonic(), time.process_time()
+        wall = now - self._cpu[0]
+        row = {'time_s': round(now - self.started, 3)}
+        row.update(gauges)
+        for name, total in (rates or {}).items():
+            increase = total - self._totals.get(name, 0)
+            row[name] = increase / wall if wall > 0 else 0.0
+            self._totals[name] = total
+        row['cpu_percent'] = (cpu - self._cpu[1]) * 100 / wall if wall > 0 else 0.0
+        row['rss_mb'] = current_rss_mb()
+        self._cpu = (now, cpu)
+        for stage, histogram in list(self.histograms.items()):
+            earlier = self._previous.get(stage)
+            interval = histogram.since(earlier) if earlier is not None else histogram
+            row[f'{stage}_p99_ms'] = interval.percentile(0.99)
+            self._previous[stage] = histogram.copy()
+        self.samples.append(row)
+        return row
+
+    def snapshot(self):
+        """Latency summary per stage and the latest gauges"""
+        return {
+            'latency': {stage: histogram.summary()
+                        for stage, histogram in list(self.histograms.items())},
+            'gauges': self.samples[-1] if self.samples else {},
+        }
+
+    def write(self, path, format="json", totals=None):
+        """Write the metrics to path: everything as JSON, or the gauge series as CSV"""
+        if format == "csv":
+            columns = []
+            for row in self.samples:
+                columns += [name for name in row if name not in columns]
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=columns)
+                writer.writeheader()
+                writer.writerows(self.samples)
+        else:
+            write_json(path, {**self.snapshot(), 'totals': totals or {},
+                              'samples': self.samples})
+        return path
+
+
+class PreviewTap:
+    """Latest downscaled RGB frame for the GUI preview
+
+    A producer thread offers frames; only every Nth one is downscaled with
+    cv2.resize(INTER_AREA) and published. The GUI polls latest() from the Tk
+    thread. Clearing enabled makes offer() a no-op, e.g. while minimized.
+    """
+
+    def __init__(self, width=380, every=1):
+        self.width = width
+        self.every = every
+        self.enabled = True
+        self.sequence = 0
+        self._frame = None
+        self._offered = 0
+        self._lock = threading.Lock()
+
+    def offer(self, frame, pixel_format):
+        """Publish a downscaled copy of frame if it is due"""
+        if not self.enabled:
+            return
+        self._offered += 1
+        if (self._offered - 1) % self.every:
+            return
+        height = max(1, int(self.width * frame.shape[0] / frame.shape[1]))
+        small = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        small = convert_color(small, pixel_format, "RGB")
+        with self._lock:
+            self._frame = small
+            self.sequence += 1
+
+    def latest(self):
+        """Return (sequence, frame); the sequence changes with every new frame"""
+        with self._lock:
+            return self.sequence, self._frame
+
+
+class CapturePipeline:
+    """Capture -> color convert -> encode, each stage on its own thread
+
+    Stages are joined by FrameRings so a slow encoder only fills the rings
+    instead of delaying the next capture. The convert stage turns a captured
+    frame into the writer's pixel_format (BGR by default, I420 for FFmpeg)
+    in one pass, straight into a preallocated slot, cropping it to the
+    writer's frame_size. Every frame carries the index of the capture tick
+    it belongs to; ticks without a frame (unchanged screen or a dropped
+    frame) are filled by writing the previous frame again, which keeps the
+    output timeline in step with the wall clock. With catch_up="drop" and
+    a writer that takes the tick of every frame (vfr = True) they are left
+    out instead and the previous frame simply lasts longer; a writer
+    without timestamps, such as cv2.VideoWriter, still gets the repeats.
+
+    A RateController throttles the pipeline through set_rate(): a stride
+    captures only every Nth tick, and with reopen_writer(frame_size, preset)
+    a smaller scale or another preset switches to a new writer at the
+    first frame converted with it. part_frames counts the ticks (repeats
+    and held ticks included) that went to each writer; a VFR writer's
+    ticks count from the first one it got. With a PipelineMetrics every
+    stage records how long it took per frame. A writer with timestamped =
+    True (a FrameSpool) also gets the capture time of every frame it writes.
+    """
+
+    def __init__(self, backend, writer, fps, policy="drop_oldest", ring_slots=6,
+                 detector=None, preview=None, catch_up="duplicate", reopen_writer=None,
+                 start_ns=None, metrics=None):
+        self.backend = backend
+        self.metrics = metrics
+        self.writer = writer
+        self.reopen_writer = reopen_writer
+        self.fps = fps
+        self.scheduler = FrameScheduler(fps, catch_up, start_ns)
+        self.detector = detector
+        self.preview = preview
+        size = backend.frame_size()
+        self.out_format = getattr(writer, 'pixel_format', "BGR")
+        self.out_size = getattr(writer, 'frame_size', size)
+        self._timestamped = getattr(writer, 'timestamped', False)
+        self.raw_ring = FrameRing(ring_slots, frame_shape(size, backend.pixel_format),
+                                  policy=policy)
+        self.out_ring = FrameRing(ring_slots, frame_shape(self.out_size, self.out_format),
+                                  policy=policy)
+        self.stride = 1
+        # Encoder settings by generation; every converted frame is tagged with one
+        self._encoders = [(self.out_size, getattr(writer, 'preset', None))]
+        self._slot_encoders = [0] * ring_slots
+        self._scaled = {}
+        self.part_frames = [0]
+        self._retired = []
+        self._grab_ns = 0
+        self._grabs = 0
+        self.ticks = 0
+        self.frames_captured = 0
+        self.frames_throttled = 0
+        self.frames_skipped = 0
+        self.frames_written = 0
+        self.frames_repeated = 0
+        self.frames_held = 0
+        self._vfr = self.scheduler.catch_up == "drop" and getattr(writer, 'vfr', False)
+        self._part_start = 0
+        self.error = None
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        """Start all pipeline stages"""
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._run_stage, args=(self._capture_loop,), daemon=True),
+            threading.Thread(target=self._run_stage, args=(self._convert_loop,), daemon=True),
+            threading.Thread(target=self._run_stage, args=(self._encode_loop,), daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop capturing and wait until every queued frame has been written"""
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        for writer, thread in self._retired:
+            thread.join()
+            if writer.error and self.error is None:
+                self.error = Exception(f"FFmpeg encoder stopped: {writer.error}")
+
+    @property
+    def frames_dropped(self):
+        return self.raw_ring.dropped + self.out_ring.dropped
+
+    @property
+    def start_ns(self):
+        """Monotonic time of tick 0, the start of the video timeline"""
+        return self.scheduler.start_ns
+
+    def stats(self):
+        """Snapshot of the pipeline counters"""
+        return {
+            **self.scheduler.stats(),
+            'captured': self.frames_captured,
+            'written': self.frames_written,
+            'skipped': self.frames_skipped,
+            'throttled': self.frames_throttled,
+            'repeated': self.frames_repeated,
+            'held': self.frames_held,
+            'dropped': self.frames_dropped,
+            'convert_queue': self.raw_ring.depth(),
+            'encode_queue': self.out_ring.depth(),
+        }
+
+    def load(self):
+        """Load signals since the last call: mean grab time, ring fill, drop counters"""
+        grabs, grab_ns = self._grabs, self._grab_ns
+        self._grabs = self._grab_ns = 0
+        slots = len(self.out_ring.buffers)
+        return {
+            'grab_ms': grab_ns / grabs / 1e6 if grabs else 0.0,
+            'queue': max(self.raw_ring.depth(), self.out_ring.depth()) / slots,
+            'dropped': self.frames_dropped,
+            'ticks_missed': self.scheduler.ticks_missed,
+        }
+
+    def set_rate(self, stride=1, scale=1.0, preset=None):
+        """Capture every stride-th tick; scale and preset need reopen_writer"""
+        self.stride = stride
+        if self.reopen_writer is None:
+            return
+        width, height = self.out_size
+        size = even_frame_size((max(2, int(width * scale)), max(2, int(height * scale))))
+        if (size, preset) != self._encoders[-1]:
+            self._encoders.append((size, preset))
+
+    def _run_stage(self, stage):
+        """Run a stage, stopping the whole pipeline if it fails"""
+        try:
+            stage()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+            self._running = False
+            self.raw_ring.close()
+            self.out_ring.close()
+
+    def _capture_loop(self):
+        """Grab frames on the scheduler's tick grid into the raw ring"""
+        try:
+            while self._running:
+                index, due_ns = self.scheduler.wait()
+                if not self._running:
+                    break
+                if index % self.stride:
+                    # Throttled, the encoder repeats the previous frame
+                    self.ticks = index + 1
+                    self.frames_throttled += 1
+                    continue
+
+                captured_ns = time.monotonic_ns()
+                frame = self.backend.grab()
+                grab_ns = time.monotonic_ns() - captured_ns
+                self._grab_ns += grab_ns
+                self._grabs += 1
+                if self.metrics is not None:
+                    self.metrics.record('capture', grab_ns)
+                self.scheduler.record(due_ns, captured_ns)
+                self.ticks = index + 1
+                self.frames_captured += 1
+
+                if self.detector is not None and not self.detector.changed(frame):
+                    # Unchanged screen, the encoder repeats the previous frame
+                    self.frames_skipped += 1
+                else:
+                    slot = self.raw_ring.acquire_write()
+                    if slot is not None:
+                        np.copyto(self.raw_ring.buffers[slot], frame)
+                        self.raw_ring.commit(slot, captured_ns, index)
+        finally:
+            self.backend.close()
+            self.raw_ring.close()
+
+    def _convert_loop(self):
+        """Convert captured frames to the writer's pixel format"""
+        width, height = self.out_size
+        try:
+            while True:
+                slot = self.raw_ring.acquire_read()
+                if slot is None:
+                    break
+                if self.preview is not None:
+                    self.preview.offer(self.raw_ring.buffers[slot], self.backend.pixel_format)
+                out_slot = self.out_ring.acquire_write()
+                if out_slot is not None:
+                    began = time.perf_counter_ns()
+                    # A view, an odd last row/column is simply not read
+                    frame = self.raw_ring.buffers[slot][:height, :width]
+                    encoder = len(self._encoders) - 1
+                    size = self._encoders[encoder][0]
+                    if size != self.out_size:
+                        if size not in self._scaled:
+                            self._scaled[size] = np.empty(
+                                frame_shape(size, self.backend.pixel_format), dtype=np.uint8)
+                        frame = cv2.resize(frame, size, dst=self._scaled[size],
+                                           interpolation=cv2.INTER_AREA)
+                    self._slot_encoders[out_slot] = encoder
+                    convert_color(frame, self.backend.pixel_format, self.out_format,
+                                  dst=self._out_frame(out_slot))
+                    self.out_ring.commit(out_slot, self.raw_ring.timestamps[slot],
+                                         self.raw_ring.indices[slot])
+                    if self.metrics is not None:
+                        self.metrics.record('convert', time.perf_counter_ns() - began)
+                self.raw_ring.release(slot)
+        finally:
+            self.out_ring.close()
+
+    def _out_frame(self, slot):
+        """The part of an output slot that holds a frame at its encoder's size"""
+        size = self._encoders[self._slot_encoders[slot]][0]
+        if size == self.out_size:
+            return self.out_ring.buffers[slot]
+        shape = frame_shape(size, self.out_format)
+        return self.out_ring.buffers[slot].reshape(-1)[:np.prod(shape)].reshape(shape)
+
+    def _encode_loop(self):
+        """Write converted frames to the video writer, filling skipped ticks"""
+        # The last written slot is held back so gaps can be filled from it
+        held_slot = None
+        last_index = -1
+        encoder = 0
+        while True:
+            slot = self.out_ring.acquire_read()
+            if slot is None:
+                break
+            index = self.out_ring.indices[slot]
+            if held_slot is not None:
+                self._repeat(held_slot, index - last_index - 1)
+                self.out_ring.release(held_slot)
+            if self._slot_encoders[slot] != encoder:
+                encoder = self._slot_encoders[slot]
+                self._switch_writer(*self._encoders[encoder])
+                self._part_start = index
+            began = time.perf_counter_ns() if self.metrics is not None else None
+            self._write(slot, index)
+            if began is not None:
+                self.metrics.record('encode', time.perf_counter_ns() - began)
+            self.frames_written += 1
+            self.part_frames[-1] += 1
+            held_slot, last_index = slot, index
+
+        if held_slot is not None:
+            self._repeat(held_slot, self.ticks - last_index - 1)
+            self.out_ring.release(held_slot)
+
+    def _write(self, slot, index=None):
+        """Hand the frame in an output slot to the writer; index is its tick"""
+        if self._vfr:
+            self.writer.write(self._out_frame(slot), index - self._part_start)
+        elif self._timestamped:
+            self.writer.write(self._out_frame(slot), self.out_ring.timestamps[slot])
+        else:
+            self.writer.write(self._out_frame(slot))
+
+    def _switch_writer(self, frame_size, preset):
+        """Continue with a new writer; the old one finishes its file in the background"""
+        retired = self.writer
+        self.writer = self.reopen_writer(frame_size, preset)
+        if not self.writer.isOpened():
+            raise Exception("Failed to create video writer")
+        retired.close_input()
+        thread = threading.Thread(target=retired.release, daemon=True)
+        thread.start()
+        self._retired.append((retired, thread))
+        self.part_frames.append(0)
+
+    def _repeat(self, slot, count):
+        """Write the frame in slot count more times to cover ticks that had no frame
+
+        A VFR writer gets nothing, the frame already lasts until the next one.
+        """
+        if self._vfr:
+            self.frames_held += max(0, count)
+            self.part_frames[-1] += max(0, count)
+            return
+        for _ in range(max(0, count)):
+            self._write(slot)
+            self.frames_repeated += 1
+            self.part_frames[-1] += 1
+
+
+class RateController:
+    """Honors the Quality setting and trades frame rate, scale and preset for load
+
+    Quality (1-100) sets the x264 CRF and the starting preset. update() is
+    called about once a second with CapturePipeline.load(). While the
+    pipeline falls behind (frames dropped, ticks missed, rings filling up
+    or grabs eating most of a frame interval) it goes one step down the
+    ladder: capture every 2nd, 3rd, ... tick, then a smaller capture scale,
+    then a faster preset. After recover_after quiet updates it goes one
+    step back up; a step up that soon has to be undone doubles that wait.
+    Only the knobs the recording can change are used; every change is
+    appended to log.
+    """
+
+    KNOBS = ("stride", "scale", "preset")
+    STRIDES = (2, 3, 4)
+    MIN_FPS = 5
+    SCALES = (0.75, 0.5)
+    PRESETS = ('ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium')
+
+    def __init__(self, fps, quality, knobs=KNOBS, settle=2, recover_after=10):
+        self.fps = fps
+        self.crf, self.preset = quality_encoder_settings(quality)
+        self.settle = settle
+        self.recover_after = recover_after
+        self.steps = []
+        if "stride" in knobs:
+            self.steps.extend(('stride', stride) for stride in self.STRIDES
+                              if fps / stride >= self.MIN_FPS)
+        if "scale" in knobs:
+            self.steps.extend(('scale', scale) for scale in self.SCALES)
+        if "preset" in knobs:
+            faster = self.PRESETS[:self.PRESETS.index(self.preset)]
+            self.steps.extend(('preset', preset) for preset in reversed(faster))
+        self.level = 0
+        self.log = []
+        self._since_change = settle
+        self._quiet = 0
+        self._backoff = 1
+        self._counters = (0, 0)
+        self._start = time.monotonic()
+
+    def settings(self, level=None):
+        """Stride, scale and preset at a ladder level (default: the current one)"""
+        settings = {'stride': 1, 'scale': 1.0, 'preset': self.preset}
+        for knob, value in self.steps[:self.level if level is None else level]:
+            settings[knob] = value
+        return settings
+
+    def describe(self, settings=None):
+        """Human readable settings, e.g. '15 FPS, scale 0.75, preset veryfast'"""
+        settings = settings or self.settings()
+        return (f"{self.fps / settings['stride']:g} FPS, scale {settings['scale']:g}, "
+                f"preset {settings['preset']}")
+
+    def update(self, load):
+        """Take one step down or up the ladder if the load calls for it; True on a change"""
+        dropped = load['dropped'] - self._counters[0]
+        missed = load['ticks_missed'] - self._counters[1]
+        self._counters = (load['dropped'], load['ticks_missed'])
+        self._since_change += 1
+        interval_ms = 1000 * self.settings()['stride'] / self.fps
+
+        reasons = []
+        if dropped:
+            reasons.append(f"{dropped} frames dropped")
+        if missed:
+            reasons.append(f"{missed} ticks missed")
+        if load['queue'] >= 0.5:
+            reasons.append(f"queue {load['queue']:.0%} full")
+        if load['grab_ms'] > 0.8 * interval_ms:
+            reasons.append(f"grab {load['grab_ms']:.1f} ms")
+
+        if reasons:
+            self._quiet = 0
+            # Give the last change time to show an effect before piling on
+            if self._since_change >= self.settle and self.level < len(self.steps):
+                if self.log and self.log[-1]['reason'] == "headroom" and \
+                        self._since_change < self.recover_after:
+                    self._backoff = min(8, self._backoff * 2)
+                return self._change(self.level + 1, ", ".join(reasons))
+            return False
+
+        # Headroom is judged against the faster rate a step up would bring
+        up = self.settings(max(0, self.level - 1))
+        if load['queue'] <= 0.2 and load['grab_ms'] < 0.4 * 1000 * up['stride'] / self.fps:
+            self._quiet += 1
+        else:
+            self._quiet = 0
+        if self._quiet >= self.recover_after * self._backoff and self.level > 0:
+            self._quiet = 0
+            return self._change(self.level - 1, "headroom")
+        return False
+
+    def _change(self, level, reason):
+        self.level = level
+        self._since_change = 0
+        self.log.append({
+            'time': round(time.monotonic() - self._start, 1),
+            'level': level,
+            'reason': reason,
+            **self.settings(),
+        })
+        return True
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, None where unsupported"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
@@ -0,0 +1,360 @@
+"""Instant replay: the last N seconds kept as fragmented MP4 in memory"""
+import tempfile
+import struct
+import threading
+from collections import deque
+import os
+import shutil
+import subprocess
+
+from .lazy import LazyModule
+from .encoding import FFmpegStreamWriter
+
+np = LazyModule('numpy', 'np', globals())
+
+
+# Track timescale of the replay stream, fragment times are in these units
+REPLAY_TIMESCALE = 90000
+
+
+def read_mp4_boxes(stream):
+    """Yield (type, whole box bytes) of the top-level boxes of an MP4 stream"""
+    def read_exact(size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = stream.read(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+    while True:
+        header = read_exact(8)
+        if header is None:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        if size == 1:
+            extended = read_exact(8)
+            if extended is None:
+                return
+            header += extended
+            size = struct.unpack('>Q', extended)[0]
+        payload = read_exact(size - len(header))
+        if payload is None:
+            return
+        yield box_type, header + payload
+
+
+def child_boxes(data, start, end):
+    """(type, payload start, end) of the boxes nested in data[start:end]"""
+    while start + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, start)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, start + 8)[0]
+            header = 16
+        if size < header:
+            return
+        yield box_type, start + header, start + size
+        start += size
+
+
+def parse_fragment(moof):
+    """(decode time, duration, starts with a keyframe) of a movie fragment
+
+    Only the first track fragment is read; times are in the track timescale.
+    """
+    traf = next((box for box in child_boxes(moof, 8, len(moof)) if box[0] == b'traf'), None)
+    if traf is None:
+        raise ValueError("Movie fragment without a track")
+    decode_time = 0
+    default_duration = 0
+    default_flags = 0
+    duration = 0
+    first_flags = None
+    for box_type, start, end in child_boxes(moof, traf[1], traf[2]):
+        version_flags = struct.unpack_from('>I', moof, start)[0]
+        version, flags = version_flags >> 24, version_flags & 0xFFFFFF
+        if box_type == b'tfhd':
+            offset = start + 8 + (8 if flags & 0x1 else 0) + (4 if flags & 0x2 else 0)
+            if flags & 0x8:
+                default_duration = struct.unpack_from('>I', moof, offset)[0]
+                offset += 4
+            offset += 4 if flags & 0x10 else 0
+            if flags & 0x20:
+                default_flags = struct.unpack_from('>I', moof, offset)[0]
+        elif box_type == b'tfdt':
+            decode_time = struct.unpack_from('>Q' if version else '>I', moof, start + 4)[0]
+        elif box_type == b'trun':
+            count = struct.unpack_from('>I', moof, start + 4)[0]
+            offset = start + 8 + (4 if flags & 0x1 else 0)
+            if flags & 0x4:
+                first_flags = struct.unpack_from('>I', moof, offset)[0]
+                offset += 4
+            if flags & 0x100:
+                # Per-sample fields in order: duration, size, flags, composition offset
+                stride = 4 * bin(flags & 0xF00).count('1')
+                duration = sum(struct.unpack_from('>I', moof, offset + index * stride)[0]
+                               for index in range(count))
+            else:
+                duration = count * default_duration
+            if first_flags is None and flags & 0x400:
+                first_flags = struct.unpack_from('>I', moof, offset + (4 if flags & 0x100 else 0)
+                                                 + (4 if flags & 0x200 else 0))[0]
+    if first_flags is None:
+        first_flags = default_flags
+    # sample_is_non_sync_sample
+    return decode_time, duration, not first_flags & 0x10000
+
+
+class ReplayBuffer:
+    """Bounded ring of encoded GOPs from a fragmented MP4 stream
+
+    Holds the stream's init segment and its fragments grouped by keyframe,
+    so the ring can be cut at any GOP and still be decoded. Whole GOPs are
+    dropped from the front once the rest covers `seconds`, or while the
+    ring is larger than max_bytes; memory does not grow with uptime.
+    """
+
+    def __init__(self, seconds, max_bytes, timescale=REPLAY_TIMESCALE):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.timescale = timescale
+        self.init = None
+        self.bytes = 0
+        self.gops_dropped = 0
+        self._gops = deque()  # [start, end, bytes, fragments], oldest first
+        self._lock = threading.Lock()
+
+    def add(self, start, duration, keyframe, data):
+        """Append a fragment; times are in the track timescale"""
+        with self._lock:
+            if keyframe or not self._gops:
+                self._gops.append([start, start, 0, []])
+            gop = self._gops[-1]
+            gop[1] = start + duration
+            gop[2] += len(data)
+            gop[3].append(data)
+            self.bytes += len(data)
+            horizon = gop[1] - self.seconds * self.timescale
+            while len(self._gops) > 1 and (self._gops[1][0] <= horizon or
+                                           self.bytes > self.max_bytes):
+                self.bytes -= self._gops.popleft()[2]
+                self.gops_dropped += 1
+
+    def clip(self, seconds):
+        """(init, fragments, start, end) of the GOPs covering the last seconds
+
+        start and end are in seconds on the stream's timeline; the clip
+        starts on the last keyframe at or before the requested window.
+        """
+        with self._lock:
+            gops = list(self._gops)
+        if not gops:
+            return self.init, [], 0.0, 0.0
+        horizon = gops[-1][1] - seconds * self.timescale
+        first = 0
+        for index, gop in enumerate(gops):
+            if gop[0] <= horizon:
+                first = index
+        gops = gops[first:]
+        fragments = [fragment for gop in gops for fragment in gop[3]]
+        return self.init, fragments, gops[0][0] / self.timescale, gops[-1][1] / self.timescale
+
+    def stats(self):
+        """Seconds and bytes currently held"""
+        with self._lock:
+            held = (self._gops[-1][1] - self._gops[0][0]) / self.timescale if self._gops else 0.0
+            return {'seconds': held, 'bytes': self.bytes, 'gops': len(self._gops),
+                    'gops_dropped': self.gops_dropped}
+
+
+class ReplayStreamWriter(FFmpegStreamWriter):
+    """Encode into a ReplayBuffer in memory instead of a file
+
+    FFmpeg writes fragmented MP4 to its stdout with a keyframe every
+    KEYFRAME_SECONDS and a fragment at least every FRAGMENT_SECONDS, so the
+    buffer trails the live picture by a fraction of a second.
+    """
+
+    STDOUT = subprocess.PIPE
+    KEYFRAME_SECONDS = 1
+    FRAGMENT_SECONDS = 0.25
+
+    def __init__(self, fps, frame_size, seconds=30, max_bytes=256 << 20, **kwargs):
+        self.buffer = ReplayBuffer(seconds, max_bytes)
+        self._reader = None
+        super().__init__('pipe:1', fps, frame_size, **kwargs)
+        if self.process is not None:
+            self._reader = threading.Thread(target=self._read_loop, args=(self.process.stdout,),
+                                            daemon=True)
+            self._reader.start()
+
+    def _output_args(self, output_path):
+        return [
+            '-force_key_frames', f'expr:gte(t,n_forced*{self.KEYFRAME_SECONDS})',
+            '-f', 'mp4',
+            '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+            '-frag_duration', str(int(self.FRAGMENT_SECONDS * 1e6)),
+            '-video_track_timescale', str(REPLAY_TIMESCALE),
+            output_path,
+        ]
+
+    def release(self):
+        """Stop the encoder once it has handed over the last fragment"""
+        success = super().release()
+        if self._reader is not None:
+            self._reader.join()
+            self._reader = None
+        return success
+
+    def _read_loop(self, stdout):
+        """Split the encoder output into the init segment and fragments"""
+        init = []
+        moof = None
+        try:
+            for box_type, data in read_mp4_boxes(stdout):
+                if box_type in (b'ftyp', b'moov'):
+                    init.append(data)
+                    self.buffer.init = b''.join(init)
+                elif box_type == b'moof':
+                    moof = data
+                elif box_type == b'mdat' and moof is not None:
+                    self.buffer.add(*parse_fragment(moof), moof + data)
+                    moof = None
+        except (OSError, ValueError, struct.error) as e:
+            self.error = f"Replay stream unreadable: {e}"
+        finally:
+            stdout.close()
+
+
+def save_replay_clip(buffer, audio, seconds, output_path):
+    """Write the last seconds of a ReplayBuffer (and a ReplayAudioSink) to MP4
+
+    Nothing is re-encoded, both streams are copied from the rings.
+    Returns the clip length in seconds.
+    """
+    init, fragments, start, end = buffer.clip(seconds)
+    if init is None or not fragments:
+        raise Exception("The replay buffer is still empty")
+    work_dir = tempfile.mkdtemp(prefix="screen_recorder_replay_")
+    try:
+        video_path = os.path.join(work_dir, 'video.mp4')
+        with open(video_path, 'wb') as video:
+            video.write(init)
+            for fragment in fragments:
+                video.write(fragment)
+        ffmpeg_cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', video_path]
+        audio_args = []
+        samples, delay = audio.clip(start, end) if audio is not None else (b'', 0.0)
+        if samples:
+            # The first AAC frame starts up to one frame after the first keyframe
+            audio_path = os.path.join(work_dir, 'audio.aac')
+            with open(audio_path, 'wb') as frames:
+                frames.write(samples)
+            ffmpeg_cmd.extend(['-itsoffset', f'{delay:.6f}', '-i', audio_path])
+            audio_args = ['-map', '1:a', '-c:a', 'copy']
+        ffmpeg_cmd.extend(['-map', '0:v', '-c:v', 'copy'] + audio_args +
+                          ['-movflags', '+faststart', output_path])
+        result = subprocess.run(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise Exception(f"FFmpeg failed: {result.stderr.decode(errors='replace').strip()}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return end - start
+
+
+class ReplayAudioSink:
+    """Keep the last seconds of audio as AAC frames for the replay buffer
+
+    Takes the place of the sound file of an AudioRecorder aligned to the
+    video timeline. An FFmpeg process encodes the samples to ADTS as they
+    arrive, so saving a clip only copies frames. AAC frames hold
+    FRAME_SAMPLES samples each; frame n starts at sample (n - 1) * 1024
+    because the encoder puts one frame of priming in front.
+    """
+
+    FRAME_SAMPLES = 1024
+
+    def __init__(self, sample_rate, channels, seconds):
+        self.path = None
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.error = None
+        self.frames_encoded = 0
+        self._frames = deque(maxlen=int(seconds * sample_rate / self.FRAME_SAMPLES) + 2)
+        self._lock = threading.Lock()
+        self._stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'error',
+             '-f', 'f32le', '-ar', str(sample_rate), '-ac', str(channels), '-i', '-',
+             '-c:a', 'aac', '-b:a', '128k', '-f', 'adts', '-'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self._stderr,
+            bufsize=0
+        )
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def write(self, block):
+        """Hand a block of samples to the encoder; after an error the rest is dropped"""
+        if self.error is not None:
+            return
+        data = memoryview(np.ascontiguousarray(block, dtype='float32')).cast('B')
+        try:
+            while data:
+                data = data[self.process.stdin.write(data):]
+        except OSError as e:
+            self.error = e
+
+    def frames(self):
+        """Number of AAC frames encoded so far"""
+        return self.frames_encoded
+
+    def clip(self, start, end):
+        """ADTS frames covering start to end seconds, and the delay of the first one"""
+        first = -(-round(start * self.sample_rate) // self.FRAME_SAMPLES) + 1
+        last = -(-round(end * self.sample_rate) // self.FRAME_SAMPLES) + 1
+        with self._lock:
+            frames = [(index, frame) for index, frame in self._frames if first <= index <= last]
+        if not frames:
+            return b'', 0.0
+        delay = (frames[0][0] - 1) * self.FRAME_SAMPLES / self.sample_rate - start
+        return b''.join(frame for index, frame in frames), delay
+
+    def close(self):
+        """Finish the encoder and keep the frames it still had"""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+        self._reader.join()
+        self._stderr.close()
+
+    def _read_loop(self):
+        """Split the ADTS stream into frames; the header holds the frame length"""
+        stdout = self.process.stdout
+        try:
+            while True:
+                header = stdout.read(7)
+                while header and len(header) < 7:
+                    more = stdout.read(7 - len(header))
+                    if not more:
+                        return
+                    header += more
+                if not header:
+                    return
+                length = ((header[3] & 0x3) << 11) | (header[4] << 3) | (header[5] >> 5)
+                frame = bytearray(header)
+                while len(frame) < length:
+                    chunk = stdout.read(length - len(frame))
+                    if not chunk:
+                        return
+                    frame += chunk
+                with self._lock:
+                    self._frames.append((self.frames_encoded, bytes(frame)))
+                    self.frames_encoded += 1
+        finally:
+            stdout.close()
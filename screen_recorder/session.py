@@ -0,0 +1,202 @@
+"""Segmented recording sessions on disk and how to rebuild them"""
+import json
+import threading
+import os
+import re
+
+from .encoding import FFmpegStreamWriter
+
+
+class SegmentedStreamWriter(FFmpegStreamWriter):
+    """Encode into self-contained fragmented MP4 segments inside a session directory
+
+    Every segment starts on a keyframe and is appended to segments.csv once
+    FFmpeg has finished it, so a crash only loses the segment being written;
+    that one is still playable up to its last complete fragment.
+    With keep > 0 only the newest `keep` completed segments stay on disk;
+    after every pruning on_prune(seconds) gets the start of the oldest
+    segment kept, e.g. to drop the audio before it.
+    """
+
+    SEGMENT_PATTERN = 'segment_%05d.mp4'
+    SEGMENT_LIST = 'segments.csv'
+
+    def __init__(self, session_dir, fps, frame_size, segment_seconds=10, keep=0, on_prune=None,
+                 **kwargs):
+        self.session_dir = str(session_dir)
+        self.segment_seconds = segment_seconds
+        self.keep = keep
+        self.on_prune = on_prune
+        self.segments_pruned = 0
+        super().__init__(os.path.join(self.session_dir, self.SEGMENT_PATTERN),
+                         fps, frame_size, **kwargs)
+        self._stop_pruning = threading.Event()
+        self._pruner = None
+        if keep and self.process is not None:
+            self._pruner = threading.Thread(target=self._prune_loop, daemon=True)
+            self._pruner.start()
+
+    def _output_args(self, output_path):
+        """Segment muxer options; timestamps keep running across segments"""
+        seconds = self.segment_seconds
+        return [
+            '-force_key_frames', f'expr:gte(t,n_forced*{seconds})',
+            '-f', 'segment',
+            '-segment_time', str(seconds),
+            '-segment_time_delta', '0.05',
+            '-segment_format', 'mp4',
+            '-segment_format_options', 'movflags=+frag_keyframe+empty_moov+default_base_moof',
+            '-segment_list', os.path.join(self.session_dir, self.SEGMENT_LIST),
+            '-segment_list_type', 'csv',
+            '-reset_timestamps', '0',
+            output_path,
+        ]
+
+    def release(self):
+        """Finish the last segment, then apply the quota a final time"""
+        self._stop_pruning.set()
+        if self._pruner is not None:
+            self._pruner.join()
+            self._pruner = None
+        success = super().release()
+        self._prune()
+        return success
+
+    def _prune_loop(self):
+        """Delete segments beyond the quota while recording"""
+        while not self._stop_pruning.wait(min(self.segment_seconds, 1.0)):
+            self._prune()
+
+    def _prune(self):
+        """Keep only the newest completed segments"""
+        if not self.keep:
+            return
+        segments = read_segment_list(self.session_dir)
+        if len(segments) <= self.keep:
+            return
+        for path, start, end in segments[:-self.keep]:
+            try:
+                os.remove(path)
+                self.segments_pruned += 1
+            except OSError:
+                pass
+        if self.on_prune is not None:
+            self.on_prune(segments[-self.keep][1])
+
+
+SESSION_SUFFIX = '.session'
+
+
+SESSION_INFO = 'session.json'
+
+
+def read_segment_list(session_dir):
+    """Completed segments of a session as (path, start, end), oldest first
+
+    Segments that a quota has already deleted are left out.
+    """
+    segments = []
+    try:
+        with open(os.path.join(session_dir, SegmentedStreamWriter.SEGMENT_LIST)) as f:
+            for line in f:
+                parts = line.strip().split(',')
+                if len(parts) != 3:
+                    continue
+                try:
+                    start, end = float(parts[1]), float(parts[2])
+                except ValueError:
+                    # Last line cut short by a crash
+                    continue
+                path = os.path.join(session_dir, parts[0])
+                if os.path.exists(path):
+                    segments.append((path, start, end))
+    except FileNotFoundError:
+        pass
+    return segments
+
+
+def write_json(path, data):
+    """Replace a JSON file atomically, so a crash never leaves half of it"""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def write_session_info(session_dir, info):
+    """Store the settings needed to rebuild a session after a crash"""
+    write_json(os.path.join(session_dir, SESSION_INFO), info)
+
+
+def find_interrupted_sessions(output_dir):
+    """Session directories left behind by recordings that never finished"""
+    try:
+        names = sorted(os.listdir(output_dir))
+    except OSError:
+        return []
+    return [os.path.join(output_dir, name) for name in names
+            if name.endswith(SESSION_SUFFIX)
+            and os.path.exists(os.path.join(output_dir, name, SESSION_INFO))]
+
+
+def sidecar_audio_chunks(session_dir, info):
+    """Raw audio files of a session in order, and the recording time the first one starts at
+
+    Chunks deleted along with pruned segments are left out.
+    """
+    pattern = info['audio_file']
+    numbers = []
+    regex = re.compile(re.escape(pattern).replace(re.escape('%05d'), r'(\d+)') + '$')
+    for name in os.listdir(session_dir):
+        match = regex.match(name)
+        if match and os.path.getsize(os.path.join(session_dir, name)):
+            numbers.append(int(match.group(1)))
+    if not numbers:
+        return [], 0.0
+    numbers.sort()
+    return ([os.path.join(session_dir, pattern % number) for number in numbers],
+            numbers[0] * info['audio_chunk_seconds'])
+
+
+def join_segments_command(session_dir, output_path=None):
+    """FFmpeg command joining the completed segments of a session, without re-encoding
+
+    Returns (command, output_path, duration in seconds).
+    """
+    with open(os.path.join(session_dir, SESSION_INFO)) as f:
+        info = json.load(f)
+    segments = read_segment_list(session_dir)
+    if not segments:
+        raise Exception(f"No completed segments in {session_dir}")
+
+    if output_path is None:
+        output_path = info['output']
+        if os.path.exists(output_path):
+            root, ext = os.path.splitext(output_path)
+            output_path = f"{root}_recovered{ext}"
+
+    concat_list = os.path.join(session_dir, 'concat.txt')
+    with open(concat_list, 'w') as f:
+        for path, start, end in segments:
+            f.write(f"file '{os.path.basename(path)}'\n")
+
+    ffmpeg_cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+                  '-f', 'concat', '-safe', '0', '-i', concat_list]
+    chunks, chunk_start = [], 0.0
+    if info.get('audio') == 'sidecar':
+        chunks, chunk_start = sidecar_audio_chunks(session_dir, info)
+    if chunks:
+        # Audio lives next to the segments; start it where the first kept segment starts
+        ffmpeg_cmd.extend([
+            '-ss', f'{max(0.0, segments[0][1] - chunk_start):.6f}',
+            '-f', 'f32le',
+            '-ar', str(info['sample_rate']),
+            '-ac', str(info['channels']),
+            # Raw samples join by plain concatenation
+            '-i', chunks[0] if len(chunks) == 1 else 'concat:' + '|'.join(chunks),
+            '-map', '0:v', '-map', '1:a',
+            '-c:v', 'copy', '-c:a', 'aac', '-b:a', '128k', '-shortest',
+        ])
+    else:
+        ffmpeg_cmd.extend(['-c', 'copy'])
+    ffmpeg_cmd.append(output_path)
+    return ffmpeg_cmd, output_path, sum(end - start for path, start, end in segments)
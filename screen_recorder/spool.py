@@ -0,0 +1,209 @@
+"""Raw frames spooled to a memory-mapped file for later encoding"""
+import json
+import time
+import errno
+import os
+
+from .lazy import LazyModule
+from .session import write_json
+from .encoding import FFMPEG_PIXEL_FORMATS
+from .capture import frame_shape
+
+np = LazyModule('numpy', 'np', globals())
+sf = LazyModule('soundfile', 'sf', globals())
+
+
+SPOOL_SUFFIX = '.spool'
+
+
+SPOOL_INFO = 'spool.json'
+
+
+class FrameSpool:
+    """Lossless raw frames in memory-mapped fixed-size slots, with a timestamp index
+
+    Slot n of frames.raw holds tick n of the recording, uncompressed in
+    pix_fmt, so the file is a plain rawvideo stream that FFmpeg reads and
+    seeks exactly, and a frame is found by arithmetic alone. The spool has
+    no vfr, so the pipeline fills every tick, also with catch_up "drop":
+    a repeated frame takes a slot of its own. index.bin holds the capture
+    time of every slot in monotonic ns plus one, so that 0 only marks a slot
+    never written; a repeated frame carries the time of the one it repeats.
+    Both files grow CHUNK_BYTES at a time: a chunk's disk space is reserved
+    and the chunk mapped once, after which write() is a copy into the
+    mapping with no system call, and the kernel writes the pages back on
+    its own.
+
+    Used as a writer it mirrors FFmpegStreamWriter (write/isOpened/
+    close_input/release). FrameSpool.open() reads a spool back as zero-copy
+    NumPy views, also one cut short by a crash: a slot is indexed only once
+    its pixels are in place, so the frames up to the first unindexed slot
+    are whole.
+    """
+
+    CHUNK_BYTES = 64 << 20  # Also bounds the mapped pages counted as resident
+    FRAMES = 'frames.raw'
+    INDEX = 'index.bin'
+    timestamped = True  # write() takes the capture time, see CapturePipeline
+
+    def __init__(self, directory, fps, frame_size, pix_fmt='yuv420p'):
+        os.makedirs(directory)
+        self._setup(directory, {'fps': fps, 'size': list(frame_size), 'pix_fmt': pix_fmt})
+        self.save_info()
+        self._frame_file = open(self.frames_path, 'w+b')
+        self._index_file = open(os.path.join(self.directory, self.INDEX), 'w+b')
+
+    @classmethod
+    def open(cls, directory):
+        """Open a spool for reading, e.g. to cut a range from it; see encode_spool()"""
+        with open(os.path.join(directory, SPOOL_INFO)) as f:
+            info = json.load(f)
+        spool = cls.__new__(cls)
+        spool._setup(directory, info)
+        slots = os.path.getsize(spool.frames_path) // spool.frame_bytes
+        index_path = os.path.join(spool.directory, cls.INDEX)
+        if slots and os.path.getsize(index_path) >= 8:
+            times = np.memmap(index_path, dtype='<i8', mode='r')[:slots]
+            unwritten = np.flatnonzero(times == 0)
+            spool.frames = int(unwritten[0]) if len(unwritten) else len(times)
+            spool._times = times[:spool.frames] - 1
+        return spool
+
+    def _setup(self, directory, info):
+        self.directory = str(directory)
+        self.info = info
+        self.fps = info['fps']
+        self.frame_size = tuple(info['size'])
+        self.pix_fmt = info['pix_fmt']
+        self.pixel_format = FFMPEG_PIXEL_FORMATS[self.pix_fmt]
+        self.shape = frame_shape(self.frame_size, self.pixel_format)
+        self.frame_bytes = int(np.prod(self.shape))
+        self.chunk_frames = max(1, self.CHUNK_BYTES // self.frame_bytes)
+        self.frames_path = os.path.join(self.directory, self.FRAMES)
+        self.frames = 0
+        self.error = None
+        self._frame_file = self._index_file = None
+        self._chunk = -1
+        self._images = None
+        self._times = np.zeros(0, dtype='<i8')
+        self._view = None
+
+    def save_info(self, **changes):
+        """Update spool.json, e.g. with what a later encode needs to know"""
+        self.info.update(changes)
+        write_json(os.path.join(self.directory, SPOOL_INFO), self.info)
+
+    def isOpened(self):
+        return self._frame_file is not None
+
+    def write(self, frame, timestamp_ns=None):
+        """Copy a frame into the next slot; without a capture time, now is used"""
+        chunk, slot = divmod(self.frames, self.chunk_frames)
+        if chunk != self._chunk:
+            self._grow(chunk)
+        np.copyto(self._images[slot], frame)
+        if timestamp_ns is None:
+            timestamp_ns = time.monotonic_ns()
+        # Indexed last, so a slot with a time always holds a whole frame
+        self._times[slot] = timestamp_ns + 1
+        self.frames += 1
+
+    def _grow(self, chunk):
+        """Map the slots of the next chunk, reserving their disk space first
+
+        With the space reserved a full disk raises here, where the pipeline
+        reports it, instead of a SIGBUS on the first touch of a page.
+        Earlier chunks are unmapped; their pages are written back anyway.
+        """
+        first = chunk * self.chunk_frames
+        for f, size in ((self._frame_file, self.frame_bytes), (self._index_file, 8)):
+            start, end = first * size, (first + self.chunk_frames) * size
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(f.fileno(), start, end - start)
+                    continue
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+            os.ftruncate(f.fileno(), end)
+        self._images = np.memmap(self._frame_file, dtype=np.uint8, mode='r+',
+                                 offset=first * self.frame_bytes,
+                                 shape=(self.chunk_frames,) + self.shape)
+        self._times = np.memmap(self._index_file, dtype='<i8', mode='r+', offset=first * 8,
+                                shape=(self.chunk_frames,))
+        self._chunk = chunk
+
+    def close_input(self):
+        """Nothing is buffered, every frame is in the mapping already"""
+
+    def release(self):
+        """Unmap the slots and cut the files to the frames written"""
+        if self._frame_file is None:
+            return False
+        self._images = None
+        self._times = np.zeros(0, dtype='<i8')
+        for f, size in ((self._frame_file, self.frame_bytes), (self._index_file, 8)):
+            f.truncate(self.frames * size)
+            f.close()
+        self._frame_file = self._index_file = None
+        self.save_info(frames=self.frames)
+        return True
+
+    def close(self):
+        """Drop the views of an opened spool"""
+        self._view = None
+        self._times = np.zeros(0, dtype='<i8')
+
+    @property
+    def duration(self):
+        return self.frames / self.fps
+
+    @property
+    def timestamps(self):
+        """Capture time of every frame of an opened spool in monotonic ns"""
+        return self._times[:self.frames]
+
+    def repeats(self):
+        """Number of frames that repeat the one before, i.e. ticks without a capture"""
+        times = self.timestamps
+        return int(np.count_nonzero(times[1:] == times[:-1]))
+
+    def view(self, start=0, stop=None):
+        """Frames start to stop as one read-only array mapped from the file, no copy"""
+        if self._view is None:
+            if not self.frames:
+                return np.empty((0,) + self.shape, dtype=np.uint8)
+            self._view = np.memmap(self.frames_path, dtype=np.uint8, mode='r',
+                                   shape=(self.frames,) + self.shape)
+        return self._view[start:stop]
+
+    def frame(self, number):
+        """One frame as a read-only view"""
+        if not 0 <= number < self.frames:
+            raise IndexError(f"Frame {number} is not in the spool ({self.frames} frames)")
+        return self.view()[number]
+
+    def frame_at(self, seconds):
+        """The frame on screen at a time of the recording, e.g. for scrubbing"""
+        return self.frame(min(self.frames - 1, max(0, int(seconds * self.fps))))
+
+    def frame_range(self, start=0.0, end=None):
+        """First frame and number of frames from start to end seconds"""
+        first = min(self.frames, max(0, round(start * self.fps)))
+        last = self.frames if end is None else min(self.frames, round(end * self.fps))
+        if last <= first:
+            until = "the end" if end is None else f"{end:g} s"
+            raise ValueError(f"No frames from {start:g} s to {until} of a {self.duration:.1f} s spool")
+        return first, last - first
+
+    def audio_path(self):
+        """The audio recorded alongside, None without one"""
+        name = self.info.get('audio')
+        path = os.path.join(self.directory, name) if name else None
+        return path if path and os.path.exists(path) and sf.info(path).frames > 0 else None
+
+    def input_args(self):
+        """FFmpeg demuxer options that read frames.raw as video"""
+        width, height = self.frame_size
+        return ['-f', 'rawvideo', '-pix_fmt', self.pix_fmt, '-video_size', f'{width}x{height}',
+                '-framerate', str(self.fps)]
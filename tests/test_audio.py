@@ -0,0 +1,74 @@
+import types
+
+import numpy as np
+import pytest
+
+from screen_recorder import audio
+from screen_recorder.audio import AudioInput, AudioRingBuffer
+from screen_recorder.bench import measure_audio_devices
+
+
+def test_ring_buffer_wraps_around():
+    ring = AudioRingBuffer(8, 2)
+    data = np.arange(22, dtype='float32').reshape(11, 2)
+    assert ring.write(data[:6])
+    ring.consume(4)
+    assert ring.write(data[6:11])
+    views = ring.peek()
+    assert len(views) == 2
+    np.testing.assert_array_equal(np.concatenate(views), data[4:11])
+    assert ring.available() == 7
+    assert ring.overruns == 0
+
+
+def test_ring_buffer_overrun_drops_the_block():
+    ring = AudioRingBuffer(8, 1)
+    data = np.arange(10, dtype='float32')[:, None]
+    assert ring.write(data[:6])
+    assert not ring.write(data[6:9])
+    assert (ring.overruns, ring.frames_lost) == (1, 3)
+    np.testing.assert_array_equal(np.concatenate(ring.peek()), data[:6])
+    # Once there is room again, writing goes on where it stopped
+    ring.consume(6)
+    assert ring.write(data[6:9])
+    np.testing.assert_array_equal(np.concatenate(ring.peek()), data[6:9])
+
+
+@pytest.mark.parametrize('drift_ppm', [300, -300])
+def test_resampler_follows_a_drifting_clock(monkeypatch, drift_ppm):
+    """A device off by drift_ppm, driven on a simulated clock, 10 ms per read"""
+    monkeypatch.setattr(audio, 'capture_time_ns',
+                        lambda frames, sample_rate, time_info: time_info.stamp_ns)
+    rate, block = 48000, 480
+    true_rate = rate * (1 + drift_ppm * 1e-6)
+    audio_input = AudioInput(0, rate, 1)
+    start_ns = 10 ** 9
+    delivered = 0
+    errors = []
+    for step in range(6000):
+        now_ns = start_ns + step * 10_000_000
+        while start_ns + (delivered + block) / true_rate * 1e9 <= now_ns:
+            # A 5 Hz sine of the capture time, so the output can be checked against the clock
+            seconds = (delivered + np.arange(block)) / true_rate
+            stamp = types.SimpleNamespace(stamp_ns=start_ns + int(delivered * 1e9 / true_rate))
+            audio_input.callback(np.sin(2 * np.pi * 5 * seconds).astype('float32')[:, None],
+                                 block, stamp, None)
+            delivered += block
+        out_ns = now_ns - 200_000_000
+        out = audio_input.read(block, rate, out_ns)
+        if step >= 4000:
+            seconds = (out_ns - start_ns) / 1e9 + np.arange(block) / rate
+            errors.append(np.max(np.abs(out[:, 0] - np.sin(2 * np.pi * 5 * seconds))))
+
+    assert audio_input.drift * 1e6 == pytest.approx(drift_ppm, abs=10)
+    assert audio_input.ratio == pytest.approx(1 + drift_ppm * 1e-6, abs=10e-6)
+    # One sample of a 5 Hz sine is at most 6.5e-4 apart: within 5 samples of the clock
+    assert max(errors) < 5 * 2 * np.pi * 5 / rate
+    assert audio_input.ring.overruns == 0
+
+
+def test_four_drifting_devices_stay_aligned(tmp_path):
+    measured = measure_audio_devices(str(tmp_path / 'mix.wav'), 4, 300, 48000, 8)
+    assert measured['xruns'] == 0
+    assert measured['clicks'] >= 3
+    assert measured['skew_ms'] < 5
@@ -0,0 +1,106 @@
+import os
+import shutil
+import time
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from screen_recorder.jobs import FinalizeQueue
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs FFmpeg")
+
+
+def tone_stages(output, seconds, realtime=False):
+    """One FFmpeg command writing seconds of a tone to output"""
+    command = ['ffmpeg', '-y', '-loglevel', 'error'] + (['-re'] if realtime else [])
+    return [[{'command': command + ['-f', 'lavfi', '-i', f'sine=duration={seconds}', output],
+              'duration': seconds}]]
+
+
+def copy_stages(output):
+    """One FFmpeg command copying {audio} to output"""
+    return [[{'command': ['ffmpeg', '-y', '-loglevel', 'error', '-i', '{audio}', output],
+              'duration': 0.1}]]
+
+
+def job(queue, job_id):
+    return {job['id']: job for job in queue.jobs()}[job_id]
+
+
+@needs_ffmpeg
+def test_finalize_queue_cancel_keeps_inputs_and_retry_finishes(tmp_path):
+    source = str(tmp_path / 'source.wav')
+    output = str(tmp_path / 'out.wav')
+    sf.write(source, np.zeros(4800, dtype='float32'), 48000)
+    queue = FinalizeQueue(tmp_path / 'jobs')
+    job_id = queue.submit('cancel', tone_stages(output, 30, realtime=True), output,
+                          in_place={'video': source})
+    queue.start()
+    try:
+        deadline = time.monotonic() + 10
+        while job(queue, job_id)['state'] != 'running' and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert queue.cancel(job_id)
+        assert queue.wait(timeout=10)
+        assert job(queue, job_id)['state'] == 'cancelled'
+        assert not os.path.exists(output)
+        assert os.path.exists(source)
+        assert not queue.cancel(job_id)
+
+        # Cancelled while still queued, then queued again: it runs to the end
+        queue.shutdown()
+        short = queue.submit('retry', tone_stages(output, 0.1), output,
+                             in_place={'video': source})
+        assert queue.cancel(short)
+        assert queue.retry(short)
+        assert not queue.retry(short)
+        queue.start()
+        assert queue.wait(timeout=30)
+        assert job(queue, short)['state'] == 'done'
+        assert os.path.exists(output)
+        assert not os.path.exists(source)
+    finally:
+        queue.shutdown()
+
+
+@needs_ffmpeg
+def test_finalize_queue_retry_after_failure(tmp_path):
+    source = str(tmp_path / 'source.wav')
+    output = str(tmp_path / 'out.wav')
+    queue = FinalizeQueue(tmp_path / 'jobs')
+    queue.start()
+    try:
+        # The input is not there yet, FFmpeg fails
+        job_id = queue.submit('copy', copy_stages(output), output, in_place={'audio': source})
+        assert queue.wait(timeout=30)
+        failed = job(queue, job_id)
+        assert failed['state'] == 'failed'
+        assert failed['error']
+        assert not queue.cancel(job_id)
+
+        sf.write(source, np.zeros(4800, dtype='float32'), 48000)
+        assert queue.retry(job_id)
+        assert queue.wait(timeout=30)
+        done = job(queue, job_id)
+        assert (done['state'], done['attempts'], done['error']) == ('done', 2, None)
+        assert os.path.exists(output)
+        assert not os.path.exists(source)
+        assert not os.listdir(tmp_path / 'jobs')
+    finally:
+        queue.shutdown()
+
+
+@needs_ffmpeg
+def test_finalize_queue_picks_up_jobs_after_a_restart(tmp_path):
+    output = str(tmp_path / 'out.wav')
+    job_id = FinalizeQueue(tmp_path / 'jobs').submit('restart', tone_stages(output, 0.1), output)
+    queue = FinalizeQueue(tmp_path / 'jobs')
+    assert queue.pending() == 1
+    queue.start()
+    try:
+        assert queue.wait(timeout=30)
+        assert job(queue, job_id)['state'] == 'done'
+        assert os.path.exists(output)
+    finally:
+        queue.shutdown()
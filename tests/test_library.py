@@ -0,0 +1,126 @@
+import os
+import shutil
+import subprocess
+import time
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from screen_recorder.library import RecordingLibrary, probe_mp4
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs FFmpeg")
+
+
+def make_mp4(path, seconds=2):
+    """An H.264/AAC file with a keyframe every second, moov at the end"""
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', f'testsrc=size=320x240:rate=30:duration={seconds}',
+                    '-f', 'lavfi', '-i', f'sine=duration={seconds}:sample_rate=44100',
+                    '-c:v', 'libx264', '-g', '30', '-sc_threshold', '0',
+                    '-c:a', 'aac', '-ac', '2', str(path)], check=True)
+
+
+def settled(path):
+    """Date a file back so the first scan indexes it"""
+    past = time.time() - 60
+    os.utime(path, (past, past))
+
+
+@needs_ffmpeg
+def test_probe_mp4_reads_the_sample_tables(tmp_path):
+    path = tmp_path / 'clip.mp4'
+    make_mp4(path)
+    info = probe_mp4(str(path))
+    keyframes = info.pop('keyframes')
+    assert info == {'duration': 2.0, 'width': 320, 'height': 240, 'fps': 30.0, 'frames': 60,
+                    'video_codec': 'avc1', 'audio_codec': 'mp4a', 'sample_rate': 44100,
+                    'channels': 2}
+    assert [seconds for seconds, offset in keyframes] == [0.0, 1.0]
+    assert 0 < keyframes[0][1] < keyframes[1][1] < os.path.getsize(path)
+
+
+@needs_ffmpeg
+def test_probe_mp4_rejects_an_unfinished_file(tmp_path):
+    path = tmp_path / 'clip.mp4'
+    make_mp4(path)
+    # Cut before the moov box, like a recording whose writer died
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) // 2)
+    with pytest.raises(ValueError):
+        probe_mp4(str(path))
+
+
+def test_library_indexes_searches_and_forgets_files(tmp_path):
+    for name in ('recording_20240101_120000.wav', 'recording_20240102_120000.wav',
+                 'notes_1.wav', 'notes1.wav'):
+        sf.write(str(tmp_path / name), np.zeros((4800, 2), dtype='float32'), 48000)
+    (tmp_path / 'broken.mp4').write_bytes(b'\0' * 64)
+    (tmp_path / 'readme.txt').write_text("not a recording")
+    for path in tmp_path.iterdir():
+        settled(path)
+
+    library = RecordingLibrary(tmp_path)
+    library.start()
+    try:
+        assert library.scan() == (5, 0)
+        assert library.wait(thumbnails=False, timeout=30)
+        assert library.count() == 5
+        newest = library.page(limit=2, search='recording')
+        assert [entry['name'] for entry in newest] == [
+            'recording_20240102_120000.wav', 'recording_20240101_120000.wav']
+        assert (newest[0]['duration'], newest[0]['sample_rate'], newest[0]['channels']) == (
+            0.1, 48000, 2)
+        # _ is matched literally, not as a LIKE wildcard
+        assert [entry['name'] for entry in library.page(search='s_')] == ['notes_1.wav']
+        # A file that cannot be probed keeps its error and is not probed again
+        assert library.get('broken.mp4')['error']
+        assert library.scan() == (0, 0)
+
+        os.remove(tmp_path / 'notes1.wav')
+        assert library.scan() == (0, 1)
+        assert library.get('notes1.wav') is None
+        assert library.count() == 4
+    finally:
+        library.close()
+
+    # The index outlives the library object
+    library = RecordingLibrary(tmp_path)
+    try:
+        assert library.count() == 4
+        assert library.scan() == (0, 0)
+    finally:
+        library.close()
+
+
+@needs_ffmpeg
+def test_library_keeps_keyframes_for_seeking(tmp_path):
+    path = tmp_path / 'recording_20240101_120000.mp4'
+    make_mp4(path, seconds=3)
+    library = RecordingLibrary(tmp_path)
+    library.start()
+    try:
+        library.add(str(path))
+        assert library.wait(thumbnails=False, timeout=30)
+        assert [seconds for seconds, offset in library.keyframes(path)] == [0.0, 1.0, 2.0]
+        assert library.keyframe_before(path.name, 1.5) == library.keyframes(path)[1]
+        assert library.keyframe_before('missing.mp4', 1.5) == (0.0, None)
+    finally:
+        library.close()
+
+
+def test_library_reports_failures_through_on_error(tmp_path, monkeypatch):
+    errors = []
+    library = RecordingLibrary(tmp_path, on_error=lambda title, message: errors.append(message))
+
+    def fail(name):
+        raise OSError("disk gone")
+
+    monkeypatch.setattr(library, '_index', fail)
+    library.start()
+    try:
+        library.add('recording.mp4')
+        assert library.wait(timeout=30)
+    finally:
+        library.close()
+    assert errors == ["Could not index recording.mp4: disk gone"]
@@ -0,0 +1,236 @@
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from screen_recorder.encoding import FFmpegStreamWriter, quality_encoder_settings
+from screen_recorder.pipeline import CapturePipeline, FrameRing
+from screen_recorder.jobs import chunk_ranges, finalize_stages
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs FFmpeg")
+
+
+def fill(ring, index):
+    slot = ring.acquire_write(timeout=0.05)
+    if slot is not None:
+        ring.buffers[slot][:] = index
+        ring.commit(slot, float(index), index)
+    return slot
+
+
+def drain(ring):
+    ring.close()
+    indices = []
+    while (slot := ring.acquire_read()) is not None:
+        indices.append(ring.indices[slot])
+        ring.release(slot)
+    return indices
+
+
+def test_frame_ring_drop_oldest_recycles_the_oldest_frame():
+    ring = FrameRing(2, (4,), policy="drop_oldest")
+    for index in range(3):
+        assert fill(ring, index) is not None
+    assert ring.dropped == 1
+    assert drain(ring) == [1, 2]
+
+
+def test_frame_ring_drop_newest_skips_the_new_frame():
+    ring = FrameRing(2, (4,), policy="drop_newest")
+    assert [fill(ring, index) is not None for index in range(3)] == [True, True, False]
+    assert ring.dropped == 1
+    assert drain(ring) == [0, 1]
+
+
+def test_frame_ring_block_waits_for_the_consumer():
+    ring = FrameRing(2, (4,), policy="block")
+    fill(ring, 0)
+    fill(ring, 1)
+    # Nobody consumes: the producer gives up after its timeout
+    assert fill(ring, 2) is None
+    assert ring.dropped == 1
+
+    def consume():
+        time.sleep(0.05)
+        ring.release(ring.acquire_read())
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    assert ring.acquire_write(timeout=5.0) is not None
+    consumer.join()
+    assert ring.dropped == 1
+
+
+def test_frame_ring_close_drains_then_returns_none():
+    ring = FrameRing(3, (4,), policy="block")
+    fill(ring, 0)
+    fill(ring, 1)
+    assert drain(ring) == [0, 1]
+    assert ring.acquire_read(timeout=0.05) is None
+
+
+@pytest.mark.parametrize('frames, chunks', [(100, 4), (101, 4), (7, 3), (3, 8), (10, 0)])
+def test_chunk_ranges_cover_every_frame_once(frames, chunks):
+    ranges = chunk_ranges(frames, chunks)
+    assert len(ranges) == max(1, min(chunks, frames))
+    assert ranges[0][0] == 0
+    for (first, count), (next_first, _) in zip(ranges, ranges[1:]):
+        assert first + count == next_first
+    assert sum(count for _, count in ranges) == frames
+    counts = [count for _, count in ranges]
+    assert max(counts) - min(counts) <= 1
+
+
+def test_vfr_capture_is_finalized_in_one_piece():
+    # Chunks are cut by frame count, which only works at a constant rate
+    stages, files = finalize_stages('out.mp4', 30, 30 * 600, chunks=4, vfr=True)
+    assert len(stages) == 1 and len(stages[0]) == 1
+    command = stages[0][0]['command']
+    assert command[command.index('-fps_mode') + 1] == 'vfr'
+    assert files == {}
+
+
+def test_default_quality_keeps_the_x264_default():
+    assert quality_encoder_settings(95) == (23, 'veryfast')
+    assert quality_encoder_settings(100)[0] == 18
+    assert quality_encoder_settings(1) == (35, 'superfast')
+    crfs = [quality_encoder_settings(quality)[0] for quality in range(1, 101)]
+    assert crfs == sorted(crfs, reverse=True)
+
+
+class StallingBackend:
+    """A 64x48 capture source whose grab() hangs once, at grab number stall_at"""
+
+    pixel_format = "BGRA"
+
+    def __init__(self, stall_at, seconds):
+        self.stall_at = stall_at
+        self.seconds = seconds
+        self.grabs = 0
+        self._frame = np.zeros((48, 64, 4), dtype=np.uint8)
+
+    def frame_size(self):
+        return (64, 48)
+
+    def grab(self):
+        self.grabs += 1
+        if self.grabs == self.stall_at:
+            time.sleep(self.seconds)
+        self._frame[...] = self.grabs
+        return self._frame
+
+    def close(self):
+        pass
+
+
+class TickWriter:
+    """Records the tick of every write; vfr like FFmpegStreamWriter(vfr=True)"""
+
+    def __init__(self):
+        self.vfr = True
+        self.ticks = []
+
+    def write(self, frame, tick=None):
+        self.ticks.append(tick)
+
+
+class PartWriter(TickWriter):
+    """A TickWriter the rate controller can retire"""
+
+    error = None
+
+    def isOpened(self):
+        return True
+
+    def close_input(self):
+        pass
+
+    def release(self):
+        return True
+
+
+def record_with_stall(catch_up):
+    backend = StallingBackend(stall_at=5, seconds=0.3)
+    writer = TickWriter()
+    pipeline = CapturePipeline(backend, writer, 20, policy="block", catch_up=catch_up)
+    pipeline.start()
+    deadline = time.monotonic() + 10
+    while backend.grabs < 15 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pipeline.stop()
+    return pipeline.stats(), writer.ticks
+
+
+def test_stalled_grab_is_filled_with_duplicates():
+    stats, ticks = record_with_stall("duplicate")
+    assert stats['ticks_missed'] >= 4
+    assert stats['repeated'] >= stats['ticks_missed']
+    assert stats['held'] == 0
+    # Every tick has a frame, the writer never sees a timestamp
+    assert len(ticks) == stats['written'] + stats['repeated']
+    assert set(ticks) == {None}
+
+
+def test_stalled_grab_leaves_the_ticks_out_with_drop():
+    stats, ticks = record_with_stall("drop")
+    assert stats['ticks_missed'] >= 4
+    assert stats['repeated'] == 0
+    assert stats['held'] >= stats['ticks_missed']
+    assert len(ticks) == stats['written']
+    gaps = [later - earlier for earlier, later in zip(ticks, ticks[1:])]
+    assert min(gaps) >= 1
+    assert max(gaps) > stats['ticks_missed']
+
+
+@needs_ffmpeg
+def test_vfr_writer_keeps_the_tick_timestamps(tmp_path):
+    output = str(tmp_path / 'vfr.mp4')
+    writer = FFmpegStreamWriter(output, 30, (64, 48), pix_fmt='bgr24', vfr=True)
+    frame = np.zeros((48, 64, 3), dtype=np.uint8)
+    ticks = [0, 1, 2, 6, 7, 20]
+    for tick in ticks:
+        frame[...] = tick * 10
+        writer.write(frame, tick)
+    assert writer.release(), writer.error
+
+    crc = subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', output, '-map', '0:v',
+                          '-f', 'framecrc', '-'], capture_output=True, text=True, check=True)
+    timebase = re.search(r'#tb 0: (\d+)/(\d+)', crc.stdout)
+    scale = int(timebase.group(1)) / int(timebase.group(2))
+    times = [int(line.split(',')[2]) * scale for line in crc.stdout.splitlines()
+             if line and not line.startswith('#')]
+    assert [round(t * 30, 3) for t in times] == ticks
+
+
+def test_vfr_parts_count_their_ticks_from_their_first_frame():
+    writers = [PartWriter()]
+
+    def reopen_writer(frame_size, preset):
+        writers.append(PartWriter())
+        return writers[-1]
+
+    backend = StallingBackend(stall_at=0, seconds=0)
+    pipeline = CapturePipeline(backend, writers[0], 20, policy="block", catch_up="drop",
+                               reopen_writer=reopen_writer)
+    pipeline.start()
+    deadline = time.monotonic() + 10
+    while backend.grabs < 10 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pipeline.set_rate(stride=2, scale=0.5)
+    while backend.grabs < 20 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pipeline.stop()
+
+    assert len(writers) == 2
+    assert writers[1].ticks[0] == 0
+    assert writers[1].ticks == sorted(set(writers[1].ticks))
+    # Throttled ticks are held, not written; frames grabbed before set_rate
+    # may still reach the new part
+    assert writers[1].ticks[-1] - writers[1].ticks[-2] == 2
+    assert pipeline.frames_held == pipeline.frames_throttled > 0
+    assert sum(pipeline.part_frames) == pipeline.ticks
+    assert pipeline.part_frames[1] > writers[1].ticks[-1]
@@ -0,0 +1,117 @@
+import io
+import shutil
+import struct
+import subprocess
+
+import numpy as np
+import pytest
+
+from screen_recorder.replay import (REPLAY_TIMESCALE, ReplayAudioSink, ReplayBuffer,
+                                    ReplayStreamWriter, parse_fragment, read_mp4_boxes,
+                                    save_replay_clip)
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs FFmpeg")
+
+FPS = 30
+SIZE = (160, 120)
+SAMPLE_RATE = 48000
+
+
+def box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type, version, flags, payload):
+    return box(box_type, struct.pack('>I', version << 24 | flags) + payload)
+
+
+def moof(first_sample_flags=None):
+    """Movie fragment of three 3000-tick samples, non-sync unless the first says otherwise"""
+    tfhd = full_box(b'tfhd', 0, 0x8 | 0x20, struct.pack('>III', 1, 3000, 0x10000))
+    tfdt = full_box(b'tfdt', 1, 0, struct.pack('>Q', 1 << 33))
+    trun_flags = 0x1 | (0x4 if first_sample_flags is not None else 0)
+    trun = struct.pack('>Ii', 3, 0)
+    if first_sample_flags is not None:
+        trun += struct.pack('>I', first_sample_flags)
+    traf = box(b'traf', tfhd + tfdt + full_box(b'trun', 0, trun_flags, trun))
+    return box(b'moof', full_box(b'mfhd', 0, 0, struct.pack('>I', 1)) + traf)
+
+
+def packets(path):
+    """(stream, pts, duration) of every packet in a media file, in stream time base"""
+    result = subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', path, '-c', 'copy',
+                             '-f', 'framemd5', '-'], capture_output=True, text=True, check=True)
+    return [tuple(int(field) for field in (line.split(',')[0], line.split(',')[2],
+                                           line.split(',')[3]))
+            for line in result.stdout.splitlines() if not line.startswith('#')]
+
+
+def test_parse_fragment_reads_times_and_the_first_sample_flags():
+    assert parse_fragment(moof()) == (1 << 33, 9000, False)
+    assert parse_fragment(moof(first_sample_flags=0x2000000)) == (1 << 33, 9000, True)
+    with pytest.raises(ValueError):
+        parse_fragment(box(b'moof', full_box(b'mfhd', 0, 0, struct.pack('>I', 1))))
+
+
+def test_replay_buffer_drops_whole_gops_from_the_front():
+    buffer = ReplayBuffer(seconds=3, max_bytes=1 << 20, timescale=10)
+    for second in range(10):
+        buffer.add(second * 10, 5, True, b'k' * 10)
+        buffer.add(second * 10 + 5, 5, False, b'p' * 10)
+    assert buffer.stats() == {'seconds': 3.0, 'bytes': 60, 'gops': 3, 'gops_dropped': 7}
+    init, fragments, start, end = buffer.clip(1.5)
+    # The window starts halfway into a GOP, the clip at its keyframe
+    assert (start, end) == (8.0, 10.0)
+    assert fragments == [b'k' * 10, b'p' * 10] * 2
+
+    # Over the memory limit the oldest GOPs go first, whatever they cover
+    buffer.max_bytes = 30
+    buffer.add(100, 5, True, b'k' * 10)
+    assert buffer.stats() == {'seconds': 1.5, 'bytes': 30, 'gops': 2, 'gops_dropped': 9}
+
+
+@needs_ffmpeg
+def test_saved_clip_starts_on_a_keyframe_with_audio_trimmed_to_it(tmp_path):
+    writer = ReplayStreamWriter(FPS, SIZE, seconds=3)
+    audio = ReplayAudioSink(SAMPLE_RATE, 2, 5)
+    width, height = SIZE
+    try:
+        for index in range(6 * FPS):
+            frame = np.zeros(width * height * 3 // 2, dtype='uint8')
+            frame[:width * height].reshape(height, width)[:, index * 3 % width] = 255
+            writer.write(frame)
+            audio.write(np.full((SAMPLE_RATE // FPS, 2), 0.1, dtype='float32'))
+    finally:
+        assert writer.release(), writer.error
+        audio.close()
+
+    # The fragments FFmpeg wrote follow each other without gaps
+    init, fragments, start, end = writer.buffer.clip(60)
+    times = [parse_fragment(data) for box_type, data in
+             read_mp4_boxes(io.BytesIO(b''.join(fragments))) if box_type == b'moof']
+    assert times[0][2]
+    assert all(a[0] + a[1] == b[0] for a, b in zip(times, times[1:]))
+    assert times[-1][0] + times[-1][1] == 6 * REPLAY_TIMESCALE
+    # Three seconds plus at most the GOP the window starts in
+    assert 3 <= writer.buffer.stats()['seconds'] <= 3 + ReplayStreamWriter.KEYFRAME_SECONDS
+
+    clip = str(tmp_path / 'clip.mp4')
+    length = save_replay_clip(writer.buffer, audio, 2.5, clip)
+    assert 2.5 <= length <= 2.5 + ReplayStreamWriter.KEYFRAME_SECONDS
+
+    video = [(pts, duration) for stream, pts, duration in packets(clip) if stream == 0]
+    sound = [(pts, duration) for stream, pts, duration in packets(clip) if stream == 1]
+    assert len(video) == round(length * FPS)
+    assert min(pts for pts, duration in video) == 0
+    # Every packet decodes, so the first one is a keyframe
+    decoded = subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', clip, '-map', '0:v',
+                              '-f', 'framemd5', '-'], capture_output=True, text=True, check=True)
+    assert len([line for line in decoded.stdout.splitlines()
+                if not line.startswith('#')]) == len(video)
+
+    # The audio covers the clip, not the five seconds its ring holds
+    frame_seconds = ReplayAudioSink.FRAME_SAMPLES / SAMPLE_RATE
+    audio_start = sound[0][0] / SAMPLE_RATE
+    audio_end = (sound[-1][0] + sound[-1][1]) / SAMPLE_RATE
+    assert 0 <= audio_start < frame_seconds
+    assert abs(audio_end - length) <= 2 * frame_seconds
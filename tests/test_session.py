@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+
+from screen_recorder.session import (find_interrupted_sessions, join_segments_command,
+                                     read_segment_list, sidecar_audio_chunks, write_session_info)
+from screen_recorder.audio import ChunkedAudioSink
+
+
+def make_session(output_dir, segments, chunks, chunk_seconds=2.0):
+    """Session directory with fake segment files and raw audio chunks"""
+    session_dir = output_dir / "recording_20240101_120000.session"
+    session_dir.mkdir()
+    lines = []
+    for number, (start, end) in segments.items():
+        name = f"segment_{number:05d}.mp4"
+        (session_dir / name).write_bytes(b"\0" * 16)
+        lines.append(f"{name},{start:.6f},{end:.6f}\n")
+    # The last line of the list was cut short by a crash
+    lines.append("segment_00009.mp4,18.0")
+    (session_dir / "segments.csv").write_text("".join(lines))
+    for number in chunks:
+        (session_dir / f"audio_{number:05d}.f32").write_bytes(b"\0" * 64)
+    info = {
+        'output': str(output_dir / "recording_20240101_120000.mp4"),
+        'fps': 30,
+        'size': [640, 480],
+        'segment_seconds': 2,
+        'segment_keep': 2,
+        'audio': 'sidecar',
+        'audio_file': 'audio_%05d.f32',
+        'audio_chunk_seconds': chunk_seconds,
+        'sample_rate': 48000,
+        'channels': 2,
+    }
+    write_session_info(str(session_dir), info)
+    return session_dir, info
+
+
+def test_segment_list_skips_pruned_and_truncated_entries(tmp_path):
+    session_dir, info = make_session(tmp_path, {1: (2.0, 4.0), 2: (4.0, 6.0)}, [2, 3])
+    # Listed, but deleted by the quota
+    with open(session_dir / "segments.csv") as f:
+        listed = f.read()
+    (session_dir / "segments.csv").write_text("segment_00000.mp4,0.000000,2.000000\n" + listed)
+
+    segments = read_segment_list(str(session_dir))
+    assert [(os.path.basename(path), start, end) for path, start, end in segments] == [
+        ("segment_00001.mp4", 2.0, 4.0), ("segment_00002.mp4", 4.0, 6.0)]
+
+
+def test_find_interrupted_sessions_needs_session_info(tmp_path):
+    session_dir, info = make_session(tmp_path, {0: (0.0, 2.0)}, [0])
+    (tmp_path / "recording_20240101_130000.session").mkdir()
+    (tmp_path / "recording_20240101_120000.mp4").write_bytes(b"")
+
+    assert find_interrupted_sessions(str(tmp_path)) == [str(session_dir)]
+    assert find_interrupted_sessions(str(tmp_path / "missing")) == []
+
+
+def test_sidecar_audio_chunks_start_after_pruned_ones(tmp_path):
+    session_dir, info = make_session(tmp_path, {2: (4.0, 6.0), 3: (6.0, 8.0)}, [3, 2, 4])
+    # An empty chunk was opened but never written to
+    (session_dir / "audio_00005.f32").write_bytes(b"")
+
+    chunks, start = sidecar_audio_chunks(str(session_dir), info)
+    assert [os.path.basename(path) for path in chunks] == [
+        "audio_00002.f32", "audio_00003.f32", "audio_00004.f32"]
+    assert start == 4.0
+
+
+def test_join_command_seeks_into_the_first_kept_chunk(tmp_path):
+    # The quota kept segments 3 and 4; audio chunks are 2 s, 0 and 1 are gone
+    session_dir, info = make_session(tmp_path, {3: (6.5, 8.5), 4: (8.5, 10.5)}, [2, 3, 4, 5],
+                                     chunk_seconds=2.0)
+
+    command, output_path, duration = join_segments_command(str(session_dir))
+    inputs = [command[i + 1] for i, arg in enumerate(command) if arg == '-i']
+    concat_list = session_dir / "concat.txt"
+    assert inputs[0] == str(concat_list)
+    assert concat_list.read_text() == "file 'segment_00003.mp4'\nfile 'segment_00004.mp4'\n"
+    assert inputs[1] == 'concat:' + '|'.join(
+        str(session_dir / f"audio_{number:05d}.f32") for number in (2, 3, 4, 5))
+    # Segment 3 starts 6.5 s in, chunk 2 at 4.0 s
+    assert command[command.index('-ss') + 1] == '2.500000'
+    assert command.index('-ss') < command.index(inputs[1])
+    assert output_path == info['output']
+    assert duration == 4.0
+
+
+def test_join_command_without_audio_copies_the_segments(tmp_path):
+    session_dir, info = make_session(tmp_path, {0: (0.0, 2.0)}, [])
+    (tmp_path / "recording_20240101_120000.mp4").write_bytes(b"")
+
+    command, output_path, duration = join_segments_command(str(session_dir))
+    assert command.count('-i') == 1
+    assert command[-3:] == ['-c', 'copy', output_path]
+    # An existing recording is never overwritten
+    assert output_path.endswith("recording_20240101_120000_recovered.mp4")
+
+
+def test_chunked_sink_splits_and_drops_chunks(tmp_path):
+    pattern = str(tmp_path / "audio_%05d.f32")
+    sink = ChunkedAudioSink(pattern, 10, 1, 1.0)
+    for block in np.arange(35, dtype='float32').reshape(7, 5, 1):
+        sink.write(block)
+    sink.close()
+    sizes = [os.path.getsize(pattern % number) for number in range(4)]
+    assert sizes == [40, 40, 40, 20]
+
+    sink.drop_before(2.5)
+    assert [os.path.exists(pattern % number) for number in range(4)] == [False, False, True, True]
+    # The chunk being written is never deleted
+    sink.drop_before(10.0)
+    assert os.path.exists(pattern % 3)
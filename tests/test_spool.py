@@ -0,0 +1,127 @@
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from screen_recorder.capture import frame_shape
+from screen_recorder.spool import FrameSpool
+from screen_recorder.engine import RecorderEngine
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs FFmpeg")
+
+SIZE = (32, 32)
+FPS = 10
+
+
+def gray_frame(value):
+    """An I420 frame of one shade of gray"""
+    frame = np.full(frame_shape(SIZE, "I420"), 128, dtype=np.uint8)
+    frame[:SIZE[1]] = value
+    return frame
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Four frames per chunk, so a few frames already map several chunks
+    monkeypatch.setattr(FrameSpool, 'CHUNK_BYTES', 4 * int(np.prod(frame_shape(SIZE, "I420"))))
+
+
+def test_spool_index_keeps_capture_times_and_repeats(tmp_path, small_chunks):
+    directory = str(tmp_path / 'recording.spool')
+    spool = FrameSpool(directory, FPS, SIZE)
+    # A capture time of exactly 0 is a time like any other
+    times = [0, 100, 100, 300, 400, 400, 400, 700, 800, 900]
+    for number, timestamp in enumerate(times):
+        spool.write(gray_frame(number), timestamp)
+    assert spool.release()
+
+    spool = FrameSpool.open(directory)
+    try:
+        assert spool.frames == 10
+        assert list(spool.timestamps) == times
+        assert spool.repeats() == 3
+        assert spool.info['frames'] == 10
+        assert spool.frame(5)[0, 0] == 5
+        assert spool.frame_at(0.75)[0, 0] == 7
+        assert spool.view(2, 4)[:, 0, 0].tolist() == [2, 3]
+        with pytest.raises(IndexError):
+            spool.frame(10)
+    finally:
+        spool.close()
+
+
+def test_spool_of_a_crashed_writer_is_read_up_to_its_last_whole_frame(tmp_path, small_chunks):
+    directory = str(tmp_path / 'recording.spool')
+    writer = FrameSpool(directory, FPS, SIZE)
+    try:
+        for number in range(6):
+            writer.write(gray_frame(number), 1000 + number)
+        # Never released: both files still span the whole second chunk
+        frame_bytes = int(np.prod(frame_shape(SIZE, "I420")))
+        assert os.path.getsize(writer.frames_path) == 8 * frame_bytes
+
+        spool = FrameSpool.open(directory)
+        assert spool.frames == 6
+        assert spool.frame(5)[0, 0] == 5
+        spool.close()
+
+        # The writer died within the pixels of slot 5, before indexing it
+        index = np.memmap(os.path.join(directory, FrameSpool.INDEX), dtype='<i8', mode='r+')
+        index[5] = 0
+        index.flush()
+        del index
+        spool = FrameSpool.open(directory)
+        assert (spool.frames, list(spool.timestamps)) == (5, [1000, 1001, 1002, 1003, 1004])
+        spool.close()
+
+        # The file system lost the end of the frames, slot 4 is only half there
+        with open(writer.frames_path, 'r+b') as f:
+            f.truncate(4 * frame_bytes + frame_bytes // 2)
+        spool = FrameSpool.open(directory)
+        assert spool.frames == 4
+        assert spool.view()[:, 0, 0].tolist() == [0, 1, 2, 3]
+        spool.close()
+    finally:
+        writer.release()
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize('chunks', [1, 2])
+def test_encode_spool_cuts_a_range_with_its_audio(tmp_path, chunks):
+    directory = str(tmp_path / 'recording_20240101_120000.spool')
+    spool = FrameSpool(directory, FPS, SIZE)
+    for number in range(3 * FPS):
+        spool.write(gray_frame(8 * number))
+    spool.release()
+    sf.write(os.path.join(directory, 'audio.wav'), np.full((3 * 48000, 2), 0.1, dtype='float32'),
+             48000)
+    spool.save_info(audio='audio.wav', audio_tracks=1, channels=2)
+
+    engine = RecorderEngine(jobs_dir=str(tmp_path / 'jobs'))
+    engine.finalize_chunks = chunks
+    engine.MIN_CHUNK_SECONDS = 0.1
+    try:
+        output = engine.encode_spool(directory, start=1.0, end=2.0)
+        assert engine.jobs.wait(timeout=60)
+    finally:
+        engine.jobs.shutdown()
+    assert output == str(tmp_path / 'recording_20240101_120000_1.0-2.0.mp4')
+
+    # Frames 10 to 19, told apart by their shade
+    height = SIZE[1]
+    raw = subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', output, '-map', '0:v',
+                          '-f', 'rawvideo', '-pix_fmt', 'yuv420p', '-'],
+                         capture_output=True, check=True).stdout
+    frames = np.frombuffer(raw, dtype=np.uint8).reshape((-1,) + frame_shape(SIZE, "I420"))
+    shades = frames[:, :height].mean(axis=(1, 2))
+    assert np.abs(shades - 8 * np.arange(10, 20)).max() < 4
+
+    audio = str(tmp_path / 'audio.wav')
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', output, '-map', '0:a', audio],
+                   check=True)
+    assert sf.info(audio).duration == pytest.approx(1.0, abs=0.05)
+    # The spool is left for further cuts
+    assert FrameSpool.open(directory).frames == 3 * FPS